@@ -1,11 +1,15 @@
 import argparse
 import sys
 
-from flowy import workflow_starter
 
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['replay']:
+        from flowy.replay import main as replay
+        return replay(argv[1:])
 
-def main():
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(
+        epilog="Use 'flowy replay -h' to replay a decision from a history.")
     parser.add_argument("domain")
     parser.add_argument("name")
     parser.add_argument("version")
@@ -14,11 +18,13 @@ def main():
     parser.add_argument("--workflow-duration", type=int, default=None)
     parser.add_argument('args', nargs=argparse.REMAINDER)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
-    wf = workflow_starter(args.domain, args.name, args.version, args.task_list,
-                          args.decision_duration, args.workflow_duration)
-    return not wf.start(*args.args)  # 0 is success
+    from flowy.backend.swf import SWFWorkflowStarter
+    start = SWFWorkflowStarter().start(
+        args.domain, args.name, args.version, args.task_list,
+        args.decision_duration, args.workflow_duration)
+    return not start(*args.args)  # 0 is success
 
 
 if __name__ == '__main__':
@@ -0,0 +1,296 @@
+"""Activity latency and throughput analysis of Amazon SWF histories.
+
+The histories can be loaded from recorder logs (the PollForDecisionTask
+responses are merged per execution) or from exported JSON files. An exported
+file can hold a GetWorkflowExecutionHistory response, a list of events or a
+list of responses, or one response per line.
+
+Every activity task attempt becomes a row in a columnar ActivityTable, backed
+by NumPy arrays, that computes the percentiles, the rates and the throughput:
+
+    $ python -m flowy.analytics flowy/tests/integration/logs/*.workflow.log
+
+NumPy is an optional dependency, install it with the analytics extra:
+
+    $ pip install flowy[analytics]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+__all__ = ['ActivityTable', 'load_histories']
+
+
+RUNNING, COMPLETED, FAILED, TIMED_OUT, CANCELED = range(5)
+_OUTCOMES = {
+    'ActivityTaskCompleted': COMPLETED,
+    'ActivityTaskFailed': FAILED,
+    'ActivityTaskTimedOut': TIMED_OUT,
+    'ActivityTaskCanceled': CANCELED,
+}
+
+
+def load_histories(paths):
+    """Return the list of event lists found in the files."""
+    histories = []
+    for path in paths:
+        with open(path) as f:
+            first = f.readline()
+            f.seek(0)
+            if first.startswith(('>>>', '<<<')):
+                histories.extend(_recorded_histories(f))
+            else:
+                histories.extend(_exported_histories(f))
+    return histories
+
+
+def _recorded_histories(log_file):
+    executions = {}
+    action = None
+    for line in log_file:
+        sep, data = line.rstrip('\n').split('\t', 1)
+        if sep == '>>>':
+            action = data.split('\t', 1)[0]
+        elif action == 'PollForDecisionTask':
+            try:
+                page = json.loads(data)
+            except ValueError:  # recorded errors
+                continue
+            _merge_page(executions, page)
+    return [_sorted_events(events) for events in executions.values()]
+
+
+def _merge_page(executions, page):
+    # each decision reloads the history, keep every event only once
+    key = page.get('workflowExecution', {}).get('runId', page.get('taskToken'))
+    if key is None:
+        return
+    events = executions.setdefault(key, {})
+    for event in page.get('events', []):
+        events[event['eventId']] = event
+
+
+def _sorted_events(events):
+    return [events[event_id] for event_id in sorted(events)]
+
+
+def _exported_histories(f):
+    try:
+        docs = [json.load(f)]
+    except ValueError:  # one document per line
+        f.seek(0)
+        docs = [json.loads(line) for line in f if line.strip()]
+    histories = []
+    for doc in docs:
+        if isinstance(doc, dict):
+            doc = [doc]
+        if doc and 'eventType' in doc[0]:
+            histories.append(doc)
+        else:
+            executions = {}
+            for i, response in enumerate(doc):
+                response.setdefault('taskToken', i)
+                _merge_page(executions, response)
+            histories.extend(_sorted_events(events)
+                             for events in executions.values())
+    return histories
+
+
+def activity_attempts(events):
+    """Generate a row for each activity task attempt in a history.
+
+    The rows are tuples of: activity type ('name:version'), task list, retry
+    number, scheduled, started and closed timestamps (None if missing) and the
+    outcome. The events are matched the same way as in load_events.
+    """
+    attempts = {}
+    order = []
+    for event in events:
+        e_type = event.get('eventType')
+        if e_type == 'ActivityTaskScheduled':
+            attrs = event['activityTaskScheduledEventAttributes']
+            a_type = attrs['activityType']
+            row = ['%s:%s' % (a_type['name'], a_type['version']),
+                   attrs.get('taskList', {}).get('name'),
+                   _retry_number(attrs['activityId']),
+                   event['eventTimestamp'], None, None, RUNNING]
+            attempts[event['eventId']] = row
+            order.append(row)
+        elif e_type == 'ActivityTaskStarted':
+            attrs = event['activityTaskStartedEventAttributes']
+            row = attempts.get(attrs['scheduledEventId'])
+            if row is not None:
+                row[4] = event['eventTimestamp']
+        elif e_type in _OUTCOMES:
+            attrs_key = e_type[0].lower() + e_type[1:] + 'EventAttributes'
+            row = attempts.get(event[attrs_key]['scheduledEventId'])
+            if row is not None:
+                row[5] = event['eventTimestamp']
+                row[6] = _OUTCOMES[e_type]
+    for row in order:
+        yield tuple(row)
+
+
+def _retry_number(activity_id):
+    # the ContextBoundProxy call keys end with the retry number
+    try:
+        return int(activity_id.rsplit('-', 1)[1])
+    except (IndexError, ValueError):
+        return 0
+
+
+class ActivityTable(object):
+    """Columnar activity task attempts.
+
+    The activity types and task lists are stored as integer codes in the
+    type and task_list arrays, indexing the types and task_lists lists. The
+    missing timestamps are NaN.
+    """
+    def __init__(self, rows):
+        if numpy is None:
+            raise ImportError('NumPy is required for the analytics, install'
+                              ' flowy[analytics].')
+        rows = list(rows)
+        self.types, type_codes = _codes(row[0] for row in rows)
+        self.task_lists, task_list_codes = _codes(row[1] for row in rows)
+        self.type = numpy.array(type_codes, dtype=numpy.int32)
+        self.task_list = numpy.array(task_list_codes, dtype=numpy.int32)
+        self.retry = numpy.array([row[2] for row in rows], dtype=numpy.int32)
+        self.scheduled, self.started, self.closed = [
+            numpy.array([row[i] for row in rows], dtype=numpy.float64)
+            for i in (3, 4, 5)]  # None becomes NaN
+        self.outcome = numpy.array([row[6] for row in rows], dtype=numpy.int8)
+
+    @classmethod
+    def from_histories(cls, histories):
+        rows = []
+        for events in histories:
+            rows.extend(activity_attempts(events))
+        return cls(rows)
+
+    def __len__(self):
+        return len(self.type)
+
+    def schedule_to_start(self):
+        return self.started - self.scheduled
+
+    def start_to_close(self):
+        return self.closed - self.started
+
+    def _groups(self, by):
+        if by == 'type':
+            return self.type, self.types
+        if by == 'task_list':
+            return self.task_list, self.task_lists
+        raise ValueError('Invalid grouping: %r' % by)
+
+    def percentiles(self, values, by='type', q=(50, 90, 99)):
+        """Return the percentiles of the values for each group.
+
+        The groups are by activity type or by task list. The NaN values are
+        ignored and the groups without values are missing from the result.
+        """
+        codes, names = self._groups(by)
+        valid = ~numpy.isnan(values)
+        codes, values = codes[valid], values[valid]
+        order = numpy.lexsort((values, codes))
+        codes, values = codes[order], values[order]
+        bounds = numpy.searchsorted(codes, numpy.arange(len(names) + 1))
+        result = {}
+        for code, name in enumerate(names):
+            group = values[bounds[code]:bounds[code + 1]]
+            if len(group):
+                result[name] = numpy.percentile(group, q).tolist()
+        return result
+
+    def rates(self, by='type'):
+        """Return the attempts count and the retry, failure and timeout
+        rates for each group."""
+        codes, names = self._groups(by)
+        size = len(names)
+        count = numpy.bincount(codes, minlength=size)
+        retries = numpy.bincount(codes, weights=self.retry > 0, minlength=size)
+        closed = numpy.bincount(codes, weights=self.outcome != RUNNING,
+                                minlength=size)
+        failed = numpy.bincount(codes, weights=self.outcome == FAILED,
+                                minlength=size)
+        timedout = numpy.bincount(codes, weights=self.outcome == TIMED_OUT,
+                                  minlength=size)
+        result = {}
+        for code, name in enumerate(names):
+            if not count[code]:
+                continue
+            n_closed = max(closed[code], 1)
+            result[name] = {
+                'count': int(count[code]),
+                'retry_rate': retries[code] / count[code],
+                'failure_rate': failed[code] / n_closed,
+                'timeout_rate': timedout[code] / n_closed,
+            }
+        return result
+
+    def throughput(self, bucket=60):
+        """Return the start times of the buckets and the number of activity
+        tasks closed in each bucket of this many seconds."""
+        closed = self.closed[~numpy.isnan(self.closed)]
+        if not len(closed):
+            return [], []
+        start = numpy.floor(closed.min() / bucket) * bucket
+        counts = numpy.bincount(((closed - start) // bucket).astype(int))
+        times = start + bucket * numpy.arange(len(counts))
+        return times.tolist(), counts.tolist()
+
+    def report(self, bucket=60, q=(50, 90, 99)):
+        """Summarize everything in a JSON serializable dict."""
+        times, counts = self.throughput(bucket)
+        return {
+            'attempts': len(self),
+            'schedule_to_start': self.percentiles(self.schedule_to_start(),
+                                                  'type', q),
+            'start_to_close': self.percentiles(self.start_to_close(),
+                                               'type', q),
+            'queueing_delay': self.percentiles(self.schedule_to_start(),
+                                               'task_list', q),
+            'rates': self.rates('type'),
+            'task_list_rates': self.rates('task_list'),
+            'throughput': {'bucket': bucket, 'times': times,
+                           'counts': counts},
+        }
+
+
+def _codes(values):
+    names, codes, index = [], [], {}
+    for value in values:
+        code = index.get(value)
+        if code is None:
+            code = index[value] = len(names)
+            names.append(value)
+        codes.append(code)
+    return names, codes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('paths', nargs='+',
+                        help='recorder logs or exported histories')
+    parser.add_argument('-b', '--bucket', type=float, default=60,
+                        help='the throughput bucket size, in seconds')
+    parser.add_argument('-q', '--percentiles', default='50,90,99',
+                        type=lambda s: [float(x) for x in s.split(',')])
+    args = parser.parse_args()
+    table = ActivityTable.from_histories(load_histories(args.paths))
+    json.dump(table.report(args.bucket, args.percentiles), sys.stdout,
+              indent=2, sort_keys=True)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,398 @@
+"""A local backend to run workflows in development mode.
+
+Everything runs in the current process: the decisions are taken in-process as
+soon as new results are available and the activities are executed on a thread
+or process pool. No serialization takes place, the values are passed around as
+they are (unless a process pool is used, in which case they must be picklable,
+so module level functions and not lambdas).
+
+    def double(x):
+        return x * 2
+
+    cfg = LocalWorkflowConfig()
+    cfg.conf_activity('double', double)
+
+    class MyWorkflow(object):
+        def __init__(self, double):
+            self.double = double
+        def run(self, n):
+            return sum(r.result() for r in map(self.double, range(n)))
+
+    executor = LocalExecutor(workers=4)
+    executor.run(cfg, MyWorkflow, 10)  # returns 90
+"""
+
+import heapq
+import itertools
+import logging
+import pickle
+import sys
+import time
+from multiprocessing.pool import Pool
+from multiprocessing.pool import ThreadPool
+
+try:
+    from queue import Empty
+    from queue import Queue
+except ImportError:  # pragma: no cover
+    from Queue import Empty
+    from Queue import Queue
+
+from flowy.base import ContextBoundProxy
+from flowy.base import DescCounter
+from flowy.base import TaskError
+from flowy.base import Workflow
+from flowy.base import WorkflowConfig
+
+
+__all__ = ['LocalWorkflowConfig', 'LocalExecutor']
+
+
+logger = logging.getLogger(__name__)
+# the pool reports its own failures only with error_callback, on Python 3
+_ERROR_CALLBACK = sys.version_info >= (3,)
+
+
+class LocalWorkflowConfig(WorkflowConfig):
+    """A configuration object for workflows running with the local backend.
+
+    Use conf_activity and conf_workflow to configure workflow implementation
+    dependencies.
+    """
+
+    category = 'local_workflow'
+
+    def conf_activity(self, dep_name, activity, retry=(0, 0, 0),
+                      timeout=None):
+        """Configure an activity dependency for a workflow implementation.
+
+        The activity is a callable that is called with the task arguments.
+        If a timeout (in seconds) is set and the activity doesn't finish in
+        time, the task times out and is retried according to retry: a tuple
+        with the delay of each attempt or a RetryPolicy instance.
+        """
+        proxy = LocalActivityProxy(identity=dep_name, activity=activity,
+                                   retry=retry, timeout=timeout)
+        self.conf(dep_name, proxy)
+
+    def conf_workflow(self, dep_name, config, workflow_factory,
+                      retry=(0, 0, 0)):
+        """Same as conf_activity but for sub-workflows.
+
+        The config and the workflow factory are the ones used to run the
+        sub-workflow.
+        """
+        proxy = LocalWorkflowProxy(identity=dep_name, config=config,
+                                   workflow_factory=workflow_factory,
+                                   retry=retry)
+        self.conf(dep_name, proxy)
+
+
+class LocalActivityProxy(object):
+    """An unbounded local activity proxy."""
+    def __init__(self, identity, activity, retry=(0, 0, 0), timeout=None):
+        self.identity = identity
+        self.activity = activity
+        self.retry = retry
+        self.timeout = timeout
+
+    def bind(self, context, rate_limit=DescCounter()):
+        return ContextBoundProxy(self, context, rate_limit)
+
+    def schedule(self, context, call_key, delay, *args, **kwargs):
+        if delay > 0 and not context.timer_ready(call_key):
+            context.schedule_timer(call_key, delay)
+        else:
+            context.schedule_activity(call_key, self.activity, args, kwargs,
+                                      self.timeout)
+
+
+class LocalWorkflowProxy(object):
+    """Same as LocalActivityProxy but for sub-workflows."""
+    def __init__(self, identity, config, workflow_factory, retry=(0, 0, 0)):
+        self.identity = identity
+        self.config = config
+        self.workflow_factory = workflow_factory
+        self.retry = retry
+
+    def bind(self, context, rate_limit=DescCounter()):
+        return ContextBoundProxy(self, context, rate_limit)
+
+    def schedule(self, context, call_key, delay, *args, **kwargs):
+        if delay > 0 and not context.timer_ready(call_key):
+            context.schedule_timer(call_key, delay)
+        else:
+            context.schedule_workflow(call_key, self.config,
+                                      self.workflow_factory, args, kwargs)
+
+
+class LocalContext(object):
+    """The execution context of a single decision.
+
+    It exposes the state of an execution and collects the decisions taken
+    while the workflow runs.
+    """
+    def __init__(self, execution):
+        self.input = execution.input
+        self.running = execution.running
+        self.timedout = execution.timedout
+        self.results = execution.results
+        self.errors = execution.errors
+        self.order = execution.order
+        self.fired = execution.fired
+        self.times = execution.times
+        self.timers = []
+        self.activities = []
+        self.workflows = []
+        self.outcome = None
+        self.closed = False
+
+    def is_running(self, call_key):
+        return call_key in self.running
+
+    def is_result(self, call_key):
+        return call_key in self.results
+
+    def result(self, call_key):
+        return self.results[call_key], self.order[call_key]
+
+    def is_error(self, call_key):
+        return call_key in self.errors
+
+    def error(self, call_key):
+        return self.errors[call_key], self.order[call_key]
+
+    def is_timeout(self, call_key):
+        return call_key in self.timedout
+
+    def timeout(self, call_key):
+        return self.order[call_key]
+
+    def timer_ready(self, call_key):
+        return call_key in self.fired
+
+    def over_budget(self):
+        return False  # the local decisions have no time limit
+
+    def elapsed(self, first_key, call_key):
+        try:
+            closed = self.times[call_key][1]
+            return closed - self.times[first_key][0]
+        except (KeyError, TypeError):
+            return None
+
+    def fail(self, reason):
+        self._close(('fail', str(reason)))
+
+    def flush(self):
+        self._close(None)
+
+    def restart(self, input_data):
+        self._close(('restart', input_data))
+
+    def finish(self, result):
+        self._close(('finish', result))
+
+    def _close(self, outcome):
+        if self.closed:
+            return
+        self.closed = True
+        self.outcome = outcome
+        if outcome is not None:
+            # like in SWF, closing the execution discards the other decisions
+            del self.timers[:], self.activities[:], self.workflows[:]
+
+    # Used by the local proxies
+
+    def schedule_timer(self, call_key, delay):
+        self.timers.append((call_key, delay))
+
+    def schedule_activity(self, call_key, activity, args, kwargs, timeout):
+        self.activities.append((call_key, activity, args, kwargs, timeout))
+
+    def schedule_workflow(self, call_key, config, workflow_factory, args,
+                          kwargs):
+        self.workflows.append((call_key, config, workflow_factory, args,
+                               kwargs))
+
+
+class _Execution(object):
+    """The state of a workflow execution; the equivalent of its history."""
+    def __init__(self, config, workflow_factory, input_data, parent=None,
+                 parent_key=None):
+        self.workflow = Workflow(config, workflow_factory)
+        self.parent = parent
+        self.parent_key = parent_key
+        self.input = input_data
+        self.running = set()
+        self.timedout = set()
+        self.results = {}
+        self.errors = {}
+        self.order = {}
+        self.fired = set()
+        self.times = {}  # call key -> [scheduled, closed]
+        self.counter = itertools.count()
+        self.closed = False
+        self.dirty = False
+
+    def restart(self, input_data):
+        """Close this execution and return a new one with the new input."""
+        self.closed = True
+        return _Execution(self.workflow.config, self.workflow.workflow_factory,
+                          input_data, self.parent, self.parent_key)
+
+    def close(self, call_key, results=None, value=None):
+        """Record the task result or timeout and return True if it's new."""
+        if self.closed or call_key not in self.running:
+            return False  # timed out already or restarted
+        self.running.remove(call_key)
+        self.times[call_key][1] = time.time()
+        if results is None:
+            self.timedout.add(call_key)
+        else:
+            results[call_key] = value
+        self.order[call_key] = next(self.counter)
+        return True
+
+
+def _run_activity(activity, args, kwargs, picklable=False):
+    # the exceptions may not be picklable so only the message is kept
+    try:
+        result = activity(*args, **kwargs)
+        if picklable:
+            # the result is sent back to the parent process
+            pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        return True, result
+    except Exception as e:
+        logger.exception('Error while running the activity:')
+        return False, str(e)
+
+
+class LocalExecutor(object):
+    """Run workflows locally, executing activities on a pool.
+
+    A thread pool is used by default. If processes is set, a process pool is
+    used instead and the activities, their arguments and results must be
+    picklable. The workers value is the size of the pool, by default the
+    number of CPUs. An activity that can't be sent to the pool, or whose
+    result can't be sent back, fails with the error message.
+    """
+    def __init__(self, workers=None, processes=False):
+        pool_factory = Pool if processes else ThreadPool
+        self.pool = pool_factory(workers)
+        self.processes = processes
+        self.decisions = 0
+
+    def close(self):
+        """Stop the pool once all the activities are finished."""
+        self.pool.close()
+        self.pool.join()
+
+    def _apply(self, activity, args, kwargs, callback, error):
+        # every activity must complete, even if the pool can't run it
+        pool_kwargs = {'callback': callback}
+        if _ERROR_CALLBACK:
+            pool_kwargs['error_callback'] = error
+        try:
+            if self.processes:
+                # the pool drops the tasks that can't be pickled
+                pickle.dumps((activity, args, kwargs),
+                             pickle.HIGHEST_PROTOCOL)
+            self.pool.apply_async(_run_activity,
+                                  (activity, args, kwargs, self.processes),
+                                  **pool_kwargs)
+        except Exception as e:
+            logger.exception('Cannot run the activity:')
+            error(e)
+
+    def run(self, config, workflow_factory, *args, **kwargs):
+        """Run a workflow until it finishes and return its result.
+
+        If the workflow fails TaskError is raised with the failure reason.
+        """
+        completions = Queue()
+        deadlines = []  # a heap of timers and timeouts
+        seq = itertools.count()  # heap tie breaker
+        dirty = []
+        in_flight = 0
+
+        def mark(execution):
+            # the execution has new events and needs a new decision
+            if not execution.dirty:
+                execution.dirty = True
+                dirty.append(execution)
+
+        mark(_Execution(config, workflow_factory, (args, kwargs)))
+        while 1:
+            while dirty:
+                execution = dirty.pop()
+                execution.dirty = False
+                if execution.closed:
+                    continue
+                context = LocalContext(execution)
+                execution.workflow.run(context)
+                self.decisions += 1
+                outcome = context.outcome
+                if outcome is not None:
+                    kind, value = outcome
+                    if kind == 'restart':
+                        mark(execution.restart(value))
+                        continue
+                    execution.closed = True
+                    parent = execution.parent
+                    if parent is None:
+                        if kind == 'fail':
+                            raise TaskError(value)
+                        return value
+                    results = parent.results if kind == 'finish' else parent.errors
+                    if parent.close(execution.parent_key, results, value):
+                        mark(parent)
+                    continue
+                now = time.time()
+                for call_key, delay in context.timers:
+                    execution.running.add(call_key)
+                    heapq.heappush(deadlines, (now + delay, next(seq),
+                                               execution, call_key, True))
+                for call_key, activity, a, kw, timeout in context.activities:
+                    execution.running.add(call_key)
+                    execution.times[call_key] = [now, None]
+                    in_flight += 1
+                    callback = (lambda r, e=execution, k=call_key:
+                                completions.put((e, k, r)))
+                    error = (lambda err, e=execution, k=call_key:
+                             completions.put((e, k, (False, str(err)))))
+                    self._apply(activity, a, kw, callback, error)
+                    if timeout is not None:
+                        heapq.heappush(deadlines, (now + timeout, next(seq),
+                                                   execution, call_key, False))
+                for call_key, w_conf, w_factory, a, kw in context.workflows:
+                    execution.running.add(call_key)
+                    execution.times[call_key] = [now, None]
+                    mark(_Execution(w_conf, w_factory, (a, kw), execution,
+                                    call_key))
+            if not in_flight and not deadlines:
+                raise RuntimeError('The workflow is suspended but nothing is'
+                                   ' running.')
+            wait = None
+            if deadlines:
+                wait = max(deadlines[0][0] - time.time(), 0)
+            try:
+                item = completions.get(timeout=wait)
+                while 1:  # get everything that's available in one decision
+                    execution, call_key, (ok, value) = item
+                    in_flight -= 1
+                    results = execution.results if ok else execution.errors
+                    if execution.close(call_key, results, value):
+                        mark(execution)
+                    item = completions.get_nowait()
+            except Empty:
+                pass
+            now = time.time()
+            while deadlines and deadlines[0][0] <= now:
+                _, _, execution, call_key, is_timer = heapq.heappop(deadlines)
+                if is_timer:
+                    execution.running.discard(call_key)
+                    execution.fired.add(call_key)
+                    mark(execution)
+                elif execution.close(call_key):
+                    mark(execution)
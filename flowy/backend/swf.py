@@ -1,11 +1,32 @@
 from __future__ import print_function
 
+import itertools
 import json
 import logging
+import math
+import mmap
 import os
 import socket
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
 import uuid
+import zlib
+from collections import deque
+from multiprocessing import cpu_count
+from multiprocessing.pool import Pool
+from multiprocessing.pool import ThreadPool
+
+try:
+    from queue import Empty
+    from queue import Queue
+except ImportError:  # pragma: no cover
+    from Queue import Empty
+    from Queue import Queue
+
+import venusian
 
 from boto.exception import SWFResponseError
 from boto.swf.exceptions import SWFTypeAlreadyExistsError
@@ -14,22 +35,41 @@ from boto.swf.layer1_decisions import Layer1Decisions
 
 from flowy.base import ContextBoundProxy
 from flowy.base import DescCounter
+from flowy.base import SuspendTask
+from flowy.base import TaskResult
 from flowy.base import setup_default_logger
 from flowy.base import Workflow
 from flowy.base import WorkflowConfig
 from flowy.base import WorkflowRegistry
+from flowy.base import write_json
+from flowy.supervisor import Supervisor
 
 
-__all__ = ['SWFWorkflowConfig', 'SWFWorkflowRegistry',
-           'start_swf_workflow_worker']
+__all__ = ['SWFWorkflowConfig', 'SWFWorkflowRegistry', 'AIMDRateLimit',
+           'PendingActivityCounts', 'HashRouting', 'RoundRobinRouting',
+           'LeastLoadedRouting',
+           'start_swf_workflow_worker', 'start_swf_workflow_supervisor',
+           'SWFWorkflowWorker', 'start_swf_multi_workflow_worker',
+           'SWFActivityConfig', 'SWFActivityRegistry', 'SWFActivityWorker',
+           'SWFBatchActivity',
+           'start_swf_activity_worker', 'pending', 'task_token',
+           'SWFCompletionService']
 
 
 logger = logging.getLogger(__name__)
 
 
 _CHILD_POLICY = ['TERMINATE', 'REQUEST_CANCEL', 'ABANDON', None]
-_INPUT_SIZE = _RESULT_SIZE = 32768
+_INPUT_SIZE = _RESULT_SIZE = _CONTROL_SIZE = _DETAILS_SIZE = 32768
+_SPILL_SIZE = 4096  # larger results are spilled to disk, see _ResultSpill
+# the schedule failures caused by too many activities
+_THROTTLED = frozenset(['ACTIVITY_CREATION_RATE_EXCEEDED',
+                        'OPEN_ACTIVITIES_LIMIT_EXCEEDED'])
 _IDENTITY_SIZE = _REASON_SIZE = 256
+# the outcome of a batched call that doesn't fit in the batch result
+_TOO_LARGE = ['error', 'The result does not fit in the batch result.']
+# so the batch result fits even if every call is _TOO_LARGE
+_BATCH_SIZE = (_RESULT_SIZE - 2) // (len(json.dumps(_TOO_LARGE)) + 2)
 
 
 _serialize_input = lambda *args, **kwargs: json.dumps((args, kwargs))
@@ -53,7 +93,9 @@ class SWFWorkflowConfig(WorkflowConfig):
                  default_child_policy=None, rate_limit=64,
                  deserialize_input=_deserialize_input,
                  serialize_result=_serialize_result,
-                 serialize_restart_input=_serialize_input):
+                 serialize_restart_input=_serialize_input,
+                 max_events=None, max_pages=None, max_replay_time=None,
+                 retry_bucket=None, rate_control=None):
         """Initialize the config object.
 
         The timer values are in seconds, and the child policy should be either
@@ -65,6 +107,22 @@ class SWFWorkflowConfig(WorkflowConfig):
         The rate_limit is used to limit the number of concurrent tasks. A value
         of None means no rate limit.
 
+        The max_events, max_pages and max_replay_time (in seconds) values bound
+        the size of the execution history. Once any of them is exceeded and
+        there are no running tasks, the workflow checkpoint method is called
+        and the execution continues as a new one. A value of None means no
+        limit.
+
+        If a retry_bucket (in seconds) is set, the retry delays of all the
+        dependencies are rounded up to the end of a bucket of this size and
+        the calls retried in the same decision and bucket share one timer,
+        instead of using a timer each.
+
+        A rate_control (see AIMDRateLimit) adapts the number of running
+        activities of this workflow on each task list to how backed up the
+        task list is. It only applies to the activities configured with a
+        task list, in addition to the rate_limit.
+
         The name is not required at this point but should be set before trying
         to register this config remotely and can be set later with
         set_alternate_name.
@@ -75,6 +133,11 @@ class SWFWorkflowConfig(WorkflowConfig):
         self.d_w_d = default_workflow_duration
         self.d_d_d = default_decision_duration
         self.d_c_p = default_child_policy
+        self.max_events = max_events
+        self.max_pages = max_pages
+        self.max_replay_time = max_replay_time
+        self.retry_bucket = retry_bucket
+        self.rate_control = rate_control
         self.proxy_factory_registry = {}
         super(SWFWorkflowConfig, self).__init__(rate_limit, deserialize_input,
                                                 serialize_result,
@@ -100,12 +163,35 @@ class SWFWorkflowConfig(WorkflowConfig):
                              default_workflow_duration=self.d_w_d,
                              default_decision_duration=self.d_d_d,
                              default_child_policy=self.d_c_p,
+                             rate_limit=self.rate_limit,
                              deserialize_input=self.deserialize_input,
-                             serialize_result=self.serialize_result)
+                             serialize_result=self.serialize_result,
+                             serialize_restart_input=self.serialize_restart_input,
+                             max_events=self.max_events,
+                             max_pages=self.max_pages,
+                             max_replay_time=self.max_replay_time,
+                             retry_bucket=self.retry_bucket,
+                             rate_control=self.rate_control)
         for dep_name, proxy_factory in self.proxy_factory_registry.iteritems():
             new_instance.conf(dep_name, proxy_factory)
         return new_instance
 
+    def needs_checkpoint(self, context):
+        """Test if the history limits are exceeded and it's safe to restart.
+
+        It's only safe to restart when there are no running tasks (or timers)
+        since their results would be lost.
+        """
+        if context.running:
+            return False
+        if self.max_events is not None and context.events >= self.max_events:
+            return True
+        if self.max_pages is not None and context.pages >= self.max_pages:
+            return True
+        if self.max_replay_time is not None:
+            return context.replay_time() >= self.max_replay_time
+        return False
+
     def register_remote(self, swf_layer1, domain):
         """Register the workflow config in Amazon SWF if it's missing.
 
@@ -206,7 +292,8 @@ class SWFWorkflowConfig(WorkflowConfig):
                       schedule_to_start=None, start_to_close=None,
                       serialize_input=_serialize_input,
                       deserialize_result=_deserialize_input,
-                      retry=(0, 0, 0)):
+                      retry=(0, 0, 0), hedge_after=None, hedge_task_list=None,
+                      routing=None, batch=None, batch_window=None):
         """Configure an activity dependency for a workflow implementation.
 
         dep_name is the name of one of the workflow factory arguments
@@ -225,6 +312,30 @@ class SWFWorkflowConfig(WorkflowConfig):
 
         For convenience, if the activity name is missing, it will be the same
         as the dependency name.
+
+        The task_list can also be a list of task lists, served by different
+        workers, and each attempt is scheduled on one of them picked by the
+        routing: HashRouting (the default), RoundRobinRouting or
+        LeastLoadedRouting. The task list picked is recorded in the history
+        so the routing doesn't need to pick the same one again on replay.
+
+        The retry is a tuple with the delay of each attempt, the timed out
+        tasks being retried, or a RetryPolicy instance.
+
+        If hedge_after is set and an attempt is still running after that many
+        seconds, a duplicate of it is scheduled, on the hedge_task_list if set
+        or else on the same task list. The first of the two to complete is
+        the attempt result and the other one is canceled. A failure or a
+        timeout only counts once both of them closed.
+
+        If batch is set, the calls scheduled by a decision are sent in
+        batches of up to that many calls, each one a single activity task of
+        the activity batch type (see the SWFActivityConfig batch). If a
+        batch_window is set too, each call first waits for the end of the
+        current batch_window seconds interval so the calls made in the same
+        interval are batched together. The calls still have their own
+        results, errors and retries, except that a batch failing or timing
+        out fails or times out all its calls. The batches are not hedged.
         """
         if name is None:
             name = dep_name
@@ -235,7 +346,12 @@ class SWFWorkflowConfig(WorkflowConfig):
                                  start_to_close=start_to_close,
                                  serialize_input=serialize_input,
                                  deserialize_result=deserialize_result,
-                                 retry=retry)
+                                 retry=retry, retry_bucket=self.retry_bucket,
+                                 rate_control=self.rate_control,
+                                 hedge_after=hedge_after,
+                                 hedge_task_list=hedge_task_list,
+                                 routing=routing, batch=batch,
+                                 batch_window=batch_window)
         self.conf(dep_name, proxy)
 
     def conf_workflow(self, dep_name, version, name=None, task_list=None,
@@ -252,10 +368,118 @@ class SWFWorkflowConfig(WorkflowConfig):
                                  decision_duration=decision_duration,
                                  serialize_input=serialize_input,
                                  deserialize_result=deserialize_result,
-                                 retry=retry)
+                                 retry=retry, retry_bucket=self.retry_bucket)
+        self.conf(dep_name, proxy)
+
+    def conf_local_activity(self, dep_name, activity, timeout=5,
+                            serialize_result=_serialize_result,
+                            deserialize_result=_deserialize_result,
+                            retry=(0, 0, 0)):
+        """Configure an activity that runs inline, in the decider.
+
+        The activity is a callable that is called with the arguments in the
+        decision that makes the call and its result, error or timeout is
+        recorded in a marker. The later decisions load the outcome from the
+        marker instead of running the activity again. This is meant for small
+        and fast functions that don't need a round trip through an activity
+        worker; their serialized results must fit in a marker (32 KB).
+
+        The timeout (in seconds, None to wait indefinitely) bounds how long
+        the decision waits for the activity. An activity that takes longer is
+        timed out and left running in the background. The activity is only
+        run if more time than its timeout is left before the decision budget
+        or, without one, the decision timeout. Otherwise, and after another
+        local activity timed out in the same decision, it's run in a new
+        decision started by a timer; if it doesn't fit there either it's
+        timed out without running.
+
+        The retry has the same meaning as for conf_activity; the retry delays
+        use timers and the retries without delay run in the same decision,
+        unless the attempt before timed out.
+        """
+        proxy = SWFLocalActivityProxy(identity=dep_name, activity=activity,
+                                      timeout=timeout,
+                                      serialize_result=serialize_result,
+                                      deserialize_result=deserialize_result,
+                                      retry=retry,
+                                      retry_bucket=self.retry_bucket)
+        self.conf(dep_name, proxy)
+
+    def conf_map(self, dep_name, version, name=None, task_list=None,
+                 heartbeat=None, schedule_to_close=None,
+                 schedule_to_start=None, start_to_close=None,
+                 serialize_input=_serialize_input,
+                 deserialize_result=_deserialize_input, retry=(0, 0, 0),
+                 shard_size=500, shard_version=1, shard_task_list=None,
+                 shard_workflow_duration=None, shard_decision_duration=None):
+        """Configure a dependency that maps an activity over a list of items.
+
+        The dependency is called with a list of items and returns a single
+        result, the list of the activity results for each item:
+
+            cfg.conf_map('double', version=1, shard_size=1000)
+
+            class MyWorkflow:
+                def __init__(self, double):
+                    self.double = double
+                def run(self, n):
+                    return sum(self.double(range(n)).result())
+
+        Up to shard_size items are scheduled as activities by the workflow
+        itself. Larger lists are split in at most shard_size shards, each one
+        mapped by a child workflow that splits its shard further if needed.
+        This way no execution history grows past shard_size tasks. The items
+        and the results are passed in the child workflows input and result
+        so they should be small, like the keys of the real data.
+
+        The child workflow type is registered by SWFWorkflowRegistry together
+        with this workflow. Its name is derived from the activity name and
+        version and its version is shard_version, which must be changed when
+        any of the values used here is changed. The shard defaults, if not
+        set, are the same as this config's defaults.
+
+        The activity arguments are the same as for conf_activity.
+        """
+        if name is None:
+            name = dep_name
+        d_c_p = self.d_c_p if self.d_c_p is not None else 'TERMINATE'
+        shard_config = SWFWorkflowConfig(
+            shard_version, name='%s-%s-map' % (name, version),
+            default_task_list=_first_set(shard_task_list, self.d_t_l),
+            default_workflow_duration=_first_set(shard_workflow_duration,
+                                                 self.d_w_d),
+            default_decision_duration=_first_set(shard_decision_duration,
+                                                 self.d_d_d),
+            default_child_policy=d_c_p, rate_limit=self.rate_limit,
+            retry_bucket=self.retry_bucket, rate_control=self.rate_control)
+        activity = SWFActivityProxy(identity=dep_name, name=name,
+                                    version=version, task_list=task_list,
+                                    heartbeat=heartbeat,
+                                    schedule_to_close=schedule_to_close,
+                                    schedule_to_start=schedule_to_start,
+                                    start_to_close=start_to_close,
+                                    serialize_input=serialize_input,
+                                    deserialize_result=deserialize_result,
+                                    retry=retry, retry_bucket=self.retry_bucket,
+                                    rate_control=self.rate_control)
+        shard = SWFWorkflowProxy(identity='%s_shard' % dep_name,
+                                 name=shard_config.name, version=shard_version,
+                                 retry_bucket=self.retry_bucket)
+        proxy = SWFMapProxy(activity, shard, shard_size,
+                            (shard_config, _MapShard))
+        shard_config.conf('mapper', proxy)
         self.conf(dep_name, proxy)
 
 
+class _MapShard(object):
+    """The child workflow mapping a shard of the items."""
+    def __init__(self, mapper):
+        self.mapper = mapper
+
+    def run(self, items):
+        return self.mapper(items).result()
+
+
 class SWFWorkflow(Workflow):
     """Bind a SWFWorkflowConfig instance and a workflow factory together.
 
@@ -280,10 +504,83 @@ class SWFWorkflowRegistry(WorkflowRegistry):
     categories = ['swf_workflow']
     WorkflowFactory = SWFWorkflow
 
-    def register_remote(self, layer1, domain):
-        """Register or check compatibility of all configs in Amazon SWF."""
-        for workflow in self.registry.values():
-            workflow.register_remote(layer1, domain)
+    def register(self, config, workflow_factory):
+        """Register a config and a workflow factory.
+
+        The child workflows used by the maps configured (see
+        SWFWorkflowConfig.conf_map) are registered too.
+        """
+        super(SWFWorkflowRegistry, self).register(config, workflow_factory)
+        for proxy in config.proxy_factory_registry.values():
+            shard_workflow = getattr(proxy, 'shard_workflow', None)
+            if shard_workflow is None:
+                continue
+            s_config, s_factory = shard_workflow
+            if (str(s_config.name), str(s_config.version)) not in self.registry:
+                self.register(s_config, s_factory)
+
+    def register_remote(self, layer1, domain, cache=None, workers=8,
+                        layer1_factory=None):
+        """Register or check compatibility of all configs in Amazon SWF.
+
+        The registered workflow types are listed first so that only the
+        missing ones are registered and the others are only checked for
+        compatibility. If a layer1_factory is set, the remote calls are made
+        concurrently using a pool of workers threads, each one with its own
+        SWF client created by calling layer1_factory. Otherwise they are made
+        one at a time with layer1, since the clients can't be shared.
+
+        If a cache file path is set, the verified configs are saved in it and
+        skipped on later calls, as long as their values don't change.
+
+        Raise _RegistrationError if any of the configs can't be registered or
+        is incompatible.
+        """
+        domain = str(domain)
+        fingerprints = dict((key, workflow.config._cvt_values())
+                            for key, workflow in self.registry.items())
+        verified = _load_registration_cache(cache, domain)
+        pending = [workflow for key, workflow in sorted(self.registry.items())
+                   if fingerprints[key] not in verified]
+        if not pending:
+            logger.info('All %s workflows are already registered.',
+                        len(fingerprints))
+            return
+        registered = _registered_workflow_types(layer1, domain)
+        if layer1_factory is None:
+            workers, layer1_factory = 1, lambda: layer1
+        clients = threading.local()
+
+        def register(workflow):
+            layer1 = getattr(clients, 'layer1', None)
+            if layer1 is None:
+                layer1 = clients.layer1 = layer1_factory()
+            try:
+                if workflow.key() in registered:
+                    workflow.config.check_compatible(layer1, domain)
+                else:
+                    workflow.register_remote(layer1, domain)
+            except _RegistrationError as e:
+                return e
+        pool = ThreadPool(min(workers, len(pending)))
+        try:
+            errors = pool.map(register, pending)
+        finally:
+            pool.close()
+            pool.join()
+        for workflow, error in zip(pending, errors):
+            if error is None:
+                verified.add(fingerprints[workflow.key()])
+        if cache is not None:
+            try:
+                _save_registration_cache(cache, domain, verified)
+            except (IOError, OSError):
+                logger.exception('Cannot save the registration cache:')
+        errors = [error for error in errors if error is not None]
+        if errors:
+            for error in errors:
+                logger.error(str(error))
+            raise errors[0]
 
     def __call__(self, context):
         """Run the workflow corresponding to this context.
@@ -296,6 +593,236 @@ class SWFWorkflowRegistry(WorkflowRegistry):
         super(SWFWorkflowRegistry, self).__call__(key, context)
 
 
+class SWFActivityConfig(object):
+    """A configuration object for Amazon SWF Activities.
+
+    Use it as a decorator on the activity functions to make them discoverable
+    by SWFActivityRegistry.scan:
+
+        @SWFActivityConfig(version=1, default_task_list='my_tl')
+        def double(x):
+            return x * 2
+    """
+
+    category = 'swf_activity'  # venusian category used for this type of confs
+
+    def __init__(self, version, name=None, default_task_list=None,
+                 default_heartbeat=None, default_schedule_to_close=None,
+                 default_schedule_to_start=None, default_start_to_close=None,
+                 deserialize_input=_deserialize_input,
+                 serialize_result=_serialize_result, batch=False):
+        """Initialize the config object.
+
+        The timer values are in seconds. For the default configs, a value of
+        None means that the config is unset and must be set explicitly in
+        proxies. The activity worker sends heartbeats automatically, twice
+        per default_heartbeat interval.
+
+        If batch is set, a second activity type is registered, named like
+        the activity with a '-batch' suffix, that runs the calls batched by
+        the workflows (see SWFWorkflowConfig.conf_activity).
+
+        The name is not required at this point but should be set before trying
+        to register this config remotely and can be set later with
+        set_alternate_name.
+        """
+        self.name = name
+        self.version = version
+        self.d_t_l = default_task_list
+        self.d_h = default_heartbeat
+        self.d_sch_c = default_schedule_to_close
+        self.d_sch_s = default_schedule_to_start
+        self.d_s_c = default_start_to_close
+        self.deserialize_input = deserialize_input
+        self.serialize_result = serialize_result
+        self.batch = batch
+
+    def __call__(self, activity):
+        """Associate an activity with this configuration.
+
+        The activity is preserved and made discoverable by the scanners.
+        """
+        def callback(venusian_scanner, *_):
+            """This gets called by venusian at scan time."""
+            venusian_scanner.register(self, activity)
+        venusian.attach(activity, callback, category=self.category)
+        return activity
+
+    def set_alternate_name(self, name):
+        """Same as SWFWorkflowConfig.set_alternate_name."""
+        if self.name is not None:
+            return self
+        return self._renamed(name)
+
+    def _renamed(self, name):
+        return self.__class__(self.version, name=name,
+                              default_task_list=self.d_t_l,
+                              default_heartbeat=self.d_h,
+                              default_schedule_to_close=self.d_sch_c,
+                              default_schedule_to_start=self.d_sch_s,
+                              default_start_to_close=self.d_s_c,
+                              deserialize_input=self.deserialize_input,
+                              serialize_result=self.serialize_result,
+                              batch=self.batch)
+
+    def _cvt_values(self):
+        """Convert values to their expected types or bailout."""
+        name = self.name
+        if name is None:
+            raise RuntimeError('Name is not set.')
+        d_t_l = _str_or_none(self.d_t_l)
+        d_h = _timer_encode(self.d_h, 'default_heartbeat')
+        d_sch_c = _timer_encode(self.d_sch_c, 'default_schedule_to_close')
+        d_sch_s = _timer_encode(self.d_sch_s, 'default_schedule_to_start')
+        d_s_c = _timer_encode(self.d_s_c, 'default_start_to_close')
+        return str(name), str(self.version), d_t_l, d_h, d_sch_c, d_sch_s, d_s_c
+
+    def register_remote(self, swf_layer1, domain):
+        """Same as SWFWorkflowConfig.register_remote but for activities."""
+        name, version, d_t_l, d_h, d_sch_c, d_sch_s, d_s_c = self._cvt_values()
+        try:
+            swf_layer1.register_activity_type(
+                str(domain), name=name, version=version, task_list=d_t_l,
+                default_task_heartbeat_timeout=d_h,
+                default_task_schedule_to_close_timeout=d_sch_c,
+                default_task_schedule_to_start_timeout=d_sch_s,
+                default_task_start_to_close_timeout=d_s_c)
+            return
+        except SWFTypeAlreadyExistsError:
+            pass
+        except SWFResponseError as e:
+            logger.exception('Error while registering the activity:')
+            raise _RegistrationError(e)
+        try:
+            a_descr = swf_layer1.describe_activity_type(str(domain), name,
+                                                        version)
+            a_descr = a_descr['configuration']
+        except SWFResponseError as e:
+            logger.exception('Error while checking activity compatibility:')
+            raise _RegistrationError(e)
+        remote = (a_descr.get('defaultTaskList', {}).get('name'),
+                  a_descr.get('defaultTaskHeartbeatTimeout'),
+                  a_descr.get('defaultTaskScheduleToCloseTimeout'),
+                  a_descr.get('defaultTaskScheduleToStartTimeout'),
+                  a_descr.get('defaultTaskStartToCloseTimeout'))
+        local = d_t_l, d_h, d_sch_c, d_sch_s, d_s_c
+        if remote != local:
+            raise _RegistrationError(
+                'Defaults for activity %r version %r do not match: %r != %r'
+                % (name, version, remote, local))
+
+
+class SWFActivity(object):
+    """Bind a SWFActivityConfig instance and an activity together.
+
+    This will set the config alternate name to the activity __name__.
+    """
+    def __init__(self, config, activity):
+        self.config = config.set_alternate_name(activity.__name__)
+        self.activity = activity
+        self.register_remote = self.config.register_remote  # delegate
+        heartbeat = self.config._cvt_values()[3]
+        self.heartbeat = int(heartbeat) if heartbeat is not None else None
+
+    def key(self):
+        """Use the name and the version to identify this activity."""
+        return str(self.config.name), str(self.config.version)
+
+    def run(self, input_data):
+        """Run the activity and return its serialized result.
+
+        Return None if the activity returns the pending marker. Any errors are
+        propagated.
+        """
+        args, kwargs = self.config.deserialize_input(input_data)
+        result = self.activity(*args, **kwargs)
+        if result is pending:
+            return None
+        return str(self.config.serialize_result(result))
+
+    def __repr__(self):
+        return '<%s %s %s>' % ((self.__class__.__name__,) + self.key())
+
+
+class SWFBatchActivity(SWFActivity):
+    """Run the batches of calls of an activity.
+
+    The input is the list of the serialized inputs of the calls and the
+    result is the list of their outcomes, ['result', serialized result] or
+    ['error', message], so a failed call doesn't fail the others. If the
+    outcomes don't fit in the result size limit, the largest ones are
+    replaced by errors until they do.
+    """
+    def __init__(self, config, activity):
+        config = config.set_alternate_name(activity.__name__)
+        super(SWFBatchActivity, self).__init__(
+            config._renamed(_batch_name(config.name)), activity)
+
+    def run(self, input_data):
+        outcomes = []
+        for item in json.loads(input_data):
+            try:
+                args, kwargs = self.config.deserialize_input(item)
+                result = self.activity(*args, **kwargs)
+                if result is pending:
+                    raise ValueError('A batched call can not be pending.')
+                result = str(self.config.serialize_result(result))
+            except Exception as e:
+                logger.exception('Error while running the batched call:')
+                outcomes.append(['error', str(e)[:_REASON_SIZE]])
+            else:
+                outcomes.append(['result', result])
+        return _fit_outcomes(outcomes)
+
+
+def _fit_outcomes(outcomes):
+    # the quotes and escapes, the comma and the space
+    lengths = [len(json.dumps(outcome)) + 2 for outcome in outcomes]
+    too_large = len(json.dumps(_TOO_LARGE)) + 2
+    total = sum(lengths) + 2
+    for i in sorted(range(len(outcomes)), key=lambda i: -lengths[i]):
+        if total <= _RESULT_SIZE:
+            break
+        outcomes[i] = _TOO_LARGE
+        total -= lengths[i] - too_large
+    return json.dumps(outcomes)
+
+
+class SWFActivityRegistry(WorkflowRegistry):
+    """A registry for the activities and their configs.
+
+    The registered activities are identified by their name and version.
+    """
+
+    categories = ['swf_activity']
+    WorkflowFactory = SWFActivity
+
+    def register(self, config, activity):
+        """Register the activity and, if its config is batched, the
+        activity running its batches."""
+        super(SWFActivityRegistry, self).register(config, activity)
+        if config.batch:
+            batch = SWFBatchActivity(config, activity)
+            key = batch.key()
+            if key in self.registry:
+                raise ValueError('Implementation is already registered: %r'
+                                 % (key,))
+            self.registry[key] = batch
+
+    def register_remote(self, layer1, domain):
+        """Register or check compatibility of all configs in Amazon SWF."""
+        for activity in self.registry.values():
+            activity.register_remote(layer1, domain)
+
+    def __call__(self, key, input_data):
+        """Run the activity registered with this key."""
+        try:
+            activity = self.registry[key]
+        except KeyError:
+            raise ValueError('No activity implementation found: %r' % (key,))
+        return activity.run(input_data)
+
+
 class SWFActivityProxy(object):
     """An unbounded Amazon SWF activity proxy.
 
@@ -309,16 +836,29 @@ class SWFActivityProxy(object):
                  schedule_to_close=None, schedule_to_start=None,
                  start_to_close=None, retry=(0, 0, 0),
                  serialize_input=_serialize_input,
-                 deserialize_result=_deserialize_result):
+                 deserialize_result=_deserialize_result, retry_bucket=None,
+                 rate_control=None, hedge_after=None, hedge_task_list=None,
+                 routing=None, batch=None, batch_window=None):
+        if batch is not None and batch < 2:
+            raise ValueError('The batch size must be at least 2: %r' % batch)
         self.identity = identity
         self.name = name
         self.version = version
         self.task_list = task_list
+        if routing is None and isinstance(task_list, (list, tuple)):
+            routing = HashRouting()
+        self.routing = routing
+        self.rate_control = rate_control
         self.heartbeat = heartbeat
         self.schedule_to_close = schedule_to_close
         self.schedule_to_start = schedule_to_start
         self.start_to_close = start_to_close
         self.retry = retry
+        self.retry_bucket = retry_bucket
+        self.hedge_after = hedge_after
+        self.hedge_task_list = hedge_task_list
+        self.batch = batch
+        self.batch_window = batch_window
         self.serialize_input = serialize_input
         self.deserialize_result = deserialize_result
 
@@ -330,9 +870,17 @@ class SWFActivityProxy(object):
         """Schedule the activity in the execution context.
 
         If any delay is set use SWF timers before really scheduling anything.
+        If there are many task lists, the routing picks one. If the task list
+        is full (see AIMDRateLimit) nothing is scheduled and the task is tried
+        again in a later decision.
         """
         if int(delay) > 0 and not context.timer_ready(call_key):
-            context.schedule_timer(call_key, delay)
+            context.schedule_timer(call_key, delay, self.retry_bucket)
+            return
+        if self.batch_window and not context.timer_ready(call_key):
+            # the calls of the same window share the timer, see schedule_timer
+            context.schedule_timer(call_key, self.batch_window,
+                                   self.batch_window)
             return
         try:
             # Serialization errors are also handled outside but the logging
@@ -342,18 +890,164 @@ class SWFActivityProxy(object):
             logger.exception('Error while serializing activity input:')
             context.fail(e)
         else:
+            if self.batch:
+                context.add_to_batch(self, call_key, input_data)
+                return
+            task_list = self.task_list
+            if self.routing is not None:
+                task_list = self.routing.route(context, call_key, input_data,
+                                               task_list)
+            if (self.rate_control is not None and task_list is not None
+                    and not context.may_schedule(task_list,
+                                                 self.rate_control)):
+                return
+            if self.hedge_after:
+                # the timer must come first in the history, see _Hedges
+                context.schedule_hedge(call_key, self.hedge_after,
+                                       self.hedge_task_list)
             context.schedule_activity(
-                call_key, self.name, self.version, input_data, self.task_list,
+                call_key, self.name, self.version, input_data, task_list,
                 self.heartbeat, self.schedule_to_close, self.schedule_to_start,
                 self.start_to_close)
 
+    def schedule_batch(self, context, call_keys, inputs):
+        """Schedule a batch of calls as a single activity task.
+
+        The call keys are saved in a marker recorded right before the task is
+        scheduled, see load_events. The control field can't be used since it
+        isn't in the event of a task that failed to be scheduled.
+        """
+        call_key = _batch_key(call_keys[0])
+        input_data = json.dumps(inputs)
+        task_list = self.task_list
+        if self.routing is not None:
+            task_list = self.routing.route(context, call_key, input_data,
+                                           task_list)
+        if (self.rate_control is not None and task_list is not None
+                and not context.may_schedule(task_list, self.rate_control)):
+            return
+        context.record_batch(call_key, call_keys)
+        context.schedule_activity(
+            call_key, _batch_name(self.name), self.version, input_data,
+            task_list, self.heartbeat, self.schedule_to_close,
+            self.schedule_to_start, self.start_to_close)
+
+
+class HashRouting(object):
+    """Route the activities with the same input to the same task list."""
+    def route(self, context, call_key, input_data, task_lists):
+        if not isinstance(input_data, bytes):
+            input_data = input_data.encode('utf-8')
+        checksum = zlib.crc32(input_data) & 0xffffffff
+        return task_lists[checksum % len(task_lists)]
+
+
+class RoundRobinRouting(object):
+    """Route the calls of a dependency to the task lists in turn.
+
+    The turn is the call number in the call key, which the retries advance
+    too, so a retry moves to the next task list.
+    """
+    def route(self, context, call_key, input_data, task_lists):
+        _, call_number, _ = str(call_key).rsplit('-', 2)
+        return task_lists[int(call_number) % len(task_lists)]
+
+
+class LeastLoadedRouting(object):
+    """Route the activities to the task list with the fewest tasks.
+
+    The load of a task list is its count of pending tasks, from the pending
+    callable (like a PendingActivityCounts instance), plus the activities of
+    the workflow running on it. The first of the least loaded task lists is
+    picked.
+    """
+    def __init__(self, pending):
+        self.pending = pending
+
+    def route(self, context, call_key, input_data, task_lists):
+        loads = []
+        for task_list in task_lists:
+            pending = self.pending(task_list) or 0
+            loads.append(pending + context.load.running.get(task_list, 0))
+        return task_lists[loads.index(min(loads))]
+
+
+class SWFLocalActivityProxy(object):
+    """An activity proxy that runs the activity in the decider, see
+    SWFWorkflowConfig.conf_local_activity."""
+    def __init__(self, identity, activity, timeout=5, retry=(0, 0, 0),
+                 serialize_result=_serialize_result,
+                 deserialize_result=_deserialize_result, retry_bucket=None):
+        self.identity = identity
+        self.activity = activity
+        self.timeout = timeout
+        self.retry = retry
+        self.retry_bucket = retry_bucket
+        self.serialize_result = serialize_result
+        self.deserialize_result = deserialize_result
+
+    def bind(self, context, rate_limit=DescCounter()):
+        return ContextBoundProxy(self, context, rate_limit)
+
+    def schedule(self, context, call_key, delay, *args, **kwargs):
+        if int(delay) > 0 and not context.timer_ready(call_key):
+            return context.schedule_timer(call_key, delay, self.retry_bucket)
+        if self._fits(context):
+            outcome, value = _run_local_activity(
+                self.activity, args, kwargs, self.timeout,
+                self.serialize_result)
+            if outcome == 'timeout':
+                # its thread may still be running, don't start any more
+                context.local_timedout = True
+        elif not context.timer_ready(call_key):
+            # try again at the start of a new decision
+            return context.schedule_timer(call_key, 0)
+        else:
+            logger.warning('Not enough time left to run %r.', self.activity)
+            outcome, value = 'timeout', None
+        context.record_local_activity(call_key, outcome, value)
+
+    def _fits(self, context):
+        if context.local_timedout:
+            return False
+        left = context.time_left()
+        return left is None or left > (self.timeout or 0)
+
+
+def _run_local_activity(activity, args, kwargs, timeout, serialize_result):
+    """Run the activity and return the outcome and the value.
+
+    The outcome is one of 'result' (with the serialized result), 'error'
+    (with the error message) or 'timeout'.
+    """
+    outcome = []
+
+    def run():
+        try:
+            outcome.append(('result',
+                            serialize_result(activity(*args, **kwargs))))
+        except Exception as e:
+            logger.exception('Error while running the local activity:')
+            outcome.append(('error', str(e)))
+    if timeout is None:
+        run()
+    else:
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(timeout)
+    if not outcome:
+        logger.error('The local activity %r timed out.', activity)
+        return 'timeout', None
+    return outcome[0]
+
 
 class SWFWorkflowProxy(object):
     """Same as SWFActivityProxy but for sub-workflows."""
     def __init__(self, identity, name, version, task_list=None,
                  workflow_duration=None, decision_duration=None,
                  retry=(0, 0, 0), serialize_input=_serialize_input,
-                 deserialize_result=_deserialize_result):
+                 deserialize_result=_deserialize_result, retry_bucket=None):
         self.identity = identity
         self.name = name
         self.version = version
@@ -361,6 +1055,7 @@ class SWFWorkflowProxy(object):
         self.workflow_duration = workflow_duration
         self.decision_duration = decision_duration
         self.retry = retry
+        self.retry_bucket = retry_bucket
         self.serialize_input = serialize_input
         self.deserialize_result = deserialize_result
 
@@ -369,7 +1064,7 @@ class SWFWorkflowProxy(object):
 
     def schedule(self, context, call_key, delay, *args, **kwargs):
         if int(delay) > 0 and not context.timer_ready(call_key):
-            return context.schedule_timer(call_key, delay)
+            return context.schedule_timer(call_key, delay, self.retry_bucket)
         try:
             input_data = self.serialize_input(*args, **kwargs)
         except Exception as e:
@@ -382,11 +1077,317 @@ class SWFWorkflowProxy(object):
                                       self.decision_duration)
 
 
-def poll_next_decision(layer1, domain, task_list, identity=None):
-    """Poll a decision and create a SWFContext instance."""
+class SWFMapProxy(object):
+    """Map an activity over a list of items, using child workflows for the
+    large lists.
+
+    This class is used by SWFWorkflowConfig for each map configured. The
+    activity and the shard proxies are used to schedule the activities and
+    the child workflows, and the shard_workflow is the config and the factory
+    of the child workflows.
+    """
+    def __init__(self, activity, shard, shard_size, shard_workflow):
+        if shard_size < 2:
+            raise ValueError('The shard size must be at least 2: %r'
+                             % shard_size)
+        self.activity = activity
+        self.shard = shard
+        self.shard_size = shard_size
+        self.shard_workflow = shard_workflow
+
+    def bind(self, context, rate_limit=DescCounter()):
+        activity = self.activity.bind(context, rate_limit)
+        shard = self.shard.bind(context, rate_limit)
+        shard_size = self.shard_size
+
+        def map_items(items):
+            items = list(items)
+            if len(items) <= shard_size:
+                return _MapResult([activity(item) for item in items])
+            # each shard can be split again in up to shard_size shards
+            chunk = shard_size
+            while chunk * shard_size < len(items):
+                chunk *= shard_size
+            return _MapResult([shard(items[i:i + chunk])
+                               for i in range(0, len(items), chunk)],
+                              concat=True)
+        return map_items
+
+
+class _MapResult(TaskResult):
+    """The list of results of a map.
+
+    The results are the activity results or, if concat is set, the shard
+    results which are concatenated.
+    """
+    def __init__(self, parts, concat=False):
+        self._parts = parts
+        self._concat = concat
+        orders = [part._order for part in parts]
+        if None not in orders:
+            self._order = max(orders) if orders else -1
+
+    def result(self):
+        values = [part.result() for part in self._parts]
+        if self._concat:
+            return list(itertools.chain.from_iterable(values))
+        return values
+
+    def wait(self):
+        for part in self._parts:
+            part.wait()
+        return self
+
+    def is_error(self):
+        running = False
+        for part in self._parts:
+            try:
+                if part.is_error():
+                    return True
+            except SuspendTask:
+                running = True
+        if running:
+            raise SuspendTask()
+        return False
+
+
+class AIMDRateLimit(object):
+    """Adapt the number of running activities on each task list.
+
+    Use it as the rate_control of a SWFWorkflowConfig. Each task list has a
+    window, the number of activities the workflow can have running on it,
+    computed on every decision from the workflow history with additive
+    increase, multiplicative decrease:
+
+    * an activity started at most target_delay seconds after it was
+      scheduled grows the window by increase / window, that is by increase
+      once a full window of activities started in time;
+    * an activity that waited longer than target_delay in the task list
+      multiplies the window by decrease;
+    * a schedule failure because of too many activities multiplies the
+      windows of all the task lists by decrease.
+
+    The window starts at initial and stays between minimum and maximum. If a
+    pending callable is set (like a PendingActivityCounts instance), it's
+    called with the task list and if more tasks than the window are pending
+    the window is decreased once more.
+    """
+    def __init__(self, initial=16, minimum=1, maximum=256, increase=1,
+                 decrease=0.5, target_delay=10, pending=None):
+        if not 1 <= minimum <= initial <= maximum:
+            raise ValueError('The windows must be 1 <= minimum <= initial <='
+                             ' maximum: %r, %r, %r'
+                             % (minimum, initial, maximum))
+        if not 0 < decrease < 1:
+            raise ValueError('The decrease must be between 0 and 1: %r'
+                             % decrease)
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.target_delay = target_delay
+        self.pending = pending
+
+    def window(self, signals, task_list):
+        """Compute the window of a task list from the history signals.
+
+        The signals are (task list, schedule to start delay) tuples in the
+        history order, see _TaskListLoad. A None task list applies to all
+        the task lists and a None delay is a schedule failure.
+        """
+        window = float(self.initial)
+        for s_task_list, delay in signals:
+            if s_task_list is not None and s_task_list != task_list:
+                continue
+            if delay is None or delay > self.target_delay:
+                window = max(window * self.decrease, self.minimum)
+            else:
+                window = min(window + self.increase / window, self.maximum)
+        if self.pending is not None:
+            pending = self.pending(task_list)
+            if pending is not None and pending > window:
+                window = max(window * self.decrease, self.minimum)
+        return int(window)
+
+    def __repr__(self):
+        return '<%s initial=%s target_delay=%s>' % (
+            self.__class__.__name__, self.initial, self.target_delay)
+
+
+class PendingActivityCounts(object):
+    """The counts of the pending activity tasks in a domain, by task list.
+
+    The counts are cached for ttl seconds to keep the number of SWF calls
+    low. A count that can't be loaded is None.
+    """
+    def __init__(self, domain, layer1=None, ttl=10):
+        self.domain = domain
+        self.layer1 = layer1 if layer1 is not None else Layer1()
+        self.ttl = ttl
+        self.cache = {}  # task list -> count, expiration time
+
+    def __call__(self, task_list):
+        now = time.time()
+        count, expires = self.cache.get(task_list, (None, 0))
+        if now >= expires:
+            try:
+                count = self.layer1.count_pending_activity_tasks(
+                    str(self.domain), str(task_list))['count']
+            except SWFResponseError:
+                logger.exception('Error while counting the pending tasks:')
+                count = None
+            self.cache[task_list] = count, now + self.ttl
+        return count
+
+
+class _TaskListLoad(object):
+    """The activities load of each task list, collected by load_events."""
+    def __init__(self):
+        self.running = {}  # task list -> number of running activities
+        self.signals = []  # see AIMDRateLimit.window
+        self.scheduled = {}  # scheduled event id -> task list, timestamp
+
+    def activity_scheduled(self, event_id, task_list, timestamp):
+        self.running[task_list] = self.running.get(task_list, 0) + 1
+        self.scheduled[event_id] = task_list, timestamp
+
+    def activity_started(self, scheduled_id, timestamp):
+        task_list, scheduled_at = self.scheduled.get(scheduled_id,
+                                                     (None, None))
+        if task_list is not None and None not in (scheduled_at, timestamp):
+            self.signals.append((task_list, timestamp - scheduled_at))
+
+    def activity_closed(self, scheduled_id):
+        task_list, _ = self.scheduled.pop(scheduled_id, (None, None))
+        if task_list is not None:
+            self.running[task_list] -= 1
+
+    def schedule_failed(self, cause):
+        if cause in _THROTTLED:
+            self.signals.append((None, None))
+
+
+class _Hedges(object):
+    """The state of the hedged activities, collected by load_events.
+
+    The hedge timer of a call is started right before the call is scheduled
+    (see SWFContext.schedule_hedge). If the call is still running when the
+    timer fires, the decision schedules a duplicate activity (the call key
+    with a ':h' suffix) with the same attributes. Once one of the activities
+    of a call completes the others are canceled. The hedge timer of a call
+    decided before it fires is canceled too, so it doesn't cause a useless
+    decision.
+    """
+    def __init__(self):
+        self.task_lists = {}  # call key -> hedge task list, timer started
+        self.attrs = {}  # call key -> the scheduled event attributes
+        self.open = {}  # call key -> the open activity ids
+        self.due = {}  # call key -> the attributes of the duplicate to start
+        self.cancel = set()  # the activity ids to cancel
+        self.timers = set()  # the call keys with an open hedge timer
+        self.cancel_timers = set()  # the hedge timer ids to cancel
+
+    def timer_started(self, call_key, task_list):
+        self.task_lists[call_key] = task_list
+        self.timers.add(call_key)
+
+    def timer_closed(self, call_key):
+        self.timers.discard(call_key)
+        self.cancel_timers.discard(_timer_key(_hedge_key(call_key)))
+
+    def timer_fired(self, call_key, running):
+        self.timer_closed(call_key)
+        attrs = self.attrs.get(call_key)
+        if (call_key not in running or attrs is None
+                or len(self.open[call_key]) != 1):
+            return
+        attrs = dict(attrs, activityId=_hedge_key(call_key))
+        task_list = self.task_lists.get(call_key)
+        if task_list is not None:
+            attrs['taskList'] = {'name': task_list}
+        self.due[call_key] = attrs
+
+    def scheduled(self, activity_id, attrs):
+        """Return True if the activity is a duplicate of a running call."""
+        call_key = _hedge_call_key(activity_id)
+        if call_key != activity_id:
+            self.due.pop(call_key, None)
+            self.open.setdefault(call_key, set()).add(activity_id)
+            return True
+        if call_key in self.task_lists:
+            self.attrs[call_key] = attrs
+            self.open[call_key] = set([call_key])
+        return False
+
+    def schedule_failed(self, activity_id):
+        """Return True if the activity is a duplicate of a running call.
+
+        The duplicate is not scheduled again."""
+        call_key = _hedge_call_key(activity_id)
+        self.due.pop(call_key, None)
+        if call_key == activity_id:
+            self._decided(call_key)
+        return call_key != activity_id
+
+    def closed(self, activity_id, running, completed):
+        """Return the call key the closed activity decides or None.
+
+        The activity doesn't decide the call if the call was already
+        decided or, unless it completed, if another of its activities is
+        still open.
+        """
+        call_key = _hedge_call_key(activity_id)
+        activities = self.open.get(call_key)
+        if activities is None:
+            return call_key
+        activities.discard(activity_id)
+        self.cancel.discard(activity_id)
+        if not activities:
+            del self.open[call_key]
+        if call_key not in running or (not completed and activities):
+            return None
+        self.cancel.update(activities)
+        self._decided(call_key)
+        return call_key
+
+    def _decided(self, call_key):
+        self.due.pop(call_key, None)
+        self.attrs.pop(call_key, None)
+        self.task_lists.pop(call_key, None)
+        if call_key in self.timers:
+            self.cancel_timers.add(_timer_key(_hedge_key(call_key)))
+
+    def cancel_requested(self, activity_id):
+        self.cancel.discard(activity_id)
+
+
+def poll_next_decision(layer1, domain, task_list, identity=None, budget=None):
+    """Poll a decision and create a SWFContext instance.
+
+    The budget is the fraction of the decision duration that can be spent on
+    the decision, see SWFContext.
+    """
     first_page = poll_first_page(layer1, domain, task_list, identity)
+    context = decision_context(layer1, domain, task_list, first_page,
+                               identity, budget)
+    if context is None:
+        # There's nothing better to do than to retry
+        return poll_next_decision(layer1, domain, task_list, identity, budget)
+    return context
+
+
+def decision_context(layer1, domain, task_list, first_page, identity=None,
+                     budget=None):
+    """Load the rest of the history and create a SWFContext instance.
+
+    Return None if the history can't be loaded.
+    """
+    started = time.time()
     token = first_page['taskToken']
-    all_events = events(layer1, domain, task_list, first_page, identity)
+    stats = {'events': 0, 'pages': 0}
+    all_events = events(layer1, domain, task_list, first_page, identity,
+                        stats)
     # Sometimes the first event in on the second page,
     # and the first page is empty
     first_event = next(all_events)
@@ -400,14 +1401,17 @@ def poll_next_decision(layer1, domain, task_list, identity=None):
     name = first_event[wesea]['workflowType']['name']
     version = first_event[wesea]['workflowType']['version']
     input_data = first_event[wesea]['input']
+    times, load, hedges = {}, _TaskListLoad(), _Hedges()
     try:
-        running, timedout, results, errors, order = load_events(all_events)
+        running, timedout, results, errors, order = load_events(
+            all_events, times, _ResultSpill(), load, hedges)
     except _PaginationError:
-        # There's nothing better to do than to retry
-        return poll_next_decision(layer1, task_list, domain, identity)
+        return None
     return SWFContext(layer1, token, name, version, input_data,
                       task_list, decision_duration, workflow_duration, tags,
-                      child_policy, running, timedout, results, errors, order)
+                      child_policy, running, timedout, results, errors, order,
+                      stats['events'], stats['pages'], started, budget, times,
+                      load, hedges)
 
 def poll_first_page(layer1, domain, task_list, identity=None):
     """Return the response from loading the first page.
@@ -438,10 +1442,17 @@ def poll_response_page(layer1, domain, task_list, token, identity=None):
         raise _PaginationError()
     return swf_response
 
-def events(layer1, domain, task_list, first_page, identity=None):
-    """Load pages one by one and generate all events found."""
+def events(layer1, domain, task_list, first_page, identity=None, stats=None):
+    """Load pages one by one and generate all events found.
+
+    If a stats dict is passed, the number of events and pages loaded are
+    counted in its 'events' and 'pages' keys.
+    """
     page = first_page
     while 1:
+        if stats is not None:
+            stats['pages'] += 1
+            stats['events'] += len(page['events'])
         for event in page['events']:
             yield event
         if not page.get('nextPageToken'):
@@ -449,7 +1460,59 @@ def events(layer1, domain, task_list, first_page, identity=None):
         page = poll_response_page(layer1, domain, task_list,
                                   page['nextPageToken'], identity)
 
-def load_events(event_iter):
+class _SpilledResult(object):
+    """A lazy view of a result saved in a _ResultSpill."""
+    def __init__(self, spill, offset, size):
+        self.spill = spill
+        self.offset = offset
+        self.size = size
+
+    def load(self):
+        return self.spill.read(self.offset, self.size)
+
+    def __repr__(self):
+        return '<spilled result %s:%s>' % (self.offset, self.size)
+
+
+class _ResultSpill(object):
+    """Keep the large results in a scratch file instead of in memory.
+
+    Calling it with a result returns the result itself if it's smaller than
+    the threshold, otherwise the result is appended to an anonymous temporary
+    file and a _SpilledResult view is returned instead. The views are read
+    from a memory map of the file, so the decider memory depends on the
+    results the workflow uses, not on the size of the history. The file is
+    removed once the spill and all its views are garbage collected.
+    """
+    def __init__(self, threshold=_SPILL_SIZE, directory=None):
+        self.threshold = threshold
+        self.directory = directory
+        self.file = None
+        self.map = None
+        self.size = 0
+
+    def __call__(self, result):
+        if result is None or len(result) < self.threshold:
+            return result
+        if not isinstance(result, bytes):
+            result = result.encode('utf-8')
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(dir=self.directory)
+        self.file.write(result)
+        view = _SpilledResult(self, self.size, len(result))
+        self.size += len(result)
+        return view
+
+    def read(self, offset, size):
+        if self.map is None or len(self.map) < offset + size:
+            # map again if results were added since the last map
+            self.file.flush()
+            self.map = mmap.mmap(self.file.fileno(), self.size,
+                                 access=mmap.ACCESS_READ)
+        return self.map[offset:offset + size].decode('utf-8')
+
+
+def load_events(event_iter, times=None, spill=None, load=None, hedges=None):
     """Combine all events in their order.
 
     This returns a tuple of the following things:
@@ -458,55 +1521,154 @@ def load_events(event_iter):
         results  - a dictionary of id -> result for each finished task
         errors   - a dictionary of id -> error message for each failed task
         order    - an list of task ids in the order they finished
+
+    If a times dict is passed, the timestamps when each task was scheduled
+    and closed (or None if it's still running) are saved in it, by id.
+
+    If a spill is passed (see _ResultSpill), the results are passed through
+    it and the large ones are replaced by lazy views.
+
+    If a load is passed (see _TaskListLoad), the activities running on each
+    task list and the rate control signals are collected in it.
+
+    If hedges is passed (see _Hedges), the state of the hedged activities is
+    collected in it. Either way, the activities of a hedged call are loaded
+    as the call.
+
+    The batched calls (see SWFActivityProxy.schedule_batch) are loaded as if
+    each one was scheduled on its own, in the batch order. Their call keys
+    come from the marker recorded with the batch.
+
+    The local activities (see SWFWorkflowConfig.conf_local_activity) are
+    loaded from their markers. They are placed in the order as if they
+    finished right before the events the decision that ran them didn't see.
     """
     running, timedout = set(), set()
     results, errors = {}, {}
     order = []
     event2call = {}
+    shared_timers = {}  # timer id -> the call keys waiting on it
+    batches = {}  # batch activity id -> the batched call keys, from markers
+    decision_order = {}  # decision event id -> the order position it saw
+    if times is None:
+        times = {}
+    if spill is None:
+        spill = lambda result: result
+    if load is None:
+        load = _TaskListLoad()
+    if hedges is None:
+        hedges = _Hedges()
     for event in event_iter:
         e_type = event.get('eventType')
         if e_type == 'ActivityTaskScheduled':
-            eid = event['activityTaskScheduledEventAttributes']['activityId']
+            atsea = 'activityTaskScheduledEventAttributes'
+            eid = event[atsea]['activityId']
             event2call[event['eventId']] = eid
-            running.add(eid)
+            a_task_list = event[atsea].get('taskList', {}).get('name')
+            load.activity_scheduled(event['eventId'], a_task_list,
+                                    event.get('eventTimestamp'))
+            if hedges.scheduled(eid, event[atsea]):
+                continue
+            for eid in batches.get(eid, [eid]):
+                running.add(eid)
+                times[eid] = [event.get('eventTimestamp'), None]
+        elif e_type == 'ActivityTaskStarted':
+            atsea = 'activityTaskStartedEventAttributes'
+            load.activity_started(event[atsea]['scheduledEventId'],
+                                  event.get('eventTimestamp'))
         elif e_type == 'ActivityTaskCompleted':
             atcea = 'activityTaskCompletedEventAttributes'
-            eid = event2call[event[atcea]['scheduledEventId']]
+            s_id = event[atcea]['scheduledEventId']
+            load.activity_closed(s_id)
+            eid = hedges.closed(event2call[s_id], running, True)
+            if eid is None:
+                continue
             result = event[atcea]['result']
+            if eid in batches:
+                call_keys = batches.pop(eid)
+                outcomes = _batch_outcomes(result, len(call_keys))
+                for eid, (outcome, value) in zip(call_keys, outcomes):
+                    running.remove(eid)
+                    times[eid][1] = event.get('eventTimestamp')
+                    if outcome == 'result':
+                        results[eid] = spill(value)
+                    else:
+                        errors[eid] = value
+                    order.append(eid)
+                continue
             running.remove(eid)
-            results[eid] = result
+            times[eid][1] = event.get('eventTimestamp')
+            results[eid] = spill(result)
             order.append(eid)
         elif e_type == 'ActivityTaskFailed':
             atfea = 'activityTaskFailedEventAttributes'
-            eid = event2call[event[atfea]['scheduledEventId']]
+            s_id = event[atfea]['scheduledEventId']
+            load.activity_closed(s_id)
+            eid = hedges.closed(event2call[s_id], running, False)
+            if eid is None:
+                continue
             reason = event[atfea]['reason']
-            running.remove(eid)
-            errors[eid] = reason
-            order.append(eid)
+            for eid in batches.pop(eid, [eid]):
+                running.remove(eid)
+                times[eid][1] = event.get('eventTimestamp')
+                errors[eid] = reason
+                order.append(eid)
         elif e_type == 'ActivityTaskTimedOut':
             attoea = 'activityTaskTimedOutEventAttributes'
-            eid = event2call[event[attoea]['scheduledEventId']]
-            running.remove(eid)
-            timedout.add(eid)
-            order.append(eid)
+            s_id = event[attoea]['scheduledEventId']
+            load.activity_closed(s_id)
+            eid = hedges.closed(event2call[s_id], running, False)
+            if eid is None:
+                continue
+            for eid in batches.pop(eid, [eid]):
+                running.remove(eid)
+                times[eid][1] = event.get('eventTimestamp')
+                timedout.add(eid)
+                order.append(eid)
+        elif e_type == 'ActivityTaskCanceled':
+            atcaea = 'activityTaskCanceledEventAttributes'
+            s_id = event[atcaea]['scheduledEventId']
+            load.activity_closed(s_id)
+            eid = hedges.closed(event2call[s_id], running, False)
+            if eid is None:
+                continue
+            reason = event[atcaea].get('details') or 'Canceled'
+            for eid in batches.pop(eid, [eid]):
+                running.remove(eid)
+                times[eid][1] = event.get('eventTimestamp')
+                errors[eid] = reason
+                order.append(eid)
+        elif e_type == 'ActivityTaskCancelRequested':
+            atcrea = 'activityTaskCancelRequestedEventAttributes'
+            hedges.cancel_requested(event[atcrea]['activityId'])
+        elif e_type == 'RequestCancelActivityTaskFailed':
+            # the activity is already closed
+            rcatfea = 'requestCancelActivityTaskFailedEventAttributes'
+            hedges.cancel_requested(event[rcatfea]['activityId'])
         elif e_type == 'ScheduleActivityTaskFailed':
             satfea = 'scheduleActivityTaskFailedEventAttributes'
             eid = event[satfea]['activityId']
             reason = event[satfea]['cause']
+            load.schedule_failed(reason)
+            if hedges.schedule_failed(eid):
+                continue
             # when a job is not found it's not even started
-            errors[eid] = reason
-            order.append(eid)
+            for eid in batches.pop(eid, [eid]):
+                errors[eid] = reason
+                order.append(eid)
         elif e_type == 'StartChildWorkflowExecutionInitiated':
             scweiea = 'startChildWorkflowExecutionInitiatedEventAttributes'
             eid = _subworkflow_call_key(event[scweiea]['workflowId'])
             running.add(eid)
+            times[eid] = [event.get('eventTimestamp'), None]
         elif e_type == 'ChildWorkflowExecutionCompleted':
             cwecea = 'childWorkflowExecutionCompletedEventAttributes'
             eid = _subworkflow_call_key(
                 event[cwecea]['workflowExecution']['workflowId'])
             result = event[cwecea]['result']
             running.remove(eid)
-            results[eid] = result
+            times[eid][1] = event.get('eventTimestamp')
+            results[eid] = spill(result)
             order.append(eid)
         elif e_type == 'ChildWorkflowExecutionFailed':
             cwefea = 'childWorkflowExecutionFailedEventAttributes'
@@ -514,6 +1676,7 @@ def load_events(event_iter):
                 event[cwefea]['workflowExecution']['workflowId'])
             reason = event[cwefea]['reason']
             running.remove(eid)
+            times[eid][1] = event.get('eventTimestamp')
             errors[eid] = reason
             order.append(eid)
         elif e_type == 'ChildWorkflowExecutionTimedOut':
@@ -521,6 +1684,7 @@ def load_events(event_iter):
             eid = _subworkflow_call_key(
                 event[cwetoea]['workflowExecution']['workflowId'])
             running.remove(eid)
+            times[eid][1] = event.get('eventTimestamp')
             timedout.add(eid)
             order.append(eid)
         elif e_type == 'StartChildWorkflowExecutionFailed':
@@ -529,22 +1693,85 @@ def load_events(event_iter):
             reason = event[scwefea]['cause']
             errors[eid] = reason
             order.append(eid)
+        elif e_type == 'DecisionTaskStarted':
+            decision_order[event['eventId']] = len(order)
+        elif e_type == 'DecisionTaskCompleted':
+            dtcea = 'decisionTaskCompletedEventAttributes'
+            started_id = event[dtcea]['startedEventId']
+            decision_order[event['eventId']] = decision_order.pop(started_id,
+                                                                  len(order))
+        elif e_type == 'MarkerRecorded':
+            mrea = 'markerRecordedEventAttributes'
+            if _is_batch(event[mrea]['markerName']):
+                batches[event[mrea]['markerName']] = json.loads(
+                    event[mrea]['details'])
+                continue
+            if not event[mrea]['markerName'].endswith(':l'):
+                continue
+            eid = _local_call_key(event[mrea]['markerName'])
+            outcome, value = json.loads(event[mrea]['details'])
+            if outcome == 'result':
+                results[eid] = spill(value)
+            elif outcome == 'error':
+                errors[eid] = value
+            else:
+                timedout.add(eid)
+            times[eid] = [event.get('eventTimestamp')] * 2
+            completed_id = event[mrea]['decisionTaskCompletedEventId']
+            position = decision_order.get(completed_id, len(order))
+            order.insert(position, eid)
+            # the next markers of the same decision go after this one
+            decision_order[completed_id] = position + 1
         elif e_type == 'TimerStarted':
-            eid = event['timerStartedEventAttributes']['timerId']
+            tsea = 'timerStartedEventAttributes'
+            eid = event[tsea]['timerId']
+            if _is_hedge_timer(eid):
+                hedges.timer_started(_hedge_call_key(_timer_call_key(eid)),
+                                     event[tsea].get('control'))
+                continue
             # while the timer is running, act as if the task itself is running
             # to prevent it from being scheduled again
-            running.add(_timer_call_key(eid))
+            if event[tsea].get('control'):
+                # a timer shared by many calls
+                shared_timers[eid] = json.loads(event[tsea]['control'])
+                running.update(shared_timers[eid])
+            else:
+                running.add(_timer_call_key(eid))
         elif e_type == 'TimerFired':
             eid = event['timerFiredEventAttributes']['timerId']
-            running.remove(_timer_call_key(eid))
-            results[eid] = None
+            if _is_hedge_timer(eid):
+                hedges.timer_fired(_hedge_call_key(_timer_call_key(eid)),
+                                   running)
+                continue
+            for call_key in shared_timers.pop(eid, [_timer_call_key(eid)]):
+                running.remove(call_key)
+                results[_timer_key(call_key)] = None
+        elif e_type == 'TimerCanceled':
+            # only the hedge timers are canceled
+            eid = event['timerCanceledEventAttributes']['timerId']
+            if _is_hedge_timer(eid):
+                hedges.timer_closed(_hedge_call_key(_timer_call_key(eid)))
+        elif e_type == 'CancelTimerFailed':
+            # the timer already fired
+            eid = event['cancelTimerFailedEventAttributes']['timerId']
+            if _is_hedge_timer(eid):
+                hedges.timer_closed(_hedge_call_key(_timer_call_key(eid)))
     return running, timedout, results, errors, order
 
 
 class SWFContext(object):
+    """The execution context of a single decision.
+
+    If a budget is set, once the time spent on this decision (loading the
+    history included) exceeds that fraction of the decision duration no new
+    tasks are scheduled. The decisions taken so far are sent instead, before
+    the decision times out and all the work is lost.
+    """
     def __init__(self, layer1, token, name, version, input_data,
                  task_list, decision_duration, workflow_duration, tags,
-                 child_policy, running, timedout, results, errors, order):
+                 child_policy, running, timedout, results, errors, order,
+                 events=0, pages=0, started=None, budget=None, times=None,
+                 load=None, hedges=None):
         self.layer1 = layer1
         self.token = token
         self.name = name
@@ -560,9 +1787,62 @@ class SWFContext(object):
         self.results = results
         self.errors = errors
         self.order = order
+        self.order_index = {}
+        for i, call_key in enumerate(order):
+            self.order_index.setdefault(call_key, i)
+        self.events = events
+        self.pages = pages
+        self.times = times if times is not None else {}
+        self.load = load if load is not None else _TaskListLoad()
+        self.windows = {}  # task list -> window, see may_schedule
+        if hedges is None:
+            hedges = _Hedges()
+        self.hedges = hedges.due  # call key -> the duplicate to schedule
+        self.cancels = hedges.cancel  # the losing activities
+        self.cancel_timers = hedges.cancel_timers  # of the decided hedges
+        self.batches = {}  # identity -> the proxy and its batched calls
+        self.started = started if started is not None else time.time()
+        self.deadline = None
+        if budget is not None:
+            try:
+                self.deadline = budget * float(decision_duration)
+            except ValueError:  # NONE, no decision timeout
+                pass
+        self.out_of_time = False
+        self.local_timedout = False  # see SWFLocalActivityProxy
         self.decisions = Layer1Decisions()
+        self.shared_timers = {}  # bucket -> call keys
         self.closed = False
 
+    def replay_time(self):
+        """The time spent on this decision since it was polled, in seconds."""
+        return time.time() - self.started
+
+    def time_left(self):
+        """The time left until the decision budget or, without one, until
+        the decision timeout; None if there's no limit."""
+        limit = self.deadline
+        if limit is None:
+            try:
+                limit = float(self.decision_duration)
+            except (TypeError, ValueError):  # NONE, no decision timeout
+                return None
+        return limit - self.replay_time()
+
+    def over_budget(self):
+        """Test if the decision ran out of its time budget."""
+        if not self.out_of_time and self.deadline is not None:
+            self.out_of_time = self.replay_time() >= self.deadline
+        return self.out_of_time
+
+    def may_schedule(self, task_list, rate_control):
+        """Test if one more activity can run on the task list."""
+        window = self.windows.get(task_list)
+        if window is None:
+            window = rate_control.window(self.load.signals, task_list)
+            self.windows[task_list] = window
+        return self.load.running.get(task_list, 0) < window
+
     def is_running(self, call_key):
         return str(call_key) in self.running
 
@@ -570,25 +1850,35 @@ class SWFContext(object):
         return str(call_key) in self.results
 
     def result(self, call_key):
-        return self.results[str(call_key)], self.order.index(str(call_key))
+        return self.results[str(call_key)], self.order_index[str(call_key)]
 
     def is_error(self, call_key):
         return str(call_key) in self.errors
 
     def error(self, call_key):
-        return self.errors[str(call_key)], self.order.index(str(call_key))
+        return self.errors[str(call_key)], self.order_index[str(call_key)]
 
     def is_timeout(self, call_key):
         return str(call_key) in self.timedout
 
     def timeout(self, call_key):
-        return self.order.index(str(call_key))
+        return self.order_index[str(call_key)]
 
     def timer_ready(self, call_key):
         return _timer_key(call_key) in self.results
 
+    def elapsed(self, first_key, call_key):
+        """The time from the first call scheduled to the other closed."""
+        try:
+            closed = self.times[str(call_key)][1]
+            return closed - self.times[str(first_key)][0]
+        except (KeyError, TypeError):
+            return None
+
     def fail(self, reason):
+        self.shared_timers, self.hedges, self.batches = {}, {}, {}
         decisions = self.decisions = Layer1Decisions()
+        self._cancel_losers()
         decisions.fail_workflow_execution(reason=str(reason)[:_REASON_SIZE])
         self.flush()
 
@@ -596,6 +1886,15 @@ class SWFContext(object):
         if self.closed:
             return
         self.closed = True
+        self._start_shared_timers()
+        self._cancel_losers()
+        self._start_hedges()
+        self._start_batches()
+        if self.out_of_time and not self.decisions._data and not self.running:
+            # nothing would trigger a new decision, use a timer
+            logger.warning('Decision time budget exceeded for %s.', self.name)
+            self.decisions.start_timer(timer_id='budget-%s:t' % self.events,
+                                       start_to_fire_timeout='0')
         try:
             self.layer1.respond_decision_task_completed(
                 task_token=str(self.token), decisions=self.decisions._data)
@@ -604,10 +1903,12 @@ class SWFContext(object):
             # ignore the error and let the decision timeout and retry
 
     def restart(self, input_data):
+        self.shared_timers, self.hedges, self.batches = {}, {}, {}
         decisions = self.decisions = Layer1Decisions()
         child_policy = _str_or_none(self.child_policy)
         if child_policy not in _CHILD_POLICY:
             raise ValueError('Invalid child policy value: %r' % child_policy)
+        self._cancel_losers()
         decisions.continue_as_new_workflow_execution(
             start_to_close_timeout=_str_or_none(self.decision_duration),
             execution_start_to_close_timeout=_str_or_none(self.workflow_duration),
@@ -618,20 +1919,109 @@ class SWFContext(object):
         self.flush()
 
     def finish(self, result):
+        self.shared_timers, self.hedges, self.batches = {}, {}, {}
         decisions = self.decisions = Layer1Decisions()
+        self._cancel_losers()
         decisions.complete_workflow_execution(str(result)[:_RESULT_SIZE])
         self.flush()
 
+    def _start_shared_timers(self):
+        now = time.time()
+        for bucket, call_keys in sorted(self.shared_timers.items()):
+            delay = str(max(int(math.ceil(bucket - now)), 0))
+            # the call keys are saved in the timer control field
+            for chunk, control in enumerate(_chunk_keys(call_keys)):
+                timer_id = 'retry-%d-%s-%s:t' % (bucket, self.events, chunk)
+                self.decisions.start_timer(timer_id=timer_id,
+                                           start_to_fire_timeout=delay,
+                                           control=control)
+        self.shared_timers = {}
+
+    def _cancel_losers(self):
+        # the activities that lost to their duplicates and the hedge timers
+        # not needed anymore, see _Hedges
+        for activity_id in sorted(self.cancels):
+            self.decisions.request_cancel_activity_task(activity_id)
+        for timer_id in sorted(self.cancel_timers):
+            self.decisions.cancel_timer(timer_id)
+        self.cancels, self.cancel_timers = set(), set()
+
+    def _start_hedges(self):
+        # the duplicates of the slow activities, see _Hedges
+        for _, attrs in sorted(self.hedges.items()):
+            self.decisions.schedule_activity_task(
+                attrs['activityId'], attrs['activityType']['name'],
+                attrs['activityType']['version'],
+                task_list=attrs.get('taskList', {}).get('name'),
+                heartbeat_timeout=attrs.get('heartbeatTimeout'),
+                schedule_to_close_timeout=attrs.get('scheduleToCloseTimeout'),
+                schedule_to_start_timeout=attrs.get('scheduleToStartTimeout'),
+                start_to_close_timeout=attrs.get('startToCloseTimeout'),
+                input=attrs.get('input'))
+        self.hedges = {}
+
+    def _start_batches(self):
+        for _, (proxy, items) in sorted(self.batches.items()):
+            for call_keys, inputs in _batches(items, proxy.batch):
+                proxy.schedule_batch(self, call_keys, inputs)
+        self.batches = {}
+
     # Used by SWFProxy instances
 
-    def schedule_timer(self, call_key, delay):
+    def record_batch(self, call_key, call_keys):
+        """Record the call keys of a batch in a marker named after it."""
+        self.decisions.record_marker(str(call_key), json.dumps(call_keys))
+
+    def add_to_batch(self, proxy, call_key, input_data):
+        """Add a call to the proxy batches scheduled by flush."""
+        _, items = self.batches.setdefault(proxy.identity, (proxy, []))
+        items.append((str(call_key), input_data))
+
+    def record_local_activity(self, call_key, outcome, value):
+        """Record the outcome of a local activity in a marker and make it
+        available to the workflow right away."""
+        call_key = str(call_key)
+        details = json.dumps([outcome, value])
+        if len(details) > _DETAILS_SIZE:
+            outcome, value = 'error', 'The local activity result is too large.'
+            details = json.dumps([outcome, value])
+        self.decisions.record_marker(_local_key(call_key), details)
+        if outcome == 'result':
+            self.results[call_key] = value
+        elif outcome == 'error':
+            self.errors[call_key] = value
+        else:
+            self.timedout.add(call_key)
+        now = time.time()
+        self.times[call_key] = [now, now]
+        self.order_index[call_key] = len(self.order)
+        self.order.append(call_key)
+
+    def schedule_timer(self, call_key, delay, bucket=None):
+        if bucket:
+            # round up to the end of the bucket and wait with the others
+            fire_at = time.time() + int(delay)
+            bucket_end = int(math.ceil(fire_at / bucket) * bucket)
+            self.shared_timers.setdefault(bucket_end, []).append(str(call_key))
+            return
         call_key = _timer_key(call_key)
         self.decisions.start_timer(timer_id=str(call_key),
                                    start_to_fire_timeout=str(delay))
 
+    def schedule_hedge(self, call_key, delay, task_list=None):
+        """Start the timer after which a duplicate of the activity is
+        scheduled if it's still running, see _Hedges."""
+        self.decisions.start_timer(
+            timer_id=_timer_key(_hedge_key(call_key)),
+            start_to_fire_timeout=str(delay),
+            control=_str_or_none(task_list))
+
     def schedule_activity(self, call_key, name, version, input_data, task_list,
                           heartbeat, schedule_to_close, schedule_to_start,
-                          start_to_close):
+                          start_to_close, control=None):
+        if task_list is not None:
+            running = self.load.running
+            running[task_list] = running.get(task_list, 0) + 1
         self.decisions.schedule_activity_task(
             str(call_key), str(name), str(version),
             heartbeat_timeout=_str_or_none(heartbeat),
@@ -639,7 +2029,7 @@ class SWFContext(object):
             schedule_to_start_timeout=_str_or_none(schedule_to_start),
             start_to_close_timeout=_str_or_none(start_to_close),
             task_list=_str_or_none(task_list),
-            input=str(input_data))
+            input=str(input_data), control=control)
 
     def schedule_workflow(self, call_key, name, version, input_data, task_list,
                           workflow_duration, decision_duration):
@@ -652,22 +2042,198 @@ class SWFContext(object):
             input=str(input_data))
 
 
+class _WeightedQueue(object):
+    """A queue for each index, served using smooth weighted round-robin.
+
+    Among the queues that have items, each one is picked proportionally to
+    its weight and the picks are spread out evenly.
+    """
+    def __init__(self, weights):
+        self.weights = weights
+        self.current = [0] * len(weights)
+        self.queues = [deque() for _ in weights]
+        self.cond = threading.Condition()
+
+    def put(self, index, item):
+        with self.cond:
+            self.queues[index].append(item)
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        """Return the next item or raise Empty after the timeout."""
+        with self.cond:
+            if not any(self.queues):
+                self.cond.wait(timeout)
+            ready = [i for i, queue in enumerate(self.queues) if queue]
+            if not ready:
+                raise Empty()
+            for i in ready:
+                self.current[i] += self.weights[i]
+            best = max(ready, key=lambda i: self.current[i])
+            self.current[best] -= sum(self.weights[i] for i in ready)
+            return self.queues[best].popleft()
+
+
+class SWFWorkflowWorker(object):
+    """A workflow worker for multiple task lists, possibly in many domains.
+
+    The task_lists is a list of (domain, task_list, weight) tuples. Each task
+    list has its own poller threads but the decisions are run by the
+    executors threads, the thread calling run being one of them, picked from
+    the task lists with work proportionally to their weights.
+
+    Each task list starts with one poller. A new poller is added every time a
+    poll returns a decision, up to max_pollers, and the extra pollers exit
+    when their polls come back empty. A decision takes one of the executors
+    slots once its poll returns and frees it once it was run, and the pollers
+    only poll while a slot is free. The long polls of idle task lists don't
+    hold any slots, so the busy task lists don't wait on them. Only the polls
+    already in progress when the last slot is taken can return more decisions
+    than there are executors; those wait in the ready queue, from where the
+    weights decide which task list runs next.
+
+    Each poller uses its own SWF client, created by calling layer1_factory.
+    See start_swf_workflow_worker for the decision_budget.
+    """
+    def __init__(self, task_lists, registry, layer1_factory=Layer1,
+                 identity=None, max_pollers=4, decision_budget=None,
+                 executors=1):
+        self.task_lists = [(str(domain), str(task_list), weight)
+                           for domain, task_list, weight in task_lists]
+        self.registry = registry
+        self.layer1_factory = layer1_factory
+        identity = identity if identity is not None else _default_identity()
+        self.identity = str(identity)[:_IDENTITY_SIZE]
+        self.max_pollers = max_pollers
+        self.decision_budget = decision_budget
+        self.executors = executors
+        self.taken = 0  # the decisions waiting for or using an executor
+        self.freed = threading.Condition()
+        self.ready = _WeightedQueue([w for _, _, w in self.task_lists])
+        self.pollers = [0] * len(self.task_lists)  # per task list
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def start(self):
+        """Start one poller thread for each task list."""
+        with self.lock:
+            for index in range(len(self.task_lists)):
+                self._add_poller(index)
+
+    def stop(self):
+        """Stop polling; run returns once the polls in progress finish."""
+        self.stopping.set()
+
+    def run(self):
+        """Run the polled decisions until the worker is stopped."""
+        threads = []
+        for _ in range(self.executors - 1):
+            thread = threading.Thread(target=self._execute)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        self._execute()
+        for thread in threads:
+            thread.join()
+
+    def _execute(self):
+        layer1 = self.layer1_factory()
+        while 1:
+            try:
+                context = self.ready.get(timeout=1)
+            except Empty:
+                with self.lock:
+                    if self.stopping.is_set() and not any(self.pollers):
+                        return
+                continue
+            # the poller's client can't be shared
+            context.layer1 = layer1
+            try:
+                self.registry(context)
+            except Exception:
+                logger.exception('Error while running the decision:')
+            finally:
+                with self.freed:
+                    self.taken -= 1
+                    self.freed.notify_all()
+
+    def _add_poller(self, index):
+        self.pollers[index] += 1
+        thread = threading.Thread(target=self._poll, args=(index,))
+        thread.daemon = True
+        thread.start()
+
+    def _poll(self, index):
+        domain, task_list, _ = self.task_lists[index]
+        layer1 = self.layer1_factory()
+        while not self.stopping.is_set():
+            with self.freed:
+                while (self.taken >= self.executors
+                       and not self.stopping.is_set()):
+                    self.freed.wait(1)
+            if self.stopping.is_set():
+                break
+            try:
+                response = layer1.poll_for_decision_task(
+                    domain, task_list, self.identity)
+            except SWFResponseError:
+                logger.exception('Error while polling for decisions:')
+                continue
+            with self.lock:
+                if not response.get('taskToken'):
+                    if self.pollers[index] > 1:
+                        # too many pollers for this task list
+                        self.pollers[index] -= 1
+                        return
+                    continue
+                if self.pollers[index] < self.max_pollers:
+                    self._add_poller(index)
+            with self.freed:
+                self.taken += 1
+            try:
+                context = decision_context(layer1, domain, task_list,
+                                           response, self.identity,
+                                           self.decision_budget)
+            except Exception:
+                logger.exception('Error while loading the decision:')
+                context = None
+            if context is None:
+                with self.freed:
+                    self.taken -= 1
+                    self.freed.notify_all()
+                continue
+            self.ready.put(index, context)
+        with self.lock:
+            self.pollers[index] -= 1
+
+
 def start_swf_workflow_worker(domain, task_list, layer1=None, reg_remote=True,
                               package=None, ignore=None, setup_log=True,
-                              identity=None, registry=None):
+                              identity=None, registry=None, manifest=None,
+                              reg_cache=None, decision_budget=None):
     """Start an endless single threaded/single process workflow worker loop.
 
     The worker polls endlessly for new decisions from the specified domain and
     task list and runs them.
 
     If no registry is passed, a new one is created and used to scan for
-    workflows. Package and ignore can be used to control the scanning.
+    workflows. Package and ignore can be used to control the scanning and a
+    manifest file path can be set to speed it up on later starts (see
+    WorkflowRegistry.scan).
 
     If reg_remote is set, all registered workflow are registered remotely.
+    A reg_cache file path can be set to skip the remote calls for the
+    workflows that were already registered (see
+    SWFWorkflowRegistry.register_remote).
 
     An identity can be set to track this worker in the SWF console, otherwise
     a default identity is generated from this machine domain and process pid.
 
+    If a decision_budget is set (a fraction, like 0.8), the decisions that
+    take longer than that fraction of their decision duration stop scheduling
+    new tasks and send the decisions already taken, so the workflow still
+    makes progress instead of timing out (see SWFContext).
+
     If setup_log is set, a default configuration for the logger is loaded.
 
     A custom SWF client can be passed in layer1, otherwise a default client is
@@ -677,24 +2243,474 @@ def start_swf_workflow_worker(domain, task_list, layer1=None, reg_remote=True,
         setup_default_logger()
     identity = identity if identity is not None else _default_identity()
     identity = str(identity)[:_IDENTITY_SIZE]
-    layer1 = layer1 if layer1 is not None else Layer1()
+    layer1_factory = None  # a custom client can only be used by one thread
+    if layer1 is None:
+        layer1, layer1_factory = Layer1(), Layer1
+    registry = _prepare_registry(layer1, [domain], registry, package, ignore,
+                                 manifest, reg_remote, reg_cache,
+                                 layer1_factory)
+    try:
+        while 1:
+            context = poll_next_decision(layer1, domain, task_list, identity,
+                                         decision_budget)
+            registry(context)  # execute the workflow
+    except KeyboardInterrupt:
+        pass
+
+
+def start_swf_workflow_supervisor(domain, task_list, workers=None,
+                                  layer1_factory=Layer1, reg_remote=True,
+                                  package=None, ignore=None, setup_log=True,
+                                  identity=None, registry=None, manifest=None,
+                                  reg_cache=None, max_decisions=None,
+                                  max_rss=None, decision_budget=None):
+    """Start a supervisor process that forks workflow worker processes.
+
+    The workflows are scanned and registered only once, in the supervisor,
+    and the workers are forked afterwards, sharing the loaded modules. See
+    flowy.supervisor for how the workers are managed.
+
+    The workers value is the number of worker processes, by default the
+    number of CPUs. A worker is recycled after max_decisions decisions or
+    when its resident memory exceeds max_rss megabytes.
+
+    The layer1_factory is used to create a SWF client in the supervisor, for
+    the remote registration, and one in each worker since the connections
+    can't be shared. The identity of each worker is suffixed with its pid.
+
+    The other arguments have the same meaning as for
+    start_swf_workflow_worker.
+    """
+    if setup_log:
+        setup_default_logger()
+    registry = _prepare_registry(layer1_factory(), [domain], registry,
+                                 package, ignore, manifest, reg_remote,
+                                 reg_cache, layer1_factory)
+
+    def worker_factory():
+        layer1 = layer1_factory()
+        w_identity = _default_identity()
+        if identity is not None:
+            w_identity = '%s-%s' % (identity, os.getpid())
+        w_identity = str(w_identity)[:_IDENTITY_SIZE]
+        poll = lambda: poll_next_decision(layer1, domain, task_list,
+                                          w_identity, decision_budget)
+        return poll, registry
+    Supervisor(worker_factory, workers, max_decisions, max_rss).run()
+
+
+def start_swf_multi_workflow_worker(task_lists, layer1_factory=Layer1,
+                                    reg_remote=True, package=None, ignore=None,
+                                    setup_log=True, identity=None,
+                                    registry=None, manifest=None,
+                                    reg_cache=None, max_pollers=4,
+                                    decision_budget=None, executors=1):
+    """Start a workflow worker for many task lists, until interrupted.
+
+    The task_lists is a list of (domain, task_list, weight) tuples, see
+    SWFWorkflowWorker. The workflows are registered in each domain and the
+    other arguments have the same meaning as for start_swf_workflow_worker.
+    """
+    if setup_log:
+        setup_default_logger()
+    domains = sorted(set(domain for domain, _, _ in task_lists))
+    registry = _prepare_registry(layer1_factory(), domains, registry, package,
+                                 ignore, manifest, reg_remote, reg_cache,
+                                 layer1_factory)
+    worker = SWFWorkflowWorker(task_lists, registry, layer1_factory, identity,
+                               max_pollers, decision_budget, executors)
+    worker.start()
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        pass
+
+
+def _prepare_registry(layer1, domains, registry, package, ignore, manifest,
+                      reg_remote, reg_cache, layer1_factory=None):
+    """Scan for workflows if needed and register them in each domain.
+
+    See SWFWorkflowRegistry.register_remote for the layer1_factory.
+    """
     if registry is None:
         registry = SWFWorkflowRegistry()
-        # Add an extra level when scanning because of this function
-        registry.scan(package=package, ignore=ignore, level=1)
+        # Add extra levels when scanning because of the calling functions
+        registry.scan(package=package, ignore=ignore, level=2,
+                      manifest=manifest)
     if reg_remote:
         try:
-            registry.register_remote(layer1, domain)
+            for domain in domains:
+                registry.register_remote(layer1, domain, cache=reg_cache,
+                                         layer1_factory=layer1_factory)
         except _RegistrationError:
             logger.exception('Not all workflows could be registered:')
             print('Not all workflows could be registered.', file=sys.stderr)
             sys.exit(1)
+    return registry
+
+
+# Each pool worker keeps the activity registry of its SWFActivityWorker here,
+# set by the pool initializer, along with the token of the running task.
+_local = threading.local()
+
+
+class _Pending(object):
+    """The type of the pending marker.
+
+    Return the pending marker from an activity to complete it later. The
+    activity task is not reported by the worker. Instead, its task token (see
+    task_token) must be used to complete it with SWFCompletionService, from
+    any process. The heartbeats stop once the activity returns, so the
+    heartbeat and start to close timeouts must be long enough for the
+    external completion.
+    """
+    def __repr__(self):
+        return 'pending'
+
+
+pending = _Pending()
+
+
+def task_token():
+    """Return the task token of the activity currently running.
+
+    Raise RuntimeError if called outside an activity.
+    """
+    token = getattr(_local, 'token', None)
+    if token is None:
+        raise RuntimeError('No activity is running.')
+    return token
+
+
+def _init_activities(registry):
+    _local.activities = registry
+
+
+def _run_activity(key, input_data, token=None):
+    # the exceptions may not be picklable so only the message is kept; the
+    # status is True on success, False on errors and None if pending
+    _local.token = token
     try:
+        result = _local.activities(key, input_data)
+    except Exception as e:
+        logger.exception('Error while running the activity:')
+        return False, str(e)
+    finally:
+        _local.token = None
+    if result is None:
+        return None, None
+    return True, result
+
+
+class _ActivityTask(object):
+    """The state of an activity task received by the worker."""
+    def __init__(self, token, heartbeat):
+        self.token = token
+        self.heartbeat = heartbeat
+        self.last_heartbeat = time.time()
+        self.cancel_requested = False
+
+
+class SWFActivityWorker(object):
+    """A multi-threaded activity worker.
+
+    A number of poller threads poll for activity tasks and run them on a
+    thread pool or, if processes is set, on a process pool of workers size
+    (the number of CPUs by default). At most workers tasks are polled at any
+    time so the tasks are not kept waiting for a free worker.
+
+    Another thread sends the heartbeats for the running tasks at half the
+    registered default heartbeat interval. The results are reported by the
+    reporter threads, that send all the results available at once.
+
+    Each thread uses its own SWF client, created by calling layer1_factory.
+    """
+    def __init__(self, domain, task_list, registry, layer1_factory=Layer1,
+                 identity=None, pollers=4, workers=None, processes=False,
+                 reporters=2):
+        self.domain = str(domain)
+        self.task_list = str(task_list)
+        self.registry = registry
+        self.layer1_factory = layer1_factory
+        identity = identity if identity is not None else _default_identity()
+        self.identity = str(identity)[:_IDENTITY_SIZE]
+        workers = workers if workers is not None else cpu_count()
+        pool_factory = Pool if processes else ThreadPool
+        self.pool = pool_factory(workers, _init_activities, (registry,))
+        self.slots = threading.Semaphore(workers)
+        self.completions = Queue()
+        self.tasks = {}  # token -> _ActivityTask
+        self.tasks_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.pollers = [threading.Thread(target=self._poll)
+                        for _ in range(pollers)]
+        self.threads = self.pollers + [
+            threading.Thread(target=self._report) for _ in range(reporters)]
+        self.threads.append(threading.Thread(target=self._heartbeat))
+        for thread in self.threads:
+            thread.daemon = True
+
+    def start(self):
+        """Start the worker threads."""
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        """Stop polling and wait for the running tasks to be reported.
+
+        The polls in progress are not interrupted and any tasks they return
+        are run too.
+        """
+        self.stopping.set()
+        for thread in self.pollers:
+            thread.join()
         while 1:
-            context = poll_next_decision(layer1, domain, task_list, identity)
-            registry(context)  # execute the workflow
+            with self.tasks_lock:
+                if not self.tasks:
+                    break
+            time.sleep(0.1)
+        self.pool.close()
+        self.pool.join()
+        for thread in self.threads:
+            thread.join()
+
+    def _stopped(self):
+        # the reporters and the heartbeats are needed until the last task
+        with self.tasks_lock:
+            return self.stopping.is_set() and not self.tasks
+
+    def _poll(self):
+        layer1 = self.layer1_factory()
+        while not self.stopping.is_set():
+            self.slots.acquire()
+            try:
+                response = layer1.poll_for_activity_task(
+                    self.domain, self.task_list, self.identity)
+            except SWFResponseError:
+                logger.exception('Error while polling for activities:')
+                self.slots.release()
+                continue
+            token = response.get('taskToken')
+            if not token:
+                self.slots.release()
+                continue
+            a_type = response['activityType']
+            key = str(a_type['name']), str(a_type['version'])
+            activity = self.registry.registry.get(key)
+            heartbeat = activity.heartbeat if activity is not None else None
+            with self.tasks_lock:
+                self.tasks[token] = _ActivityTask(token, heartbeat)
+            callback = lambda r, t=token: self.completions.put((t, r))
+            self.pool.apply_async(_run_activity,
+                                  (key, response.get('input', ''), token),
+                                  callback=callback)
+
+    def _report(self):
+        layer1 = self.layer1_factory()
+        while 1:
+            try:
+                batch = [self.completions.get(timeout=1)]
+            except Empty:
+                if self._stopped():
+                    return
+                continue
+            try:
+                while 1:
+                    batch.append(self.completions.get_nowait())
+            except Empty:
+                pass
+            for token, (ok, value) in batch:
+                with self.tasks_lock:
+                    task = self.tasks.get(token)
+                try:
+                    if ok is None:
+                        pass  # it will be completed with the task token
+                    elif task is not None and task.cancel_requested:
+                        layer1.respond_activity_task_canceled(token)
+                    elif ok:
+                        layer1.respond_activity_task_completed(
+                            token, result=value[:_RESULT_SIZE])
+                    else:
+                        layer1.respond_activity_task_failed(
+                            token, reason=value[:_REASON_SIZE])
+                except SWFResponseError:
+                    logger.exception('Error while reporting the activity:')
+                with self.tasks_lock:
+                    self.tasks.pop(token, None)
+                self.slots.release()
+
+    def _heartbeat(self):
+        layer1 = self.layer1_factory()
+        while not self._stopped():
+            time.sleep(1)
+            now = time.time()
+            with self.tasks_lock:
+                due = [task for task in self.tasks.values()
+                       if task.heartbeat is not None
+                       and now - task.last_heartbeat >= task.heartbeat / 2.0]
+            for task in due:
+                task.last_heartbeat = now
+                try:
+                    response = layer1.record_activity_task_heartbeat(
+                        task.token)
+                except SWFResponseError:
+                    logger.exception('Error while sending the heartbeat:')
+                    continue
+                if response.get('cancelRequested'):
+                    task.cancel_requested = True
+
+
+def start_swf_activity_worker(domain, task_list, layer1_factory=Layer1,
+                              reg_remote=True, package=None, ignore=None,
+                              setup_log=True, identity=None, registry=None,
+                              manifest=None, pollers=4, workers=None,
+                              processes=False, reporters=2):
+    """Start an activity worker that runs until interrupted.
+
+    If no registry is passed, a new one is created and used to scan for
+    activities, see start_swf_workflow_worker for the scanning and remote
+    registration arguments. See SWFActivityWorker for the others.
+    """
+    if setup_log:
+        setup_default_logger()
+    if registry is None:
+        registry = SWFActivityRegistry()
+        # Add an extra level when scanning because of this function
+        registry.scan(package=package, ignore=ignore, level=1,
+                      manifest=manifest)
+    if reg_remote:
+        try:
+            registry.register_remote(layer1_factory(), domain)
+        except _RegistrationError:
+            logger.exception('Not all activities could be registered:')
+            print('Not all activities could be registered.', file=sys.stderr)
+            sys.exit(1)
+    worker = SWFActivityWorker(domain, task_list, registry, layer1_factory,
+                               identity, pollers, workers, processes,
+                               reporters)
+    worker.start()
+    try:
+        while 1:
+            time.sleep(3600)
     except KeyboardInterrupt:
-        pass
+        worker.stop()
+
+
+class SWFCompletionService(object):
+    """Complete activity tasks by their task tokens.
+
+    The completions are saved in a SQLite outbox, sent in batches and retried
+    with exponential backoff on errors, up to max_attempts times (or forever
+    if it's None). If the outbox is a file, the completions that were not sent
+    survive restarts and it can be shared between processes. The completions
+    of tasks that are already closed (timed out, for example) are dropped.
+
+    Call flush to send the completions or start a background thread that
+    does it every interval seconds.
+    """
+    def __init__(self, layer1=None, outbox=':memory:', batch_size=100,
+                 interval=1, max_attempts=None,
+                 serialize_result=_serialize_result):
+        self.layer1 = layer1 if layer1 is not None else Layer1()
+        self.db = sqlite3.connect(outbox, check_same_thread=False,
+                                  timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS outbox ('
+                        ' id INTEGER PRIMARY KEY, token TEXT, ok INTEGER,'
+                        ' value TEXT, attempts INTEGER, send_at REAL)')
+        self.db.commit()
+        self.lock = threading.Lock()
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.serialize_result = serialize_result
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def complete(self, token, result):
+        """Complete the activity task with a result."""
+        value = str(self.serialize_result(result))[:_RESULT_SIZE]
+        self._add(token, True, value)
+
+    def fail(self, token, reason):
+        """Fail the activity task with a reason."""
+        self._add(token, False, str(reason)[:_REASON_SIZE])
+
+    def _add(self, token, ok, value):
+        with self.lock:
+            self.db.execute('INSERT INTO outbox (token, ok, value, attempts,'
+                            ' send_at) VALUES (?, ?, ?, 0, 0)',
+                            (str(token), ok, value))
+            self.db.commit()
+
+    def flush(self):
+        """Send all the completions that are due; return how many were sent.
+
+        The ones that fail are retried later, on another flush.
+        """
+        sent = 0
+        while 1:
+            with self.lock:
+                batch = self.db.execute(
+                    'SELECT id, token, ok, value, attempts FROM outbox'
+                    ' WHERE send_at <= ? ORDER BY id LIMIT ?',
+                    (time.time(), self.batch_size)).fetchall()
+            if not batch:
+                return sent
+            done, retries = [], []
+            for row_id, token, ok, value, attempts in batch:
+                try:
+                    if ok:
+                        self.layer1.respond_activity_task_completed(
+                            str(token), result=value)
+                    else:
+                        self.layer1.respond_activity_task_failed(
+                            str(token), reason=value)
+                    sent += 1
+                    done.append(row_id)
+                except Exception as e:
+                    if _is_unknown_resource(e):
+                        logger.warning('Dropping the completion of a closed'
+                                       ' activity task.')
+                        done.append(row_id)
+                        continue
+                    attempts += 1
+                    if (self.max_attempts is not None
+                            and attempts >= self.max_attempts):
+                        logger.exception('Dropping the completion after %s'
+                                         ' attempts:', attempts)
+                        done.append(row_id)
+                        continue
+                    logger.exception('Error while completing the activity:')
+                    delay = min(2 ** attempts, 300)
+                    retries.append((attempts, time.time() + delay, row_id))
+            with self.lock:
+                self.db.executemany('DELETE FROM outbox WHERE id = ?',
+                                    [(row_id,) for row_id in done])
+                self.db.executemany('UPDATE outbox SET attempts = ?,'
+                                    ' send_at = ? WHERE id = ?', retries)
+                self.db.commit()
+
+    def start(self):
+        """Start flushing in a background thread."""
+        def run():
+            while not self.stopping.wait(self.interval):
+                self.flush()
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background thread and try to send the rest."""
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+
+def _is_unknown_resource(err):
+    body = getattr(err, 'body', None)
+    return (isinstance(err, SWFResponseError) and isinstance(body, dict)
+            and body.get('__type', '').endswith('#UnknownResourceFault'))
 
 
 class SWFWorkflowStarter(object):
@@ -737,6 +2753,53 @@ class SWFWorkflowStarter(object):
         return really_start
 
 
+def _registered_workflow_types(layer1, domain):
+    """Return the set of all registered workflow types names and versions.
+
+    Listing errors are logged and an empty set is returned, making all the
+    workflows look as if they are not registered yet.
+    """
+    registered = set()
+    next_page_token = None
+    try:
+        while 1:
+            response = layer1.list_workflow_types(
+                domain, 'REGISTERED', maximum_page_size=1000,
+                next_page_token=next_page_token)
+            for type_info in response['typeInfos']:
+                w_type = type_info['workflowType']
+                registered.add((str(w_type['name']), str(w_type['version'])))
+            next_page_token = response.get('nextPageToken')
+            if not next_page_token:
+                return registered
+    except SWFResponseError:
+        logger.exception('Error while listing the workflow types:')
+        return set()
+
+
+def _load_registration_cache(path, domain):
+    """Return the set of the verified config values for a domain."""
+    if path is None:
+        return set()
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return set()
+    return set(tuple(_str_or_none(v) for v in values)
+               for values in cache.get(domain, []))
+
+
+def _save_registration_cache(path, domain, verified):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {}
+    cache[domain] = sorted(verified)
+    write_json(path, cache)
+
+
 def _default_identity():
     """Generate a local identity for this process."""
     identity = "%s-%s" % (socket.getfqdn(), os.getpid())
@@ -755,6 +2818,19 @@ def _subworkflow_id(workflow_id):
     return workflow_id.rsplit('-', 1)[-1]
 
 
+def _chunk_keys(call_keys, size=_CONTROL_SIZE):
+    """Split the call keys in JSON lists that fit in size characters."""
+    chunk, length = [], 2
+    for call_key in call_keys:
+        if chunk and length + len(call_key) + 4 > size:
+            yield json.dumps(chunk)
+            chunk, length = [], 2
+        chunk.append(call_key)
+        length += len(call_key) + 4  # quotes, comma and space
+    if chunk:
+        yield json.dumps(chunk)
+
+
 def _timer_key(call_key):
     return '%s:t' % call_key
 
@@ -764,6 +2840,83 @@ def _timer_call_key(timer_key):
     return timer_key[:-2]
 
 
+def _batches(items, size):
+    """Split the (call key, input) items in batches of up to size items
+    that fit in the activity input and marker details fields and whose
+    outcomes can fit in the result, see SWFBatchActivity."""
+    call_keys, inputs = [], []
+    input_length = details_length = 2
+    for call_key, input_data in items:
+        # the quotes and escapes, the comma and the space
+        item_length = len(json.dumps(input_data)) + 2
+        key_length = len(json.dumps(call_key)) + 2
+        if inputs and (len(inputs) == size or len(inputs) == _BATCH_SIZE
+                       or input_length + item_length > _INPUT_SIZE
+                       or details_length + key_length > _DETAILS_SIZE):
+            yield call_keys, inputs
+            call_keys, inputs = [], []
+            input_length = details_length = 2
+        call_keys.append(call_key)
+        inputs.append(input_data)
+        input_length += item_length
+        details_length += key_length
+    if inputs:
+        yield call_keys, inputs
+
+
+def _batch_outcomes(result, count):
+    """Load the outcomes of a batch or, if the result is invalid, an error
+    for each call."""
+    try:
+        outcomes = json.loads(result)
+        if len(outcomes) != count:
+            raise ValueError('Expected %s outcomes, got %s.'
+                             % (count, len(outcomes)))
+        for outcome, _ in outcomes:
+            if outcome not in ('result', 'error'):
+                raise ValueError('Invalid outcome: %r' % (outcome,))
+    except (TypeError, ValueError) as e:
+        logger.error('Invalid batch result: %s', e)
+        reason = ('Invalid batch result: %s' % e)[:_REASON_SIZE]
+        return [('error', reason)] * count
+    return outcomes
+
+
+def _batch_name(name):
+    return '%s-batch' % name
+
+
+def _batch_key(call_key):
+    return '%s:b' % call_key
+
+
+def _is_batch(activity_id):
+    return activity_id.endswith(':b')
+
+
+def _hedge_key(call_key):
+    return '%s:h' % call_key
+
+
+def _hedge_call_key(activity_id):
+    if activity_id.endswith(':h'):
+        return activity_id[:-2]
+    return activity_id
+
+
+def _is_hedge_timer(timer_key):
+    return timer_key.endswith(':h:t')
+
+
+def _local_key(call_key):
+    return '%s:l' % call_key
+
+
+def _local_call_key(local_key):
+    assert local_key.endswith(':l')
+    return local_key[:-2]
+
+
 def _subworkflow_key(call_key):
     return '%s:%s' % (uuid.uuid4(), call_key)
 
@@ -787,6 +2940,10 @@ def _str_or_none(val):
     return str(val)
 
 
+def _first_set(val, default):
+    return val if val is not None else default
+
+
 def _tags(tags):
     if tags is None:
         return None
@@ -1,19 +1,26 @@
 import itertools
+import json
 import logging
+import os
 import sys
+import tempfile
+import time
+import zlib
 from collections import namedtuple
 from functools import partial
 from keyword import iskeyword
 
 import venusian
 
-__all__ = 'restart TaskError TaskTimedout wait_first wait_n wait_all'.split()
+__all__ = ('restart TaskError TaskTimedout wait_first wait_n wait_all'
+           ' RetryPolicy').split()
 
 
 logger = logging.getLogger(__package__)
 
 
 _identity = lambda x: x
+_no_value = object()
 _serialize_args = lambda *args, **kwargs: (args, kwargs)
 
 
@@ -57,6 +64,15 @@ class WorkflowConfig(object):
         if dep_name in self.proxy_factory_registry:
             raise ValueError('Dependency name is already registered: %r' % dep_name)
 
+    def needs_checkpoint(self, context):
+        """Test if the workflow running in context should be restarted.
+
+        This is consulted each time the workflow is suspended and, if it
+        returns True, the workflow checkpoint method is used to restart the
+        workflow as a new execution. By default this never happens.
+        """
+        return False
+
     def conf(self, dep_name, proxy_factory):
         """Configure a proxy factory for a dependency."""
         self._check_dep(dep_name)
@@ -137,20 +153,16 @@ class Workflow(object):
         try:
             result = workflow.run(*args, **kwargs)
         except SuspendTask:
-            context.flush()
+            if conf.needs_checkpoint(context):
+                self.checkpoint(workflow, context)
+            else:
+                context.flush()
         except Exception as e:
             logger.exception('Error while running:')
             context.fail(e)
         else:
             if isinstance(result, _restart):
-                sri = getattr(conf, 'serialize_restart_input', _identity)
-                try:
-                    input_data = sri(*result.args, **result.kwargs)
-                except Exception as e:
-                    logger.exception('Error while serializing restart arguments:')
-                    context.fail(e)
-                else:
-                    context.restart(input_data)
+                self.restart(result, context)
             else:
                 serialize_result = getattr(conf, 'serialize_result', _identity)
                 try:
@@ -161,6 +173,51 @@ class Workflow(object):
                 else:
                     context.finish(result)
 
+    def checkpoint(self, workflow, context):
+        """Restart the workflow with the arguments returned by its checkpoint.
+
+        This is called instead of flushing the decisions when the config
+        decides the execution history got too big. The workflow instance can
+        define a checkpoint method that returns a restart instance with the
+        arguments needed to resume the work in a new execution. If there is no
+        such method or it returns None, the decisions are flushed as usual.
+        """
+        checkpoint = getattr(workflow, 'checkpoint', None)
+        if checkpoint is None:
+            logger.warning('History limits exceeded but %r has no checkpoint'
+                           ' method.', self.workflow_factory)
+            context.flush()
+            return
+        try:
+            result = checkpoint()
+        except SuspendTask:
+            context.flush()
+            return
+        except Exception as e:
+            logger.exception('Error while running the checkpoint:')
+            context.fail(e)
+            return
+        if result is None:
+            context.flush()
+        elif not isinstance(result, _restart):
+            err = TypeError('The checkpoint must return a restart instance'
+                            ' or None: %r' % (result,))
+            logger.error(str(err))
+            context.fail(err)
+        else:
+            self.restart(result, context)
+
+    def restart(self, result, context):
+        """Serialize the restart arguments and restart the workflow."""
+        sri = getattr(self.config, 'serialize_restart_input', _identity)
+        try:
+            input_data = sri(*result.args, **result.kwargs)
+        except Exception as e:
+            logger.exception('Error while serializing restart arguments:')
+            context.fail(e)
+        else:
+            context.restart(input_data)
+
     def __repr__(self):
         klass = self.__class__.__name__
         return "<%s %r %r>" % (klass, self.config, self.workflow_factory)
@@ -203,7 +260,7 @@ class WorkflowRegistry(object):
             raise ValueError('No workflow implementation found: %r' % key)
         workflow.run(context)
 
-    def scan(self, package=None, ignore=None, level=0):
+    def scan(self, package=None, ignore=None, level=0, manifest=None):
         """Scan for registered workflows and their configuration.
 
         Use venusian to scan. By default it will scan the package of the scan
@@ -221,11 +278,85 @@ class WorkflowRegistry(object):
 
             # ... and later, in another package
             reg = scan()
+
+        If a manifest file path is set, the modules and attributes of the
+        registered workflows found by a full scan are saved in it. Later scans
+        import only those modules, as long as no source file in the package
+        was added, removed or modified since. Otherwise the manifest is stale
+        and a full scan is done instead, writing a new manifest. For the
+        manifest to be reused, the ignore values should be strings.
         """
-        scanner = venusian.Scanner(register=self.register)
         if package is None:
             package = _caller_package(level=2 + level)
+        if manifest is None:
+            scanner = venusian.Scanner(register=self.register)
+            scanner.scan(package, categories=self.categories, ignore=ignore)
+            return
+        start = time.time()
+        key = {
+            'package': package.__name__,
+            'categories': sorted(self.categories),
+            'ignore': repr(ignore),
+            'sources': _package_sources(package),
+        }
+        registrations = _load_manifest(manifest, key)
+        if registrations is not None:
+            registry = dict(self.registry)
+            try:
+                self._scan_registrations(registrations)
+            except _StaleManifest:
+                logger.warning('The scan manifest %s is stale, falling back'
+                               ' to a full scan.', manifest)
+                self.registry = registry
+            else:
+                logger.info('Loaded %s workflows from %s in %.3fs.',
+                            len(registrations), manifest, time.time() - start)
+                return
+        registrations = []
+
+        def register(config, workflow_factory):
+            self.register(config, workflow_factory)
+            registrations.append([workflow_factory.__module__,
+                                  workflow_factory.__name__])
+        scanner = venusian.Scanner(register=register)
         scanner.scan(package, categories=self.categories, ignore=ignore)
+        logger.info('Scanned %s workflows from %s in %.3fs.',
+                    len(registrations), package.__name__, time.time() - start)
+        try:
+            _save_manifest(manifest, key, sorted(registrations))
+        except (IOError, OSError):
+            logger.exception('Cannot save the scan manifest:')
+
+    def _scan_registrations(self, registrations):
+        """Import and scan only the modules with registered workflows.
+
+        Raise _StaleManifest if the registrations found are different.
+        """
+        modules = {}
+        for module_name, attr in registrations:
+            modules.setdefault(module_name, set()).add(attr)
+        found = []
+
+        def register(config, workflow_factory):
+            self.register(config, workflow_factory)
+            found.append([workflow_factory.__module__,
+                          workflow_factory.__name__])
+        scanner = venusian.Scanner(register=register)
+        for module_name, attrs in sorted(modules.items()):
+            start = time.time()
+            try:
+                __import__(module_name)
+            except ImportError:
+                raise _StaleManifest()
+            module = sys.modules[module_name]
+            logger.debug('Imported %s in %.3fs.', module_name,
+                         time.time() - start)
+            # only look at the registered attributes, no submodules
+            wanted = set('%s.%s' % (module_name, attr) for attr in attrs)
+            scanner.scan(module, categories=self.categories,
+                         ignore=lambda name: name not in wanted)
+        if sorted(found) != sorted(registrations):
+            raise _StaleManifest()
 
     def __repr__(self):
         klass = self.__class__.__name__
@@ -252,6 +383,86 @@ class DescCounter(object):
         return next(self.iterator)
 
 
+class RetryPolicy(object):
+    """Decide when and how many times a task is retried.
+
+    A policy can be used instead of the retry tuples when configuring the
+    dependencies:
+
+        cfg.conf_activity('a', version=1, retry=RetryPolicy(
+            max_attempts=5, delay=2, max_elapsed=600,
+            retry_on=lambda reason: 'Throttling' in reason))
+
+    At most max_attempts attempts are made. The first attempt starts right
+    away and the retry n waits for delay * backoff ** (n - 1) seconds, but no
+    more than max_delay. A random part of each delay, up to the jitter
+    fraction, is removed so that the tasks that failed together don't retry
+    together. The random values are derived from the call keys so the delays
+    are the same each time the workflow is replayed.
+
+    The timed out tasks are always retried. The failed tasks are retried only
+    if retry_on is set and returns True for the error reason. No more retries
+    are made once max_elapsed seconds passed since the first attempt was
+    scheduled, if the backend knows when the tasks were scheduled and closed.
+    """
+    def __init__(self, max_attempts=3, delay=1, backoff=2, max_delay=3600,
+                 jitter=0.5, max_elapsed=None, retry_on=None):
+        if max_attempts < 1:
+            raise ValueError('At least one attempt is needed: %r'
+                             % max_attempts)
+        if not 0 <= jitter <= 1:
+            raise ValueError('The jitter must be between 0 and 1: %r' % jitter)
+        self.max_attempts = max_attempts
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.max_elapsed = max_elapsed
+        self.retry_on = retry_on
+
+    def attempt_delay(self, attempt, call_key):
+        """Return the delay of an attempt in seconds or None if there is no
+        such attempt.
+
+        The call_key is the key of the first attempt, used as a random seed.
+        """
+        if attempt >= self.max_attempts:
+            return None
+        if attempt == 0:
+            return 0
+        delay = min(self.delay * self.backoff ** (attempt - 1), self.max_delay)
+        seed = zlib.crc32(('%s-%s' % (call_key, attempt)).encode('utf-8'))
+        delay *= 1 - self.jitter * ((seed & 0xffffffff) / float(2 ** 32))
+        return int(round(delay))
+
+    def retry_error(self, reason):
+        """Test if a task that failed with this reason should be retried."""
+        return self.retry_on is not None and bool(self.retry_on(reason))
+
+    def __repr__(self):
+        return '<%s max_attempts=%s>' % (self.__class__.__name__,
+                                         self.max_attempts)
+
+
+class _RetryDelays(RetryPolicy):
+    """The policy used for the retry tuples: one attempt for each delay,
+    only the timed out tasks are retried."""
+    def __init__(self, delays):
+        super(_RetryDelays, self).__init__(max(len(delays), 1), jitter=0)
+        self.delays = list(delays) or [0]
+
+    def attempt_delay(self, attempt, call_key):
+        if attempt >= len(self.delays):
+            return None
+        return self.delays[attempt]
+
+
+def _retry_policy(retry):
+    if isinstance(retry, RetryPolicy):
+        return retry
+    return _RetryDelays(retry)
+
+
 class ContextBoundProxy(object):
     """A proxy bound to a context.
 
@@ -264,9 +475,15 @@ class ContextBoundProxy(object):
         self.context = context
         self.rate_limit = rate_limit
         self.call_number = 0
+        # Looked up once, not on every call
+        self.policy = _retry_policy(getattr(proxy, 'retry', [0]))
+        self.load_result = partial(
+            _load_result, getattr(proxy, 'deserialize_result', _identity))
+        self.key_format = '%s-%%d-%%d' % proxy.identity.replace('%', '%%')
+        self.resolved = {}  # see _short_circuit_on_args
 
     def _call_key(self, retry_number):
-        r = "%s-%s-%s" % (self.proxy.identity, self.call_number, retry_number)
+        r = self.key_format % (self.call_number, retry_number)
         self.call_number += 1
         return r
 
@@ -277,6 +494,10 @@ class ContextBoundProxy(object):
         When calling it, the task it refers to can be in one of the following
         states: RUNNING, READY, FAILED, TIMEDOUT or NOTSCHEDULED.
 
+        Each attempt has its own state. If an attempt TIMEDOUT or FAILED and
+        the retry policy allows it (see RetryPolicy), the next attempt is
+        considered instead.
+
         * If the task is RUNNING this returns a Placeholder. The Placeholder
           interrupts the workflow execution if its result is accessed by
           raising a SuspendTask exception.
@@ -294,16 +515,31 @@ class ContextBoundProxy(object):
               another error.
             * If any placeholders in arguments, don't do anything because there
               are unresolved dependencies.
+            * The results nested in lists, tuples, sets and dicts arguments
+              count too; they are replaced by their values when scheduling.
+            * If the context is over its time budget, raise SuspendTask to
+              stop the workflow and send the decisions taken so far.
             * Finally, if all the arguments look OK, extract the values from
               any result objects that might be in the arguments and schedule it
               for execution.
         """
         context = self.context
-        result = Placeholder()
-        retry = getattr(self.proxy, 'retry', [0])
-        for retry_number, delay in enumerate(retry):
-            call_key = self._call_key(retry_number)
+        result = _placeholder
+        policy = self.policy
+        retry_number = 0
+        call_key = first_key = self._call_key(retry_number)
+        delay = policy.attempt_delay(retry_number, first_key)
+        while 1:
             if context.is_timeout(call_key):
+                retry_delay = self._retry_delay(policy, retry_number,
+                                                first_key, call_key)
+                if retry_delay is None:
+                    # No retries left
+                    result = Timeout(context.timeout(call_key))
+                    break
+                retry_number += 1
+                call_key = self._call_key(retry_number)
+                delay = retry_delay
                 continue
             if context.is_running(call_key):
                 break
@@ -311,18 +547,30 @@ class ContextBoundProxy(object):
                 value, order = context.result(call_key)
                 # Make the result deserialization lazy; in case of
                 # deserialization errors the result will fail the workflow
-                d_r = getattr(self.proxy, 'deserialize_result', _identity)
-                d_r = partial(d_r, value)
-                result = Result(context, d_r, order)
+                result = Result(context, self.load_result, order, value)
                 break
             if context.is_error(call_key):
                 err, order = context.error(call_key)
-                result = Error(err, order)
-                break
-            errors, placeholders = _short_circuit_on_args(args, kwargs)
+                retry_delay = None
+                if policy.retry_error(err):
+                    retry_delay = self._retry_delay(policy, retry_number,
+                                                    first_key, call_key)
+                if retry_delay is None:
+                    result = Error(err, order)
+                    break
+                retry_number += 1
+                call_key = self._call_key(retry_number)
+                delay = retry_delay
+                continue
+            errors, placeholders = _short_circuit_on_args(args, kwargs,
+                                                          self.resolved)
             if errors:
                 result = wait_first(errors)
             elif not placeholders:
+                if context.over_budget():
+                    # Not enough time is left in this decision, send the
+                    # decisions taken so far and continue in a new one
+                    raise SuspendTask()
                 if not self.rate_limit.consume():
                     # Enough tasks have been scheduled for this decision
                     break
@@ -346,20 +594,38 @@ class ContextBoundProxy(object):
                     # workflow and pretend the task is running
                     logger.exception('Cannot schedule task:')
                     context.fail(e)
+                else:
+                    if (context.is_result(call_key)
+                            or context.is_error(call_key)
+                            or context.is_timeout(call_key)):
+                        # The task finished while being scheduled, like the
+                        # local activities do
+                        continue
             break
-        else:
-            # No retries left, it must be a timeout
-            order = context.timeout(call_key)
-            result = Timeout(order)
         return result
 
+    def _retry_delay(self, policy, retry_number, first_key, call_key):
+        """The delay of the next attempt or None if it shouldn't be made."""
+        delay = policy.attempt_delay(retry_number + 1, first_key)
+        if delay is None or policy.max_elapsed is None:
+            return delay
+        elapsed = self.context.elapsed(first_key, call_key)
+        if elapsed is not None and elapsed + delay > policy.max_elapsed:
+            return None
+        return delay
+
     def __repr__(self):
         klass = self.__class__.__name__
         return "<%s %r %r>" % (klass, self.context, self.proxy)
 
 
 class TaskResult(object):
-    """Base class for all different types of task results."""
+    """Base class for all different types of task results.
+
+    The results are created for every proxy call on every replay, so the
+    classes here use __slots__ to keep them small and cheap to create.
+    """
+    __slots__ = ()
     _order = None
 
     def __lt__(self, other):
@@ -402,16 +668,26 @@ class Result(TaskResult):
     SuspendTask) this doesn't guarantee that .result() call won't block.
     Actually, if the result can't be deserialized this class will act as if
     it's a placeholder when calling .result().
+
+    The lazy_result is called with the value, if one is set, or with no
+    arguments otherwise.
     """
-    def __init__(self, context, lazy_result, order):
+    __slots__ = ('_context', '_lazy_result', '_order', '_value',
+                 '_result_cache')
+
+    def __init__(self, context, lazy_result, order, value=_no_value):
         self._context = context
         self._lazy_result = lazy_result
         self._order = order
+        self._value = value
 
     def result(self):
         if not hasattr(self, '_result_cache'):
             try:
-                self._result_cache = self._lazy_result()
+                if self._value is _no_value:
+                    self._result_cache = self._lazy_result()
+                else:
+                    self._result_cache = self._lazy_result(self._value)
             except Exception as e:
                 logger.exception('Error while deserializing result:')
                 self._result_cache = e
@@ -427,6 +703,8 @@ class Result(TaskResult):
 
 
 class Error(Result):
+    __slots__ = ('_err',)
+
     def __init__(self, err, order):
         self._err = err
         self._order = order
@@ -439,6 +717,8 @@ class Error(Result):
 
 
 class Timeout(Error):
+    __slots__ = ()
+
     def __init__(self, order):
         self._order = order
 
@@ -447,6 +727,8 @@ class Timeout(Error):
 
 
 class Placeholder(TaskResult):
+    __slots__ = ()
+
     def result(self):
         raise SuspendTask
 
@@ -457,6 +739,10 @@ class Placeholder(TaskResult):
         raise SuspendTask
 
 
+# Placeholders have no state, all the running tasks share this one
+_placeholder = Placeholder()
+
+
 def wait_first(result, *results):
     """Return the result of the first task to finish from a list of results.
 
@@ -509,17 +795,66 @@ class TaskTimedout(TaskError):
     """Raised by result when a task has timedout its execution."""
 
 
-def _short_circuit_on_args(a, kw):
-    args = a + tuple(kw.values())
-    errs, placeholders = [], False
-    for result in args:
-        if isinstance(result, TaskResult):
+_CONTAINERS = frozenset([list, tuple, set, frozenset, dict])
+_FROZEN = frozenset([tuple, frozenset])
+
+
+def _short_circuit_on_args(a, kw, resolved=None):
+    """Find the errors and test for placeholders in the arguments.
+
+    The results nested in lists, tuples, sets and dicts are found too. If a
+    resolved dict is passed, the tuples and frozensets found without
+    placeholders are saved in it, by id, and are not walked again. Only the
+    ones holding no mutable containers, at any depth, are saved: a list,
+    set or dict can be changed in place between calls so it's always walked.
+    The containers are kept in the dict so their ids can't be reused.
+    """
+    errs = []
+    placeholders = _scan_args(a, errs, resolved)
+    if kw and _scan_args(kw.itervalues(), errs, resolved):
+        placeholders = True
+    return errs, placeholders
+
+
+def _scan_args(values, errs, resolved):
+    placeholders = False
+    for value in values:
+        if isinstance(value, TaskResult):
             try:
-                if result.is_error():
-                    errs.append(result)
+                if value.is_error():
+                    errs.append(value)
             except SuspendTask:
                 placeholders = True
-    return errs, placeholders
+        elif type(value) in _CONTAINERS and value:
+            if _scan_container(value, errs, resolved):
+                placeholders = True
+    return placeholders
+
+
+def _scan_container(container, errs, resolved):
+    key = id(container)
+    if resolved is not None and key in resolved:
+        _, container_errs = resolved[key]
+        errs.extend(container_errs)
+        return False
+    container_errs = []
+    values = container
+    if type(container) is dict:
+        values = container.itervalues()
+    placeholders = _scan_args(values, container_errs, resolved)
+    if (not placeholders and resolved is not None
+            and type(container) in _FROZEN
+            and all(_is_frozen(value, resolved) for value in container)):
+        resolved[key] = container, container_errs
+    errs.extend(container_errs)
+    return placeholders
+
+
+def _is_frozen(value, resolved):
+    # the nested containers were saved already if they could be
+    if type(value) not in _CONTAINERS:
+        return True
+    return type(value) in _FROZEN and (not value or id(value) in resolved)
 
 
 def _extract_results(a, kw):
@@ -531,9 +866,23 @@ def _extract_results(a, kw):
 def _result_or_value(result):
     if isinstance(result, TaskResult):
         return result.result()
+    r_type = type(result)
+    if r_type is dict:
+        return dict((k, _result_or_value(v)) for k, v in result.iteritems())
+    if r_type in _CONTAINERS:
+        return r_type(_result_or_value(v) for v in result)
     return result
 
 
+def _load_result(deserialize_result, value):
+    # A backend can keep the large results out of memory and return views
+    # that are loaded only when the result is needed
+    load = getattr(value, 'load', None)
+    if load is not None:
+        value = load()
+    return deserialize_result(value)
+
+
 _restart = namedtuple('restart', 'args kwargs')
 def restart(*args, **kwargs):
     """Return an instance of this to restart a workflow with the new input."""
@@ -563,6 +912,60 @@ def setup_default_logger():
     })
 
 
+class _StaleManifest(Exception):
+    """The scan manifest doesn't match the source code."""
+
+
+def _package_sources(package):
+    """Map the source files of a package (or module) to their mtimes."""
+    if not hasattr(package, '__path__'):
+        path = os.path.splitext(package.__file__)[0] + '.py'
+        return {path: os.path.getmtime(path)}
+    sources = {}
+    for package_path in package.__path__:
+        for dir_path, dir_names, file_names in os.walk(package_path):
+            dir_names.sort()
+            for file_name in file_names:
+                if file_name.endswith('.py'):
+                    path = os.path.join(dir_path, file_name)
+                    sources[path] = os.path.getmtime(path)
+    return sources
+
+
+def _load_manifest(path, key):
+    """Return the manifest registrations or None if it's missing or stale."""
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if manifest.get('key') != key:
+        return None
+    return manifest['registrations']
+
+
+def _save_manifest(path, key, registrations):
+    write_json(path, {'key': key, 'registrations': registrations})
+
+
+def write_json(path, value):
+    """Write the value in a JSON file atomically.
+
+    The value is written in a temporary file next to path which is then
+    renamed over it, so concurrent workers reading the file never see a
+    partial write. Used for the scan manifest and the registration cache.
+    """
+    dir_name = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(value, f)
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
 # Stolen from Pyramid
 def _caller_module(level=2, sys=sys):
     module_globals = sys._getframe(level).f_globals
@@ -0,0 +1,187 @@
+"""Declarative workflows, described as graphs of tasks.
+
+Instead of a workflow class with a run method, a DAG lists its tasks once.
+Each task is a call of one of the config dependencies and its arguments can
+be the results of other tasks (nested in lists, tuples, sets and dicts too)
+or the workflow input:
+
+    cfg = SWFWorkflowConfig(1)
+    cfg.conf_activity('fetch', 1)
+    cfg.conf_activity('merge', 1)
+
+    pipeline = DAG('Pipeline')
+    first = pipeline.task('fetch', pipeline.input(0))
+    second = pipeline.task('fetch', pipeline.input('url'))
+    pipeline.output(pipeline.task('merge', [first, second]))
+    cfg(pipeline)  # or registry.register(cfg, pipeline)
+
+A DAG can be used wherever a workflow factory is expected. On each decision
+the tasks are visited starting from the roots and the dependents of a task
+are only visited once the task finished, so the work done by a decision
+grows with the number of finished tasks and the tasks ready to run, not with
+the size of the graph. A task call key depends only on its position among
+the calls of the same dependency, as if the calls were made in the order the
+tasks were added.
+"""
+
+from collections import deque
+
+from flowy.base import ContextBoundProxy
+from flowy.base import Placeholder
+from flowy.base import SuspendTask
+from flowy.base import _CONTAINERS
+from flowy.base import _placeholder
+from flowy.base import _result_or_value
+
+
+__all__ = ['DAG']
+
+
+class Input(object):
+    """A reference to a workflow input argument, by position or name."""
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __repr__(self):
+        return '<Input %r>' % (self.key,)
+
+
+class Task(object):
+    """A task in a DAG, see DAG.task."""
+    __slots__ = ('dep_name', 'number', 'args', 'kwargs', 'deps', 'dependents')
+
+    def __init__(self, dep_name, number, args, kwargs, deps):
+        self.dep_name = dep_name
+        self.number = number
+        self.args = args
+        self.kwargs = kwargs
+        self.deps = deps
+        self.dependents = []
+
+    def __repr__(self):
+        return '<Task %s-%s>' % (self.dep_name, self.number)
+
+
+class DAG(object):
+    """A workflow factory running a graph of tasks.
+
+    The name is used as the workflow name, like a workflow class __name__.
+    """
+    def __init__(self, name='DAG'):
+        self.__name__ = name
+        self.tasks = []
+        self.roots = []
+        self.calls = {}  # dependency name -> number of tasks
+        self.result = None
+        self._owned = set()
+
+    def input(self, key):
+        """Refer to a positional (int key) or keyword input argument."""
+        return Input(key)
+
+    def task(self, dep_name, *args, **kwargs):
+        """Add a call of the dep_name dependency and return its task.
+
+        The tasks in the arguments become the dependencies of the new task.
+        """
+        deps = []
+        _find_tasks((args, kwargs), deps, set())
+        for dep in deps:
+            if dep not in self._owned:
+                raise ValueError('The task is not in this DAG: %r' % dep)
+        number = self.calls.get(dep_name, 0)
+        self.calls[dep_name] = number + 1
+        task = Task(dep_name, number, args, kwargs, deps)
+        for dep in deps:
+            dep.dependents.append(task)
+        if not deps:
+            self.roots.append(task)
+        self.tasks.append(task)
+        self._owned.add(task)
+        return task
+
+    def output(self, result):
+        """Set the workflow result: a task or a container of tasks.
+
+        Without an output, the workflow finishes with None once all its
+        tasks finished.
+        """
+        self.result = result
+
+    def __call__(self, **proxies):
+        return _DAGRun(self, proxies)
+
+    def __repr__(self):
+        return '<DAG %s tasks=%s>' % (self.__name__, len(self.tasks))
+
+
+class _DAGRun(object):
+    """A DAG bound to the proxies of a decision."""
+    def __init__(self, dag, proxies):
+        self.dag = dag
+        self.proxies = proxies
+
+    def run(self, *args, **kwargs):
+        dag = self.dag
+        inputs = args, kwargs
+        results = {}  # task -> TaskResult
+        waiting = {}  # task -> number of unfinished dependencies
+        finished = 0
+        ready = deque(dag.roots)
+        while ready:
+            task = ready.popleft()
+            proxy = self.proxies.get(task.dep_name)
+            if not isinstance(proxy, ContextBoundProxy):
+                raise ValueError('Not a task dependency: %r' % task.dep_name)
+            # the call key must not depend on the tasks visited before
+            proxy.call_number = task.number
+            result = proxy(*_resolve(task.args, results, inputs),
+                           **_resolve(task.kwargs, results, inputs))
+            results[task] = result
+            if isinstance(result, Placeholder):
+                continue
+            finished += 1
+            for dependent in task.dependents:
+                count = waiting.get(dependent, len(dependent.deps)) - 1
+                waiting[dependent] = count
+                if not count:
+                    ready.append(dependent)
+        if dag.result is None:
+            if finished < len(dag.tasks):
+                raise SuspendTask()
+            return None
+        return _result_or_value(_resolve(dag.result, results, inputs))
+
+
+def _find_tasks(value, found, seen):
+    if isinstance(value, Task):
+        if value not in seen:
+            seen.add(value)
+            found.append(value)
+    elif type(value) is dict:
+        for item in value.values():
+            _find_tasks(item, found, seen)
+    elif type(value) in _CONTAINERS:
+        for item in value:
+            _find_tasks(item, found, seen)
+
+
+def _resolve(value, results, inputs):
+    # replace the tasks with their results and the inputs with their values
+    if isinstance(value, Task):
+        # the output can refer to tasks that were not reached yet
+        return results.get(value, _placeholder)
+    if isinstance(value, Input):
+        args, kwargs = inputs
+        if isinstance(value.key, int):
+            return args[value.key]
+        return kwargs[value.key]
+    v_type = type(value)
+    if v_type is dict:
+        return dict((k, _resolve(v, results, inputs))
+                    for k, v in value.items())
+    if v_type in _CONTAINERS:
+        return v_type(_resolve(v, results, inputs) for v in value)
+    return value
@@ -0,0 +1,1117 @@
+"""A local Amazon SWF API emulator.
+
+The emulator implements the subset of the SWF JSON API used by Flowy on top of
+a SQLite database and serves it over HTTP. It can be used for offline (load)
+testing with any number of workers and starters, all using stock Layer1
+clients:
+
+    $ python -m flowy.emulator --port 8420 --db /tmp/swf.sqlite
+
+    from boto.regioninfo import RegionInfo
+    from boto.swf.layer1 import Layer1
+    layer1 = Layer1('any-key', 'any-secret', is_secure=False, port=8420,
+                    region=RegionInfo(name='local', endpoint='127.0.0.1'))
+
+The layer1 helper in this module does exactly that. The domains don't need to
+be registered and the credentials are not checked.
+
+The implemented operations are: Register/Describe/List for workflow and
+activity types, StartWorkflowExecution, SignalWorkflowExecution,
+TerminateWorkflowExecution, GetWorkflowExecutionHistory, PollForDecisionTask
+(with pagination), RespondDecisionTaskCompleted, PollForActivityTask,
+RespondActivityTaskCompleted/Failed/Canceled, RecordActivityTaskHeartbeat and
+CountPendingActivityTasks/DecisionTasks. All the decisions are supported,
+including timers, markers and child workflows, as well as the activity,
+decision, timer and execution timeouts.
+"""
+from __future__ import print_function
+
+import argparse
+import base64
+import binascii
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:  # pragma: no cover
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+
+
+__all__ = ['SWFEmulator', 'serve', 'layer1']
+
+
+logger = logging.getLogger(__name__)
+
+
+_FAULT = 'com.amazonaws.swf.base.model#%s'
+_PAGE_SIZE = 1000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS types (
+    domain TEXT, kind TEXT, name TEXT, version TEXT, status TEXT,
+    created REAL, configuration TEXT,
+    PRIMARY KEY (domain, kind, name, version));
+CREATE TABLE IF NOT EXISTS executions (
+    run_id TEXT PRIMARY KEY, domain TEXT, workflow_id TEXT, name TEXT,
+    version TEXT, task_list TEXT, task_timeout TEXT, child_policy TEXT,
+    status TEXT, close_at REAL, last_event_id INTEGER,
+    parent_run_id TEXT, parent_initiated_id INTEGER, parent_started_id INTEGER,
+    decision_state TEXT, decision_again INTEGER, decision_scheduled_at REAL,
+    decision_scheduled_id INTEGER, decision_started_id INTEGER,
+    decision_token TEXT, decision_close_at REAL, previous_started_id INTEGER);
+CREATE INDEX IF NOT EXISTS executions_decisions
+    ON executions (domain, task_list, decision_state);
+CREATE INDEX IF NOT EXISTS executions_ids ON executions (domain, workflow_id);
+CREATE TABLE IF NOT EXISTS events (
+    run_id TEXT, event_id INTEGER, body TEXT,
+    PRIMARY KEY (run_id, event_id));
+CREATE TABLE IF NOT EXISTS activities (
+    token TEXT PRIMARY KEY, run_id TEXT, domain TEXT, task_list TEXT,
+    activity_id TEXT, scheduled_id INTEGER, started_id INTEGER, state TEXT,
+    scheduled_at REAL, heartbeat TEXT, start_to_close TEXT,
+    schedule_to_start_at REAL, schedule_to_close_at REAL,
+    start_to_close_at REAL, heartbeat_at REAL, cancel_requested INTEGER);
+CREATE INDEX IF NOT EXISTS activities_tasks
+    ON activities (domain, task_list, state);
+CREATE INDEX IF NOT EXISTS activities_ids ON activities (run_id, activity_id);
+CREATE TABLE IF NOT EXISTS timers (
+    run_id TEXT, timer_id TEXT, started_id INTEGER, fire_at REAL,
+    PRIMARY KEY (run_id, timer_id));
+"""
+
+
+class SWFFault(Exception):
+    """An error response; the name is the SWF fault name."""
+    def __init__(self, name, message=''):
+        super(SWFFault, self).__init__(message)
+        self.name = name
+        self.message = message
+
+
+def _new_id():
+    return binascii.hexlify(os.urandom(16)).decode('ascii')
+
+
+def _seconds(value):
+    """Convert a SWF timeout value to seconds; None means no timeout."""
+    if value is None or value == 'NONE':
+        return None
+    return int(value)
+
+
+def _deadline(now, value):
+    seconds = _seconds(value)
+    return None if seconds is None else now + seconds
+
+
+def _encode_token(data):
+    return base64.b64encode(json.dumps(data).encode('utf-8')).decode('ascii')
+
+
+def _decode_token(token):
+    try:
+        return json.loads(base64.b64decode(token.encode('ascii'))
+                          .decode('utf-8'))
+    except (TypeError, ValueError):
+        raise SWFFault('ValidationException', 'Invalid nextPageToken.')
+
+
+def _attrs_key(e_type):
+    return e_type[0].lower() + e_type[1:] + 'EventAttributes'
+
+
+def _decision_attrs_key(d_type):
+    return d_type[0].lower() + d_type[1:] + 'DecisionAttributes'
+
+
+class SWFEmulator(object):
+    """The emulated service.
+
+    The handle method takes the name of an action and its request data and
+    returns the response data or raises SWFFault. It's thread safe and the
+    polls block until a task is available or the poll_timeout expires.
+
+    The tick method must be called periodically (serve does this) to fire
+    the timers and to time out the tasks and the executions.
+    """
+    def __init__(self, db=':memory:', poll_timeout=60, clock=time.time):
+        self.db = sqlite3.connect(db, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(_SCHEMA)
+        self.poll_timeout = poll_timeout
+        self.clock = clock
+        self.lock = threading.Condition()
+        self.actions = {
+            'RegisterWorkflowType': self.register_workflow_type,
+            'RegisterActivityType': self.register_activity_type,
+            'DescribeWorkflowType': self.describe_workflow_type,
+            'DescribeActivityType': self.describe_activity_type,
+            'ListWorkflowTypes': self.list_workflow_types,
+            'ListActivityTypes': self.list_activity_types,
+            'StartWorkflowExecution': self.start_workflow_execution,
+            'SignalWorkflowExecution': self.signal_workflow_execution,
+            'TerminateWorkflowExecution': self.terminate_workflow_execution,
+            'GetWorkflowExecutionHistory': self.get_workflow_execution_history,
+            'PollForDecisionTask': self.poll_for_decision_task,
+            'RespondDecisionTaskCompleted':
+                self.respond_decision_task_completed,
+            'PollForActivityTask': self.poll_for_activity_task,
+            'RespondActivityTaskCompleted':
+                self.respond_activity_task_completed,
+            'RespondActivityTaskFailed': self.respond_activity_task_failed,
+            'RespondActivityTaskCanceled': self.respond_activity_task_canceled,
+            'RecordActivityTaskHeartbeat': self.record_activity_task_heartbeat,
+            'CountPendingActivityTasks': self.count_pending_activity_tasks,
+            'CountPendingDecisionTasks': self.count_pending_decision_tasks,
+        }
+
+    def handle(self, action, data):
+        try:
+            method = self.actions[action]
+        except KeyError:
+            raise SWFFault('UnknownOperationException',
+                           'Unsupported action: %s' % action)
+        return method(data)
+
+    def _transaction(self, func, *args):
+        """Run func in a transaction while holding the lock."""
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                result = func(*args)
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+            return result
+
+    def _poll(self, func, *args):
+        """Retry func until it returns something or the poll times out."""
+        deadline = time.time() + self.poll_timeout
+        with self.lock:
+            while 1:
+                result = self._transaction(func, *args)
+                remaining = deadline - time.time()
+                if result is not None or remaining <= 0:
+                    return result
+                self.lock.wait(remaining)
+
+    # Types
+
+    def _register_type(self, kind, data, configuration):
+        def register():
+            try:
+                self.db.execute(
+                    'INSERT INTO types VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (data['domain'], kind, data['name'], data['version'],
+                     'REGISTERED', self.clock(), json.dumps(configuration)))
+            except sqlite3.IntegrityError:
+                raise SWFFault('TypeAlreadyExistsFault', '%s %s %s' % (
+                    kind, data['name'], data['version']))
+        self._transaction(register)
+
+    def register_workflow_type(self, data):
+        configuration = {}
+        for key in ['defaultTaskList', 'defaultTaskStartToCloseTimeout',
+                    'defaultExecutionStartToCloseTimeout',
+                    'defaultChildPolicy']:
+            if key in data:
+                configuration[key] = data[key]
+        self._register_type('workflow', data, configuration)
+
+    def register_activity_type(self, data):
+        configuration = {}
+        for key in ['defaultTaskList', 'defaultTaskHeartbeatTimeout',
+                    'defaultTaskScheduleToCloseTimeout',
+                    'defaultTaskScheduleToStartTimeout',
+                    'defaultTaskStartToCloseTimeout']:
+            if key in data:
+                configuration[key] = data[key]
+        self._register_type('activity', data, configuration)
+
+    def _get_type(self, domain, kind, t):
+        row = self.db.execute(
+            'SELECT * FROM types WHERE domain = ? AND kind = ? AND name = ?'
+            ' AND version = ?', (domain, kind, t['name'], t['version'])
+        ).fetchone()
+        return row
+
+    def _type_info(self, kind, row):
+        return {
+            '%sType' % kind: {'name': row['name'], 'version': row['version']},
+            'status': row['status'],
+            'creationDate': row['created'],
+        }
+
+    def _describe_type(self, kind, data):
+        def describe():
+            row = self._get_type(data['domain'], kind, data['%sType' % kind])
+            if row is None:
+                raise SWFFault('UnknownResourceFault', 'Unknown %s type.' % kind)
+            return {'typeInfo': self._type_info(kind, row),
+                    'configuration': json.loads(row['configuration'])}
+        return self._transaction(describe)
+
+    def describe_workflow_type(self, data):
+        return self._describe_type('workflow', data)
+
+    def describe_activity_type(self, data):
+        return self._describe_type('activity', data)
+
+    def _list_types(self, kind, data):
+        def list_types():
+            query = ('SELECT * FROM types WHERE domain = ? AND kind = ?'
+                     ' AND status = ?')
+            args = [data['domain'], kind, data['registrationStatus']]
+            if data.get('name'):
+                query += ' AND name = ?'
+                args.append(data['name'])
+            order = 'DESC' if data.get('reverseOrder') else 'ASC'
+            query += ' ORDER BY name %s, version %s' % (order, order)
+            return self.db.execute(query, args).fetchall()
+        rows = self._transaction(list_types)
+        offset = 0
+        if data.get('nextPageToken'):
+            offset = _decode_token(data['nextPageToken'])
+        page_size = min(data.get('maximumPageSize') or _PAGE_SIZE, _PAGE_SIZE)
+        response = {'typeInfos': [self._type_info(kind, row) for row
+                                  in rows[offset:offset + page_size]]}
+        if offset + page_size < len(rows):
+            response['nextPageToken'] = _encode_token(offset + page_size)
+        return response
+
+    def list_workflow_types(self, data):
+        return self._list_types('workflow', data)
+
+    def list_activity_types(self, data):
+        return self._list_types('activity', data)
+
+    # Executions and their events
+
+    def _add_event(self, run_id, e_type, attrs):
+        row = self.db.execute('SELECT last_event_id FROM executions'
+                              ' WHERE run_id = ?', (run_id,)).fetchone()
+        event_id = row['last_event_id'] + 1
+        self.db.execute('UPDATE executions SET last_event_id = ?'
+                        ' WHERE run_id = ?', (event_id, run_id))
+        event = {'eventId': event_id, 'eventType': e_type,
+                 'eventTimestamp': self.clock(), _attrs_key(e_type): attrs}
+        self.db.execute('INSERT INTO events VALUES (?, ?, ?)',
+                        (run_id, event_id, json.dumps(event)))
+        return event_id
+
+    def _execution(self, run_id):
+        return self.db.execute('SELECT * FROM executions WHERE run_id = ?',
+                               (run_id,)).fetchone()
+
+    def _open_execution(self, domain, workflow_id, run_id=None):
+        query = ('SELECT * FROM executions WHERE domain = ? AND workflow_id = ?'
+                 ' AND status = ?')
+        args = [domain, workflow_id, 'OPEN']
+        if run_id:
+            query += ' AND run_id = ?'
+            args.append(run_id)
+        return self.db.execute(query, args).fetchone()
+
+    def _start_execution(self, domain, workflow_id, w_type, data,
+                         parent=None, parent_initiated_id=None,
+                         continued_run_id=None):
+        """Start a new execution; raise SWFFault with the failure cause."""
+        row = self._get_type(domain, 'workflow', w_type)
+        if row is None or row['status'] != 'REGISTERED':
+            raise SWFFault('UnknownResourceFault',
+                           'WORKFLOW_TYPE_DOES_NOT_EXIST')
+        if self._open_execution(domain, workflow_id) is not None:
+            raise SWFFault('WorkflowExecutionAlreadyStartedFault',
+                           'WORKFLOW_ALREADY_RUNNING')
+        config = json.loads(row['configuration'])
+        task_list = data.get('taskList') or config.get('defaultTaskList')
+        if not task_list:
+            raise SWFFault('DefaultUndefinedFault',
+                           'DEFAULT_TASK_LIST_UNDEFINED')
+        exec_timeout = (data.get('executionStartToCloseTimeout')
+                        or config.get('defaultExecutionStartToCloseTimeout'))
+        if not exec_timeout:
+            raise SWFFault('DefaultUndefinedFault',
+                           'DEFAULT_EXECUTION_START_TO_CLOSE_TIMEOUT_UNDEFINED')
+        task_timeout = (data.get('taskStartToCloseTimeout')
+                        or config.get('defaultTaskStartToCloseTimeout'))
+        if not task_timeout:
+            raise SWFFault('DefaultUndefinedFault',
+                           'DEFAULT_TASK_START_TO_CLOSE_TIMEOUT_UNDEFINED')
+        child_policy = (data.get('childPolicy')
+                        or config.get('defaultChildPolicy'))
+        if not child_policy:
+            raise SWFFault('DefaultUndefinedFault',
+                           'DEFAULT_CHILD_POLICY_UNDEFINED')
+        run_id = _new_id()
+        now = self.clock()
+        self.db.execute(
+            'INSERT INTO executions (run_id, domain, workflow_id, name,'
+            ' version, task_list, task_timeout, child_policy, status,'
+            ' close_at, last_event_id, parent_run_id, parent_initiated_id,'
+            ' decision_again, previous_started_id) VALUES'
+            ' (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?, 0, 0)',
+            (run_id, domain, workflow_id, w_type['name'], w_type['version'],
+             task_list['name'], task_timeout, child_policy, 'OPEN',
+             _deadline(now, exec_timeout),
+             parent['run_id'] if parent is not None else None,
+             parent_initiated_id))
+        attrs = {
+            'workflowType': w_type,
+            'taskList': task_list,
+            'executionStartToCloseTimeout': exec_timeout,
+            'taskStartToCloseTimeout': task_timeout,
+            'childPolicy': child_policy,
+        }
+        for key in ['input', 'tagList']:
+            if data.get(key) is not None:
+                attrs[key] = data[key]
+        if parent is not None:
+            attrs['parentWorkflowExecution'] = {
+                'workflowId': parent['workflow_id'],
+                'runId': parent['run_id']}
+            attrs['parentInitiatedEventId'] = parent_initiated_id
+        if continued_run_id is not None:
+            attrs['continuedExecutionRunId'] = continued_run_id
+        self._add_event(run_id, 'WorkflowExecutionStarted', attrs)
+        self._schedule_decision(run_id)
+        return run_id
+
+    def start_workflow_execution(self, data):
+        def start():
+            return self._start_execution(data['domain'], data['workflowId'],
+                                         data['workflowType'], data)
+        return {'runId': self._transaction(start)}
+
+    def signal_workflow_execution(self, data):
+        def signal():
+            execution = self._open_execution(data['domain'],
+                                             data['workflowId'],
+                                             data.get('runId'))
+            if execution is None:
+                raise SWFFault('UnknownResourceFault', 'Unknown execution.')
+            attrs = {'signalName': data['signalName']}
+            if data.get('input') is not None:
+                attrs['input'] = data['input']
+            self._add_event(execution['run_id'], 'WorkflowExecutionSignaled',
+                            attrs)
+            self._schedule_decision(execution['run_id'])
+        self._transaction(signal)
+
+    def terminate_workflow_execution(self, data):
+        def terminate():
+            execution = self._open_execution(data['domain'],
+                                             data['workflowId'],
+                                             data.get('runId'))
+            if execution is None:
+                raise SWFFault('UnknownResourceFault', 'Unknown execution.')
+            attrs = {'childPolicy': data.get('childPolicy')
+                     or execution['child_policy'], 'cause': 'OPERATOR_INITIATED'}
+            for key in ['reason', 'details']:
+                if data.get(key) is not None:
+                    attrs[key] = data[key]
+            self._close_execution(execution['run_id'], 'TERMINATED',
+                                  'WorkflowExecutionTerminated', attrs)
+        self._transaction(terminate)
+
+    def _events(self, run_id, after, until, reverse, page_size):
+        order = 'DESC' if reverse else 'ASC'
+        if reverse:
+            query = ('SELECT body FROM events WHERE run_id = ? AND event_id < ?'
+                     ' AND event_id > 0 ORDER BY event_id DESC LIMIT ?')
+            args = (run_id, after, page_size)
+        else:
+            query = ('SELECT body FROM events WHERE run_id = ? AND event_id > ?'
+                     ' AND event_id <= ? ORDER BY event_id %s LIMIT ?' % order)
+            args = (run_id, after, until, page_size)
+        return [json.loads(row['body'])
+                for row in self.db.execute(query, args)]
+
+    def _history_page(self, run_id, last_id, cursor, reverse, page_size):
+        """Return the events after cursor (or before it, if reverse) and the
+        next cursor or None if this is the last page."""
+        page_size = min(page_size or _PAGE_SIZE, _PAGE_SIZE)
+        if cursor is None:
+            cursor = last_id + 1 if reverse else 0
+        events = self._events(run_id, cursor, last_id, reverse, page_size)
+        if not events:
+            return events, None
+        next_cursor = events[-1]['eventId']
+        if reverse and next_cursor <= 1 or not reverse and next_cursor >= last_id:
+            next_cursor = None
+        return events, next_cursor
+
+    def get_workflow_execution_history(self, data):
+        def history():
+            execution = self._execution(data['execution']['runId'])
+            if execution is None:
+                raise SWFFault('UnknownResourceFault', 'Unknown execution.')
+            cursor = None
+            if data.get('nextPageToken'):
+                cursor = _decode_token(data['nextPageToken'])
+            events, cursor = self._history_page(
+                execution['run_id'], execution['last_event_id'], cursor,
+                data.get('reverseOrder'), data.get('maximumPageSize'))
+            response = {'events': events}
+            if cursor is not None:
+                response['nextPageToken'] = _encode_token(cursor)
+            return response
+        return self._transaction(history)
+
+    def _schedule_decision(self, run_id):
+        execution = self._execution(run_id)
+        if execution['status'] != 'OPEN':
+            return
+        state = execution['decision_state']
+        if state == 'STARTED':
+            self.db.execute('UPDATE executions SET decision_again = 1'
+                            ' WHERE run_id = ?', (run_id,))
+        elif state is None:
+            event_id = self._add_event(run_id, 'DecisionTaskScheduled', {
+                'taskList': {'name': execution['task_list']},
+                'startToCloseTimeout': execution['task_timeout']})
+            self.db.execute(
+                'UPDATE executions SET decision_state = ?,'
+                ' decision_scheduled_id = ?, decision_scheduled_at = ?'
+                ' WHERE run_id = ?',
+                ('SCHEDULED', event_id, self.clock(), run_id))
+            self.lock.notify_all()
+
+    def _close_execution(self, run_id, status, e_type, attrs):
+        execution = self._execution(run_id)
+        self._add_event(run_id, e_type, attrs)
+        self.db.execute('UPDATE executions SET status = ?,'
+                        ' decision_state = NULL WHERE run_id = ?',
+                        (status, run_id))
+        self.db.execute('DELETE FROM activities WHERE run_id = ?', (run_id,))
+        self.db.execute('DELETE FROM timers WHERE run_id = ?', (run_id,))
+        if execution['child_policy'] == 'TERMINATE':
+            for child in self.db.execute(
+                    'SELECT run_id FROM executions WHERE parent_run_id = ?'
+                    ' AND status = ?', (run_id, 'OPEN')).fetchall():
+                self._close_execution(
+                    child['run_id'], 'TERMINATED',
+                    'WorkflowExecutionTerminated',
+                    {'childPolicy': 'TERMINATE', 'cause': 'CHILD_POLICY_APPLIED'})
+        if status != 'CONTINUED_AS_NEW' and execution['parent_run_id']:
+            self._notify_parent(execution, status, attrs)
+
+    def _notify_parent(self, execution, status, attrs):
+        parent_id = execution['parent_run_id']
+        if self._execution(parent_id)['status'] != 'OPEN':
+            return
+        e_type = {
+            'COMPLETED': 'ChildWorkflowExecutionCompleted',
+            'FAILED': 'ChildWorkflowExecutionFailed',
+            'TIMED_OUT': 'ChildWorkflowExecutionTimedOut',
+            'CANCELED': 'ChildWorkflowExecutionCanceled',
+            'TERMINATED': 'ChildWorkflowExecutionTerminated',
+        }[status]
+        p_attrs = {
+            'workflowExecution': {'workflowId': execution['workflow_id'],
+                                  'runId': execution['run_id']},
+            'workflowType': {'name': execution['name'],
+                             'version': execution['version']},
+            'initiatedEventId': execution['parent_initiated_id'],
+            'startedEventId': execution['parent_started_id'],
+        }
+        for key in ['result', 'reason', 'details', 'timeoutType']:
+            if key in attrs:
+                p_attrs[key] = attrs[key]
+        self._add_event(parent_id, e_type, p_attrs)
+        self._schedule_decision(parent_id)
+
+    # Decisions
+
+    def _acquire_decision(self, domain, task_list, identity, page_size):
+        execution = self.db.execute(
+            'SELECT * FROM executions WHERE domain = ? AND task_list = ?'
+            ' AND decision_state = ? ORDER BY decision_scheduled_at LIMIT 1',
+            (domain, task_list, 'SCHEDULED')).fetchone()
+        if execution is None:
+            return None
+        run_id = execution['run_id']
+        attrs = {'scheduledEventId': execution['decision_scheduled_id']}
+        if identity:
+            attrs['identity'] = identity
+        started_id = self._add_event(run_id, 'DecisionTaskStarted', attrs)
+        token = _new_id()
+        self.db.execute(
+            'UPDATE executions SET decision_state = ?, decision_started_id = ?,'
+            ' decision_token = ?, decision_close_at = ? WHERE run_id = ?',
+            ('STARTED', started_id, token,
+             _deadline(self.clock(), execution['task_timeout']), run_id))
+        return self._decision_page(self._execution(run_id), token, None,
+                                   page_size)
+
+    def _decision_page(self, execution, token, cursor, page_size,
+                       reverse=False):
+        started_id = execution['decision_started_id']
+        events, cursor = self._history_page(execution['run_id'], started_id,
+                                            cursor, reverse, page_size)
+        response = {
+            'taskToken': token,
+            'startedEventId': started_id,
+            'previousStartedEventId': execution['previous_started_id'],
+            'workflowExecution': {'workflowId': execution['workflow_id'],
+                                  'runId': execution['run_id']},
+            'workflowType': {'name': execution['name'],
+                             'version': execution['version']},
+            'events': events,
+        }
+        if cursor is not None:
+            response['nextPageToken'] = _encode_token(
+                [execution['run_id'], token, cursor])
+        return response
+
+    def poll_for_decision_task(self, data):
+        page_size = data.get('maximumPageSize')
+        reverse = data.get('reverseOrder', False)
+        if data.get('nextPageToken'):
+            run_id, token, cursor = _decode_token(data['nextPageToken'])
+
+            def next_page():
+                execution = self._execution(run_id)
+                if (execution is None or execution['decision_token'] != token
+                        or execution['decision_state'] != 'STARTED'):
+                    raise SWFFault('UnknownResourceFault',
+                                   'The decision task is closed.')
+                return self._decision_page(execution, token, cursor,
+                                           page_size, reverse)
+            return self._transaction(next_page)
+        if reverse:
+            raise SWFFault('ValidationException',
+                           'reverseOrder is not supported.')
+        response = self._poll(self._acquire_decision, data['domain'],
+                              data['taskList']['name'], data.get('identity'),
+                              page_size)
+        if response is None:
+            return {'taskToken': '', 'startedEventId': 0,
+                    'previousStartedEventId': 0, 'events': []}
+        return response
+
+    def respond_decision_task_completed(self, data):
+        def respond():
+            execution = self.db.execute(
+                'SELECT * FROM executions WHERE decision_token = ?'
+                ' AND decision_state = ?',
+                (data['taskToken'], 'STARTED')).fetchone()
+            if execution is None:
+                raise SWFFault('UnknownResourceFault',
+                               'The decision task is closed.')
+            run_id = execution['run_id']
+            attrs = {'scheduledEventId': execution['decision_scheduled_id'],
+                     'startedEventId': execution['decision_started_id']}
+            if data.get('executionContext') is not None:
+                attrs['executionContext'] = data['executionContext']
+            completed_id = self._add_event(run_id, 'DecisionTaskCompleted',
+                                           attrs)
+            self.db.execute(
+                'UPDATE executions SET decision_state = NULL,'
+                ' decision_token = NULL, decision_close_at = NULL,'
+                ' decision_again = 0, previous_started_id = ?'
+                ' WHERE run_id = ?', (execution['decision_started_id'], run_id))
+            again = execution['decision_again']
+            for decision in data.get('decisions') or []:
+                if self._execution(run_id)['status'] != 'OPEN':
+                    break
+                d_type = decision['decisionType']
+                d_attrs = decision.get(_decision_attrs_key(d_type), {})
+                handler = getattr(self, '_decide_%s' % d_type, None)
+                if handler is None:
+                    raise SWFFault('ValidationException',
+                                   'Unsupported decision: %s' % d_type)
+                again = handler(execution, completed_id, d_attrs, again) or again
+            if again:
+                self._schedule_decision(run_id)
+        self._transaction(respond)
+
+    def _decision_failed(self, run_id, e_type, attrs, cause, completed_id):
+        attrs = dict(attrs, cause=cause,
+                     decisionTaskCompletedEventId=completed_id)
+        self._add_event(run_id, e_type, attrs)
+        return True  # failures must be handled in a new decision
+
+    def _decide_ScheduleActivityTask(self, execution, completed_id, attrs,
+                                     again):
+        run_id = execution['run_id']
+        a_type, a_id = attrs['activityType'], attrs['activityId']
+        fail_attrs = {'activityType': a_type, 'activityId': a_id}
+        row = self._get_type(execution['domain'], 'activity', a_type)
+        if row is None:
+            return self._decision_failed(
+                run_id, 'ScheduleActivityTaskFailed', fail_attrs,
+                'ACTIVITY_TYPE_DOES_NOT_EXIST', completed_id)
+        if row['status'] != 'REGISTERED':
+            return self._decision_failed(
+                run_id, 'ScheduleActivityTaskFailed', fail_attrs,
+                'ACTIVITY_TYPE_DEPRECATED', completed_id)
+        if self.db.execute('SELECT 1 FROM activities WHERE run_id = ?'
+                           ' AND activity_id = ?', (run_id, a_id)).fetchone():
+            return self._decision_failed(
+                run_id, 'ScheduleActivityTaskFailed', fail_attrs,
+                'ACTIVITY_ID_ALREADY_IN_USE', completed_id)
+        config = json.loads(row['configuration'])
+        values = {}
+        for key, default in [
+                ('taskList', 'defaultTaskList'),
+                ('heartbeatTimeout', 'defaultTaskHeartbeatTimeout'),
+                ('scheduleToCloseTimeout', 'defaultTaskScheduleToCloseTimeout'),
+                ('scheduleToStartTimeout', 'defaultTaskScheduleToStartTimeout'),
+                ('startToCloseTimeout', 'defaultTaskStartToCloseTimeout')]:
+            values[key] = attrs.get(key) or config.get(default)
+            if values[key] is None:
+                cause = '%s_UNDEFINED' % ''.join(
+                    '_' + c if c.isupper() else c.upper() for c in default)
+                return self._decision_failed(
+                    run_id, 'ScheduleActivityTaskFailed', fail_attrs,
+                    cause, completed_id)
+        e_attrs = dict(values, activityType=a_type, activityId=a_id,
+                       decisionTaskCompletedEventId=completed_id)
+        for key in ['input', 'control']:
+            if attrs.get(key) is not None:
+                e_attrs[key] = attrs[key]
+        scheduled_id = self._add_event(run_id, 'ActivityTaskScheduled',
+                                       e_attrs)
+        now = self.clock()
+        self.db.execute(
+            'INSERT INTO activities (token, run_id, domain, task_list,'
+            ' activity_id, scheduled_id, state, scheduled_at, heartbeat,'
+            ' start_to_close, schedule_to_start_at, schedule_to_close_at,'
+            ' cancel_requested) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)',
+            (_new_id(), run_id, execution['domain'],
+             values['taskList']['name'], a_id, scheduled_id, 'SCHEDULED', now,
+             values['heartbeatTimeout'], values['startToCloseTimeout'],
+             _deadline(now, values['scheduleToStartTimeout']),
+             _deadline(now, values['scheduleToCloseTimeout'])))
+        self.lock.notify_all()
+
+    def _decide_RequestCancelActivityTask(self, execution, completed_id,
+                                          attrs, again):
+        run_id, a_id = execution['run_id'], attrs['activityId']
+        activity = self.db.execute(
+            'SELECT * FROM activities WHERE run_id = ? AND activity_id = ?',
+            (run_id, a_id)).fetchone()
+        if activity is None:
+            return self._decision_failed(
+                run_id, 'RequestCancelActivityTaskFailed', {'activityId': a_id},
+                'ACTIVITY_ID_UNKNOWN', completed_id)
+        requested_id = self._add_event(run_id, 'ActivityTaskCancelRequested', {
+            'activityId': a_id, 'decisionTaskCompletedEventId': completed_id})
+        if activity['state'] == 'SCHEDULED':
+            # it was not started yet, it can be canceled right away
+            self._add_event(run_id, 'ActivityTaskCanceled', {
+                'scheduledEventId': activity['scheduled_id'],
+                'latestCancelRequestedEventId': requested_id})
+            self.db.execute('DELETE FROM activities WHERE token = ?',
+                            (activity['token'],))
+            return True
+        self.db.execute('UPDATE activities SET cancel_requested = 1'
+                        ' WHERE token = ?', (activity['token'],))
+
+    def _decide_StartTimer(self, execution, completed_id, attrs, again):
+        run_id, t_id = execution['run_id'], attrs['timerId']
+        if self.db.execute('SELECT 1 FROM timers WHERE run_id = ?'
+                           ' AND timer_id = ?', (run_id, t_id)).fetchone():
+            return self._decision_failed(
+                run_id, 'StartTimerFailed', {'timerId': t_id},
+                'TIMER_ID_ALREADY_IN_USE', completed_id)
+        e_attrs = {'timerId': t_id,
+                   'startToFireTimeout': attrs['startToFireTimeout'],
+                   'decisionTaskCompletedEventId': completed_id}
+        if attrs.get('control') is not None:
+            e_attrs['control'] = attrs['control']
+        started_id = self._add_event(run_id, 'TimerStarted', e_attrs)
+        self.db.execute('INSERT INTO timers VALUES (?, ?, ?, ?)', (
+            run_id, t_id, started_id,
+            self.clock() + int(attrs['startToFireTimeout'])))
+
+    def _decide_CancelTimer(self, execution, completed_id, attrs, again):
+        run_id, t_id = execution['run_id'], attrs['timerId']
+        timer = self.db.execute('SELECT * FROM timers WHERE run_id = ?'
+                                ' AND timer_id = ?', (run_id, t_id)).fetchone()
+        if timer is None:
+            return self._decision_failed(
+                run_id, 'CancelTimerFailed', {'timerId': t_id},
+                'TIMER_ID_UNKNOWN', completed_id)
+        self.db.execute('DELETE FROM timers WHERE run_id = ? AND timer_id = ?',
+                        (run_id, t_id))
+        self._add_event(run_id, 'TimerCanceled', {
+            'timerId': t_id, 'startedEventId': timer['started_id'],
+            'decisionTaskCompletedEventId': completed_id})
+
+    def _decide_RecordMarker(self, execution, completed_id, attrs, again):
+        e_attrs = {'markerName': attrs['markerName'],
+                   'decisionTaskCompletedEventId': completed_id}
+        if attrs.get('details') is not None:
+            e_attrs['details'] = attrs['details']
+        self._add_event(execution['run_id'], 'MarkerRecorded', e_attrs)
+
+    def _close_decision(self, execution, completed_id, again, status, e_type,
+                        attrs):
+        if again:
+            # new events arrived while the decision was running
+            return self._decision_failed(
+                execution['run_id'], '%sFailed' % _close_action[e_type], {},
+                'UNHANDLED_DECISION', completed_id)
+        attrs = dict(attrs, decisionTaskCompletedEventId=completed_id)
+        self._close_execution(execution['run_id'], status, e_type, attrs)
+
+    def _decide_CompleteWorkflowExecution(self, execution, completed_id,
+                                          attrs, again):
+        return self._close_decision(execution, completed_id, again,
+                                    'COMPLETED', 'WorkflowExecutionCompleted',
+                                    attrs)
+
+    def _decide_FailWorkflowExecution(self, execution, completed_id, attrs,
+                                      again):
+        return self._close_decision(execution, completed_id, again, 'FAILED',
+                                    'WorkflowExecutionFailed', attrs)
+
+    def _decide_CancelWorkflowExecution(self, execution, completed_id, attrs,
+                                        again):
+        return self._close_decision(execution, completed_id, again,
+                                    'CANCELED', 'WorkflowExecutionCanceled',
+                                    attrs)
+
+    def _decide_ContinueAsNewWorkflowExecution(self, execution, completed_id,
+                                               attrs, again):
+        if again:
+            return self._decision_failed(
+                execution['run_id'], 'ContinueAsNewWorkflowExecutionFailed',
+                {}, 'UNHANDLED_DECISION', completed_id)
+        run_id = execution['run_id']
+        w_type = {'name': execution['name'],
+                  'version': attrs.get('workflowTypeVersion')
+                  or execution['version']}
+        data = dict(attrs)
+        data.setdefault('taskList', {'name': execution['task_list']})
+        data.setdefault('taskStartToCloseTimeout', execution['task_timeout'])
+        data.setdefault('childPolicy', execution['child_policy'])
+        # the new run takes over the workflow id, close this one first
+        self.db.execute('UPDATE executions SET status = ? WHERE run_id = ?',
+                        ('CONTINUED_AS_NEW', run_id))
+        try:
+            new_run_id = self._start_execution(
+                execution['domain'], execution['workflow_id'], w_type, data,
+                continued_run_id=run_id)
+        except SWFFault as e:
+            self.db.execute('UPDATE executions SET status = ? WHERE run_id = ?',
+                            ('OPEN', run_id))
+            return self._decision_failed(
+                run_id, 'ContinueAsNewWorkflowExecutionFailed', {}, e.message,
+                completed_id)
+        parent = execution['parent_run_id']
+        self.db.execute(
+            'UPDATE executions SET parent_run_id = ?, parent_initiated_id = ?,'
+            ' parent_started_id = ? WHERE run_id = ?',
+            (parent, execution['parent_initiated_id'],
+             execution['parent_started_id'], new_run_id))
+        self.db.execute('UPDATE executions SET status = ? WHERE run_id = ?',
+                        ('OPEN', run_id))
+        e_attrs = dict(attrs, newExecutionRunId=new_run_id,
+                       workflowType=w_type)
+        self._close_decision(execution, completed_id, False,
+                             'CONTINUED_AS_NEW',
+                             'WorkflowExecutionContinuedAsNew', e_attrs)
+
+    def _decide_StartChildWorkflowExecution(self, execution, completed_id,
+                                            attrs, again):
+        run_id = execution['run_id']
+        w_type, w_id = attrs['workflowType'], attrs['workflowId']
+        e_attrs = dict(attrs, decisionTaskCompletedEventId=completed_id)
+        initiated_id = self._add_event(
+            run_id, 'StartChildWorkflowExecutionInitiated', e_attrs)
+        try:
+            child_id = self._start_execution(
+                execution['domain'], w_id, w_type, attrs, parent=execution,
+                parent_initiated_id=initiated_id)
+        except SWFFault as e:
+            fail_attrs = {'workflowType': w_type, 'workflowId': w_id,
+                          'initiatedEventId': initiated_id}
+            if attrs.get('control') is not None:
+                fail_attrs['control'] = attrs['control']
+            return self._decision_failed(
+                run_id, 'StartChildWorkflowExecutionFailed', fail_attrs,
+                e.message, completed_id)
+        started_id = self._add_event(run_id, 'ChildWorkflowExecutionStarted', {
+            'workflowExecution': {'workflowId': w_id, 'runId': child_id},
+            'workflowType': w_type, 'initiatedEventId': initiated_id})
+        self.db.execute('UPDATE executions SET parent_started_id = ?'
+                        ' WHERE run_id = ?', (started_id, child_id))
+        return True
+
+    # Activities
+
+    def _acquire_activity(self, domain, task_list, identity):
+        activity = self.db.execute(
+            'SELECT * FROM activities WHERE domain = ? AND task_list = ?'
+            ' AND state = ? ORDER BY scheduled_at LIMIT 1',
+            (domain, task_list, 'SCHEDULED')).fetchone()
+        if activity is None:
+            return None
+        run_id = activity['run_id']
+        attrs = {'scheduledEventId': activity['scheduled_id']}
+        if identity:
+            attrs['identity'] = identity
+        started_id = self._add_event(run_id, 'ActivityTaskStarted', attrs)
+        now = self.clock()
+        self.db.execute(
+            'UPDATE activities SET state = ?, started_id = ?,'
+            ' schedule_to_start_at = NULL, start_to_close_at = ?,'
+            ' heartbeat_at = ? WHERE token = ?',
+            ('STARTED', started_id, _deadline(now, activity['start_to_close']),
+             _deadline(now, activity['heartbeat']), activity['token']))
+        execution = self._execution(run_id)
+        scheduled = self.db.execute(
+            'SELECT body FROM events WHERE run_id = ? AND event_id = ?',
+            (run_id, activity['scheduled_id'])).fetchone()
+        scheduled = json.loads(scheduled['body'])['activityTaskScheduledEventAttributes']
+        response = {
+            'taskToken': activity['token'],
+            'activityId': activity['activity_id'],
+            'startedEventId': started_id,
+            'workflowExecution': {'workflowId': execution['workflow_id'],
+                                  'runId': run_id},
+            'activityType': scheduled['activityType'],
+        }
+        if 'input' in scheduled:
+            response['input'] = scheduled['input']
+        return response
+
+    def poll_for_activity_task(self, data):
+        response = self._poll(self._acquire_activity, data['domain'],
+                              data['taskList']['name'], data.get('identity'))
+        if response is None:
+            return {'taskToken': '', 'startedEventId': 0}
+        return response
+
+    def _started_activity(self, token):
+        activity = self.db.execute(
+            'SELECT * FROM activities WHERE token = ? AND state = ?',
+            (token, 'STARTED')).fetchone()
+        if activity is None:
+            raise SWFFault('UnknownResourceFault',
+                           'The activity task is closed.')
+        return activity
+
+    def _close_activity(self, token, e_type, attrs):
+        activity = self._started_activity(token)
+        attrs = dict(attrs, scheduledEventId=activity['scheduled_id'],
+                     startedEventId=activity['started_id'])
+        self._add_event(activity['run_id'], e_type, attrs)
+        self.db.execute('DELETE FROM activities WHERE token = ?', (token,))
+        self._schedule_decision(activity['run_id'])
+
+    def respond_activity_task_completed(self, data):
+        attrs = {}
+        if data.get('result') is not None:
+            attrs['result'] = data['result']
+        self._transaction(self._close_activity, data['taskToken'],
+                          'ActivityTaskCompleted', attrs)
+
+    def respond_activity_task_failed(self, data):
+        attrs = {}
+        for key in ['reason', 'details']:
+            if data.get(key) is not None:
+                attrs[key] = data[key]
+        self._transaction(self._close_activity, data['taskToken'],
+                          'ActivityTaskFailed', attrs)
+
+    def respond_activity_task_canceled(self, data):
+        attrs = {}
+        if data.get('details') is not None:
+            attrs['details'] = data['details']
+        self._transaction(self._close_activity, data['taskToken'],
+                          'ActivityTaskCanceled', attrs)
+
+    def record_activity_task_heartbeat(self, data):
+        def heartbeat():
+            activity = self._started_activity(data['taskToken'])
+            self.db.execute(
+                'UPDATE activities SET heartbeat_at = ? WHERE token = ?',
+                (_deadline(self.clock(), activity['heartbeat']),
+                 activity['token']))
+            return {'cancelRequested': bool(activity['cancel_requested'])}
+        return self._transaction(heartbeat)
+
+    def count_pending_activity_tasks(self, data):
+        def count():
+            return self.db.execute(
+                'SELECT COUNT(*) FROM activities WHERE domain = ?'
+                ' AND task_list = ? AND state = ?',
+                (data['domain'], data['taskList']['name'], 'SCHEDULED')
+            ).fetchone()[0]
+        return {'count': self._transaction(count), 'truncated': False}
+
+    def count_pending_decision_tasks(self, data):
+        def count():
+            return self.db.execute(
+                'SELECT COUNT(*) FROM executions WHERE domain = ?'
+                ' AND task_list = ? AND decision_state = ?',
+                (data['domain'], data['taskList']['name'], 'SCHEDULED')
+            ).fetchone()[0]
+        return {'count': self._transaction(count), 'truncated': False}
+
+    # Timers and timeouts
+
+    def tick(self):
+        """Fire the due timers and time out the tasks and executions."""
+        self._transaction(self._tick, self.clock())
+
+    def _tick(self, now):
+        db = self.db
+        for timer in db.execute('SELECT * FROM timers WHERE fire_at <= ?',
+                                (now,)).fetchall():
+            db.execute('DELETE FROM timers WHERE run_id = ? AND timer_id = ?',
+                       (timer['run_id'], timer['timer_id']))
+            self._add_event(timer['run_id'], 'TimerFired', {
+                'timerId': timer['timer_id'],
+                'startedEventId': timer['started_id']})
+            self._schedule_decision(timer['run_id'])
+        for column, timeout_type in [
+                ('schedule_to_start_at', 'SCHEDULE_TO_START'),
+                ('schedule_to_close_at', 'SCHEDULE_TO_CLOSE'),
+                ('start_to_close_at', 'START_TO_CLOSE'),
+                ('heartbeat_at', 'HEARTBEAT')]:
+            for activity in db.execute(
+                    'SELECT * FROM activities WHERE %s <= ?' % column,
+                    (now,)).fetchall():
+                attrs = {'timeoutType': timeout_type,
+                         'scheduledEventId': activity['scheduled_id']}
+                if activity['started_id'] is not None:
+                    attrs['startedEventId'] = activity['started_id']
+                db.execute('DELETE FROM activities WHERE token = ?',
+                           (activity['token'],))
+                self._add_event(activity['run_id'], 'ActivityTaskTimedOut',
+                                attrs)
+                self._schedule_decision(activity['run_id'])
+        for execution in db.execute(
+                'SELECT * FROM executions WHERE decision_state = ?'
+                ' AND decision_close_at <= ?', ('STARTED', now)).fetchall():
+            self._add_event(execution['run_id'], 'DecisionTaskTimedOut', {
+                'timeoutType': 'START_TO_CLOSE',
+                'scheduledEventId': execution['decision_scheduled_id'],
+                'startedEventId': execution['decision_started_id']})
+            db.execute('UPDATE executions SET decision_state = NULL,'
+                       ' decision_token = NULL, decision_again = 0'
+                       ' WHERE run_id = ?', (execution['run_id'],))
+            self._schedule_decision(execution['run_id'])
+        for execution in db.execute(
+                'SELECT * FROM executions WHERE status = ? AND close_at <= ?',
+                ('OPEN', now)).fetchall():
+            self._close_execution(execution['run_id'], 'TIMED_OUT',
+                                  'WorkflowExecutionTimedOut', {
+                                      'timeoutType': 'START_TO_CLOSE',
+                                      'childPolicy': execution['child_policy']})
+
+
+_close_action = {
+    'WorkflowExecutionCompleted': 'CompleteWorkflowExecution',
+    'WorkflowExecutionFailed': 'FailWorkflowExecution',
+    'WorkflowExecutionCanceled': 'CancelWorkflowExecution',
+    'WorkflowExecutionContinuedAsNew': 'ContinueAsNewWorkflowExecution',
+}
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        action = self.headers.get('X-Amz-Target', '').rsplit('.', 1)[-1]
+        try:
+            data = json.loads(body.decode('utf-8')) if body else {}
+            response = self.server.emulator.handle(action, data)
+            status = 200
+        except SWFFault as e:
+            response = {'__type': _FAULT % e.name, 'message': e.message}
+            status = 400
+        except (KeyError, TypeError, ValueError) as e:
+            logger.exception('Invalid %s request:', action)
+            response = {'__type': _FAULT % 'ValidationException',
+                        'message': repr(e)}
+            status = 400
+        body = json.dumps(response).encode('utf-8') if response else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/x-amz-json-1.0')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(host='127.0.0.1', port=8420, db=':memory:', poll_timeout=60,
+          tick=0.1, emulator=None):
+    """Start serving the emulator in background threads.
+
+    Returns the HTTP server; its address is in server_address and it can be
+    stopped with shutdown(). A port value of 0 picks a random free port.
+    """
+    server = _Server((host, port), _RequestHandler)
+    server.emulator = emulator or SWFEmulator(db, poll_timeout)
+    stopped = threading.Event()
+
+    def ticker():
+        while not stopped.wait(tick):
+            server.emulator.tick()
+
+    def shutdown(shutdown=server.shutdown):
+        stopped.set()
+        shutdown()
+        server.server_close()
+    server.shutdown = shutdown
+    for target in [server.serve_forever, ticker]:
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+    return server
+
+
+def layer1(host='127.0.0.1', port=8420):
+    """Return a stock Layer1 client connected to an emulator."""
+    from boto.regioninfo import RegionInfo
+    from boto.swf.layer1 import Layer1
+    return Layer1('emulator', 'emulator', is_secure=False, port=port,
+                  region=RegionInfo(name='local', endpoint=host))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8420)
+    parser.add_argument('--db', default=':memory:',
+                        help='the SQLite database path')
+    parser.add_argument('--poll-timeout', type=float, default=60)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server = serve(args.host, args.port, args.db, args.poll_timeout)
+    print('Serving on %s:%s' % server.server_address, file=sys.stderr)
+    try:
+        while 1:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""Replay and profile a decision from a recorded history, without Amazon SWF.
+
+The history can be a recorder log or an exported history (see
+flowy.analytics.load_histories). The workflow found in the registry runs
+against a SWFContext loaded from the history events, the same way the
+worker does, and its decisions are captured instead of being sent:
+
+    $ flowy replay -p mypackage history.json
+    $ flowy replay -p mypackage history.json --until 42 \\
+          --pstats decision.prof --collapsed decision.folded
+
+The report has the time spent in each phase and the decisions produced. The
+cProfile stats can be read with pstats or other tools, and the collapsed
+stacks (one 'frame;frame;frame microseconds' line per call stack) are the
+input format of flamegraph.pl, speedscope and similar flame graph tools.
+"""
+from __future__ import print_function
+
+import argparse
+import cProfile
+import importlib
+import json
+import os
+import pstats
+import sys
+import time
+from timeit import default_timer
+
+from flowy.analytics import load_histories
+from flowy.backend.swf import SWFContext
+from flowy.backend.swf import SWFWorkflowRegistry
+from flowy.backend.swf import _Hedges
+from flowy.backend.swf import _ResultSpill
+from flowy.backend.swf import _TaskListLoad
+from flowy.backend.swf import load_events
+
+
+__all__ = ['replay', 'ReplayLayer1', 'StackProfiler']
+
+
+class ReplayLayer1(object):
+    """A stand-in SWF client that keeps the decisions instead of sending
+    them."""
+    def __init__(self):
+        self.decisions = None
+
+    def respond_decision_task_completed(self, task_token, decisions=None,
+                                        execution_context=None):
+        self.decisions = decisions
+
+
+class StackProfiler(object):
+    """A deterministic profiler that times each distinct call stack.
+
+    The time is measured between consecutive profiler events and added to
+    the stack that was running, so each stack gets its own time, not
+    including the calls made from it.
+    """
+    def __init__(self):
+        self.stacks = {}
+        self._stack = []
+        self._last = None
+
+    def runcall(self, func, *args, **kwargs):
+        self._last = default_timer()
+        sys.setprofile(self._profile)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            sys.setprofile(None)
+            self._stack = []
+
+    def _profile(self, frame, event, arg):
+        now = default_timer()
+        if self._stack:
+            stack = tuple(self._stack)
+            self.stacks[stack] = self.stacks.get(stack, 0) + now - self._last
+        if event == 'call':
+            code = frame.f_code
+            self._stack.append('%s (%s:%s)' % (
+                code.co_name, os.path.basename(code.co_filename),
+                code.co_firstlineno))
+        elif event == 'c_call':
+            self._stack.append('%s (built-in)' % getattr(arg, '__name__', arg))
+        elif self._stack:  # return, c_return or c_exception
+            self._stack.pop()
+        self._last = default_timer()
+
+    def collapsed(self):
+        """Return the collapsed stacks lines, with the time in
+        microseconds."""
+        lines = []
+        for stack, duration in sorted(self.stacks.items()):
+            duration = int(duration * 1000000)
+            if duration:
+                lines.append('%s %s' % (';'.join(stack), duration))
+        return lines
+
+
+def replay(registry, events, budget=None, profiler=None):
+    """Replay the decision for the history events with the registry.
+
+    Return the timings of each phase, in seconds, and the decisions produced.
+    The phases are: load_events, loading the events in the context state,
+    and decide, running the workflow until its decisions are flushed. If a
+    profiler is set (a cProfile.Profile or a StackProfiler instance) it runs
+    the workflow.
+    """
+    wall, started = time.time(), default_timer()
+    first_event = events[0]
+    assert first_event['eventType'] == 'WorkflowExecutionStarted'
+    attrs = first_event['workflowExecutionStartedEventAttributes']
+    times, load, hedges = {}, _TaskListLoad(), _Hedges()
+    running, timedout, results, errors, order = load_events(
+        iter(events), times, _ResultSpill(), load, hedges)
+    loaded = default_timer()
+    layer1 = ReplayLayer1()
+    context = SWFContext(
+        layer1, 'replay', attrs['workflowType']['name'],
+        attrs['workflowType']['version'], attrs['input'],
+        attrs['taskList']['name'], attrs['taskStartToCloseTimeout'],
+        attrs['executionStartToCloseTimeout'], attrs.get('tagList'),
+        attrs['childPolicy'], running, timedout, results, errors, order,
+        len(events), 1, wall, budget, times, load, hedges)
+    if profiler is not None:
+        profiler.runcall(registry, context)
+    else:
+        registry(context)
+    decided = default_timer()
+    timings = {'load_events': loaded - started, 'decide': decided - loaded}
+    return timings, layer1.decisions
+
+
+def _until(events, event_id):
+    if event_id is None:
+        return events
+    return [event for event in events if event['eventId'] <= event_id]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='flowy replay',
+                                     description=__doc__.split('\n')[0])
+    parser.add_argument('path', help='a recorder log or an exported history')
+    parser.add_argument('-p', '--package', action='append', required=True,
+                        help='the package to scan for workflows')
+    parser.add_argument('-i', '--index', type=int, default=0,
+                        help='the history to replay if there are many')
+    parser.add_argument('-u', '--until', type=int, default=None,
+                        help='replay the decision with the events up to this'
+                        ' event id')
+    parser.add_argument('-b', '--budget', type=float, default=None,
+                        help='the decision budget, see SWFContext')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='replay this many times, the best timings are'
+                        ' reported')
+    parser.add_argument('--pstats', help='save the cProfile stats to a file')
+    parser.add_argument('--collapsed',
+                        help='save the collapsed stacks to a file')
+    args = parser.parse_args(argv)
+
+    start = default_timer()
+    histories = load_histories([args.path])
+    events = _until(histories[args.index], args.until)
+    loaded = default_timer()
+    registry = SWFWorkflowRegistry()
+    for package in args.package:
+        registry.scan(package=importlib.import_module(package))
+    scanned = default_timer()
+
+    best = {}
+    for _ in range(args.repeat):
+        timings, decisions = replay(registry, events, args.budget)
+        for phase, duration in timings.items():
+            best[phase] = min(duration, best.get(phase, duration))
+    best['load'] = loaded - start
+    best['scan'] = scanned - loaded
+
+    if args.pstats:
+        profile = cProfile.Profile()
+        replay(registry, events, args.budget, profile)
+        profile.dump_stats(args.pstats)
+        stats = pstats.Stats(profile, stream=sys.stderr)
+        stats.sort_stats('cumulative').print_stats(20)
+    if args.collapsed:
+        profiler = StackProfiler()
+        replay(registry, events, args.budget, profiler)
+        with open(args.collapsed, 'w') as f:
+            for line in profiler.collapsed():
+                f.write(line + '\n')
+
+    json.dump({'events': len(events), 'timings': best,
+               'decisions': decisions}, sys.stdout, indent=2, sort_keys=True)
+    print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,181 @@
+"""A prefork supervisor for worker processes.
+
+Everything that is loaded before the workers are forked (the imported modules,
+the scanned registries, etc.) is shared copy-on-write by all the worker
+processes, reducing both the startup time and the memory usage per host.
+
+The supervisor restarts the workers that crash or exit and can recycle them
+after a number of tasks or once they use too much memory. On SIGHUP the
+workers are restarted one at a time and on SIGTERM or SIGINT they are all
+stopped. The workers finish the task they are working on before exiting.
+"""
+
+import gc
+import logging
+import os
+import signal
+import time
+from multiprocessing import cpu_count
+
+
+__all__ = ['Supervisor']
+
+
+logger = logging.getLogger(__name__)
+
+
+class Supervisor(object):
+    """Fork and supervise a number of worker processes.
+
+    The worker_factory is called in each worker process, right after the
+    fork, and must return two callables: poll, that blocks until a new task
+    is available and returns it, and run that is called with the task. Any
+    setup that can't be shared between processes, like opening network
+    connections, should be done in the factory.
+
+    The workers value is the number of processes, by default the number of
+    CPUs. A worker process is recycled after it runs max_tasks tasks or when
+    its resident memory exceeds max_rss megabytes. A value of None means no
+    limit. The workers that crash soon after they were started are restarted
+    only after restart_delay seconds.
+    """
+    def __init__(self, worker_factory, workers=None, max_tasks=None,
+                 max_rss=None, restart_delay=1):
+        self.worker_factory = worker_factory
+        self.workers = workers if workers is not None else cpu_count()
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss
+        self.restart_delay = restart_delay
+        self.children = {}  # pid -> start time
+        self.retiring = set()
+        self.to_roll = []
+        self.next_spawn = 0
+        self.stopping = False
+
+    def run(self):
+        """Supervise the workers until SIGTERM or SIGINT is received."""
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._reload)
+        # move everything loaded so far out of the collector's reach, so the
+        # collections in the workers don't touch (and copy) the shared pages
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+        logger.info('Starting %s workers.', self.workers)
+        while not self.stopping:
+            self._reap()
+            self._roll()
+            self._spawn()
+            time.sleep(0.1)
+        self._shutdown()
+
+    def _stop(self, *_):
+        self.stopping = True
+
+    def _reload(self, *_):
+        logger.info('Restarting the workers.')
+        self.to_roll = [pid for pid in self.children
+                        if pid not in self.retiring]
+
+    def _reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+            if not pid:
+                return
+            started = self.children.pop(pid, None)
+            if started is None:
+                continue
+            retired = pid in self.retiring
+            self.retiring.discard(pid)
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                logger.info('Worker %s exited.', pid)
+            elif not retired:
+                logger.error('Worker %s crashed with status %s.', pid, status)
+                if time.time() - started < self.restart_delay:
+                    self.next_spawn = time.time() + self.restart_delay
+
+    def _roll(self):
+        if self.retiring or not self.to_roll:
+            return
+        pid = self.to_roll.pop()
+        if pid in self.children:
+            self._retire(pid)
+
+    def _retire(self, pid):
+        self.retiring.add(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def _spawn(self):
+        while (len(self.children) - len(self.retiring) < self.workers
+               and time.time() >= self.next_spawn and not self.stopping):
+            pid = os.fork()
+            if pid == 0:
+                os._exit(self._work())
+            self.children[pid] = time.time()
+
+    def _shutdown(self, timeout=60):
+        logger.info('Stopping the workers.')
+        for pid in list(self.children):
+            self._retire(pid)
+        deadline = time.time() + timeout
+        while self.children and time.time() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in self.children:
+            logger.error('Killing worker %s.', pid)
+            os.kill(pid, signal.SIGKILL)
+
+    def _work(self):
+        """The worker process main loop; returns the exit status."""
+        state = {'busy': False, 'stopping': False}
+
+        def stop(*_):
+            state['stopping'] = True
+            if not state['busy']:
+                raise SystemExit(0)
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        tasks = 0
+        try:
+            poll, run = self.worker_factory()
+            while not state['stopping']:
+                task = poll()
+                state['busy'] = True
+                run(task)
+                state['busy'] = False
+                tasks += 1
+                if self.max_tasks is not None and tasks >= self.max_tasks:
+                    logger.info('Recycling worker %s after %s tasks.',
+                                os.getpid(), tasks)
+                    break
+                if self.max_rss is not None and _rss() > self.max_rss:
+                    logger.info('Recycling worker %s using %.1fMB.',
+                                os.getpid(), _rss())
+                    break
+        except SystemExit as e:
+            return e.code or 0
+        except Exception:
+            logger.exception('Error in worker %s:', os.getpid())
+            return 1
+        return 0
+
+
+def _rss():
+    """The resident memory of this process in megabytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1024.0 / 1024.0
+    except (IOError, OSError, ValueError):
+        # not Linux, use the peak value instead (in bytes on OSX)
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / 1024.0 / 1024.0
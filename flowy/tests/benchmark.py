@@ -0,0 +1,336 @@
+"""Replay benchmarks.
+
+Run all the benchmarks and save the results:
+
+    python -m flowy.tests.benchmark -o before.json
+
+and later, after some changes, compare against the saved results:
+
+    python -m flowy.tests.benchmark -c before.json
+
+The results are JSON documents with one entry per benchmark. A non-zero exit
+status is returned if any benchmark got slower than the threshold allows.
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from boto.swf.layer1 import Layer1
+
+from flowy.backend.swf import SWFContext
+from flowy.backend.swf import SWFWorkflowConfig
+from flowy.backend.swf import SWFWorkflowRegistry
+from flowy.backend.swf import load_events
+from flowy.backend.swf import start_swf_workflow_worker
+from flowy.base import Result
+from flowy.base import wait_all
+from flowy.base import wait_first
+from flowy.base import wait_n
+from flowy.tests import histories
+
+
+LOGS = os.path.join(os.path.dirname(__file__), 'integration', 'logs')
+SIZES = [1000, 10000, 100000]
+
+
+class Layer1Replay(Layer1):
+    """Replay the decision tasks from a recording as fast as possible.
+
+    Unlike the playback client used by the integration tests, the requests
+    are not checked; the recorded poll responses are returned in order and
+    the decisions are discarded. When there's nothing left to replay
+    KeyboardInterrupt is raised to stop the worker loop.
+    """
+    def __init__(self, pages):
+        self.pages = pages
+        self.pages_i = iter(pages)
+
+    @classmethod
+    def from_log(cls, log_file):
+        pages = []
+        action = None
+        for line in log_file:
+            sep, data = line.rstrip('\n').split('\t', 1)
+            if sep == '>>>':
+                action = data.split('\t', 1)[0]
+            elif action == 'PollForDecisionTask':
+                try:
+                    pages.append(json.loads(data))
+                except ValueError:  # recorded errors
+                    pass
+        log_file.close()
+        return cls(pages)
+
+    def json_request(self, action, data, object_hook=None):
+        if action == 'PollForDecisionTask':
+            try:
+                return next(self.pages_i)
+            except StopIteration:
+                raise KeyboardInterrupt
+        return None
+
+
+class _Replayed(object):
+    """A stand-in for the workflows in the recordings."""
+    def run(self, *args, **kwargs):
+        return None
+
+
+def recorded_workflows(pages):
+    """A registry with a stand-in workflow for each recorded workflow type."""
+    registry = SWFWorkflowRegistry()
+    for page in pages:
+        w_type = page.get('workflowType')
+        if w_type is None:
+            continue
+        key = str(w_type['name']), str(w_type['version'])
+        if key not in registry.registry:
+            config = SWFWorkflowConfig(w_type['version'], name=w_type['name'])
+            registry.register(config, _Replayed)
+    return registry
+
+
+def task_list(pages):
+    for page in pages:
+        for event in page.get('events', []):
+            if event['eventType'] == 'WorkflowExecutionStarted':
+                a = event['workflowExecutionStartedEventAttributes']
+                return a['taskList']['name']
+
+
+def bench(name, func, repeat, n=1):
+    """Time func repeat times and return the benchmark entry.
+
+    The func is called with no arguments and must return a callable that is
+    timed. This allows for the setup to be excluded from the timings.
+    """
+    timings = []
+    for _ in range(repeat):
+        timed = func()
+        gc.collect()
+        start = time.time()
+        timed()
+        timings.append(time.time() - start)
+    timings.sort()
+    return {
+        'name': name,
+        'n': n,
+        'repeat': repeat,
+        'min': timings[0],
+        'median': timings[len(timings) // 2],
+        'per_op': timings[0] / n,
+    }
+
+
+def allocations(name, func, n=1):
+    """Count the objects func leaves allocated and return the entry.
+
+    Like for bench, func is called to set up the callable that is measured.
+    The garbage collector is disabled while it runs and the new objects
+    tracked by the collector are counted, with the value returned kept alive.
+    The entry has the same keys as the timings, so it's saved and compared
+    the same way, but the values are numbers of objects.
+    """
+    measured = func()
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        kept = measured()
+        count = len(gc.get_objects()) - before
+    finally:
+        gc.enable()
+    del kept
+    return {
+        'name': name,
+        'n': n,
+        'repeat': 1,
+        'min': count,
+        'median': count,
+        'per_op': count / float(n),
+        'unit': 'objects',
+    }
+
+
+def bench_recordings(repeat):
+    for path in sorted(glob.glob(os.path.join(LOGS, '*.workflow.log'))):
+        pages = Layer1Replay.from_log(open(path)).pages
+        registry = recorded_workflows(pages)
+        tl = task_list(pages)
+        name = 'recording/%s' % os.path.basename(path)[:-len('.workflow.log')]
+
+        def setup(pages=pages, registry=registry, tl=tl):
+            layer1 = Layer1Replay(pages)
+            return lambda: start_swf_workflow_worker(
+                'IntegrationTest', tl, layer1=layer1, reg_remote=False,
+                setup_log=False, identity='BenchID', registry=registry)
+        try:
+            yield bench(name, setup, repeat, len(pages))
+        except Exception as e:
+            # some recordings were made with the old API and can't be replayed
+            print('Cannot replay %s: %r' % (name, e), file=sys.stderr)
+
+
+def _iter_events(pages):
+    for page in pages:
+        for event in page['events']:
+            yield event
+
+
+def _context(pages):
+    running, timedout, results, errors, order = load_events(
+        _iter_events(pages))
+    first = pages[0]['events'][0]['workflowExecutionStartedEventAttributes']
+    return SWFContext(Layer1Replay([]), 'token', first['workflowType']['name'],
+                      '1', first['input'], histories.TASK_LIST, '10', '3600',
+                      None, 'TERMINATE', running, timedout, results, errors,
+                      order)
+
+
+def bench_histories(repeat, sizes):
+    for shape, generate in sorted(histories.shapes.items()):
+        config, factory = histories.workflows[shape]
+        registry = SWFWorkflowRegistry()
+        registry.register(config, factory)
+        for size in sizes:
+            pages = generate(size)
+            n = sum(len(p['events']) for p in pages)
+            yield bench('load_events/%s/%s' % (shape, size),
+                        lambda: lambda: load_events(_iter_events(pages)),
+                        repeat, n)
+            yield bench('replay/%s/%s' % (shape, size),
+                        lambda: lambda: registry(_context(pages)),
+                        repeat, n)
+
+
+def bench_proxy_call(repeat, sizes):
+    config, factory = histories.workflows['fanout']
+    for size in sizes:
+        context = _context(histories.fanout(size * 3))
+        calls = size
+
+        def setup():
+            task = config.proxy_factory_registry['task'].bind(context)
+            return lambda: [task(i) for i in range(calls)]
+        yield bench('ContextBoundProxy.__call__/%s' % size, setup, repeat,
+                    calls)
+
+
+def bench_allocations(sizes):
+    """The objects left allocated for each proxy call, per call state."""
+    config, factory = histories.workflows['fanout']
+    for size in sizes:
+        running = _context(histories.fanout(size * 3))
+        running.running.update(running.results)
+        running.results.clear()
+        for state, context in [('result', _context(histories.fanout(size * 3))),
+                               ('placeholder', running)]:
+            def setup(context=context):
+                task = config.proxy_factory_registry['task'].bind(context)
+                return lambda: [task(i) for i in range(size)]
+            yield allocations('allocations/%s/%s' % (state, size), setup,
+                              size)
+
+
+def bench_wait(repeat, sizes):
+    for size in sizes:
+        results = [Result(None, lambda: None, size - i) for i in range(size)]
+        yield bench('wait_first/%s' % size,
+                    lambda: lambda: wait_first(results), repeat, size)
+        yield bench('wait_n/%s' % size,
+                    lambda: lambda: list(wait_n(size // 2, results)),
+                    repeat, size)
+        yield bench('wait_all/%s' % size,
+                    lambda: lambda: list(wait_all(results)), repeat, size)
+
+
+suites = {
+    'recordings': lambda a: bench_recordings(a.repeat),
+    'histories': lambda a: bench_histories(a.repeat, a.sizes),
+    'proxy': lambda a: bench_proxy_call(a.repeat, a.sizes),
+    'allocations': lambda a: bench_allocations(a.sizes),
+    'wait': lambda a: bench_wait(a.repeat, a.sizes),
+}
+
+
+def _revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(__file__)).decode('ascii').strip()
+    except Exception:
+        return None
+
+
+def compare(old, new, threshold):
+    """Print the speed ratios and return the names of the regressions."""
+    old_results = dict((r['name'], r) for r in old['results'])
+    regressions = []
+    for result in new['results']:
+        old_result = old_results.get(result['name'])
+        if old_result is None or not old_result['min']:
+            continue
+        ratio = result['min'] / old_result['min']
+        flag = ''
+        if ratio > threshold:
+            flag = ' <- slower'
+            regressions.append(result['name'])
+        print('%-50s %8.3fx%s' % (result['name'], ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('suites', nargs='*', default=sorted(suites),
+                        help='what to run: %s' % ', '.join(sorted(suites)))
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('-s', '--sizes', default=','.join(map(str, SIZES)),
+                        type=lambda s: [int(x) for x in s.split(',')],
+                        help='comma separated history sizes, in events')
+    parser.add_argument('-o', '--output', help='save the results here')
+    parser.add_argument('-c', '--compare', help='compare with these results')
+    parser.add_argument('-t', '--threshold', type=float, default=1.1,
+                        help='the slowdown ratio considered a regression')
+    args = parser.parse_args()
+
+    results = []
+    for suite in args.suites:
+        for result in suites[suite](args):
+            if 'unit' in result:
+                print('%-50s %12d %12.3f %s/op' % (
+                    result['name'], result['min'], result['per_op'],
+                    result['unit']), file=sys.stderr)
+            else:
+                print('%-50s %12.6fs %12.3fus/op' % (
+                    result['name'], result['min'], result['per_op'] * 1e6),
+                    file=sys.stderr)
+            results.append(result)
+    report = {
+        'revision': _revision(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(json.load(f), report, args.threshold):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
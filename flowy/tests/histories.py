@@ -0,0 +1,208 @@
+"""Synthetic Amazon SWF execution histories.
+
+The generators in this module build decision task pages (as returned by
+PollForDecisionTask) for workflows of a given shape. They are used by the
+benchmarks and by the tests that need histories bigger than the ones recorded
+in the integration logs.
+
+Every generator takes the approximate number of events the history should have
+and returns the list of pages. The activity ids follow the ContextBoundProxy
+naming scheme so the histories can be replayed by the matching workflows:
+
+    fanout  - FanOut, calls `task` once for each item and sums the results
+    chain   - Chain, calls `task` sequentially passing each result to the next
+    retries - Retries, like FanOut but every task times out once
+    timers  - Timers, like FanOut but every task waits for a retry timer
+"""
+
+import itertools
+import json
+
+from flowy.backend.swf import SWFWorkflowConfig
+
+
+DOMAIN = 'Benchmark'
+TASK_LIST = 'benchmark'
+PAGE_SIZE = 1000  # SWF never returns more than 1000 events per page
+
+
+class _History(object):
+    def __init__(self, name, input_data='[[], {}]', start=1400000000.0):
+        self.name = name
+        self.events = []
+        self.clock = itertools.count()
+        self.epoch = start
+        self.add('WorkflowExecutionStarted', {
+            'taskList': {'name': TASK_LIST},
+            'taskStartToCloseTimeout': '10',
+            'executionStartToCloseTimeout': '3600',
+            'childPolicy': 'TERMINATE',
+            'workflowType': {'name': name, 'version': '1'},
+            'input': input_data})
+
+    def add(self, e_type, attrs):
+        event_id = len(self.events) + 1
+        attrs_key = e_type[0].lower() + e_type[1:] + 'EventAttributes'
+        self.events.append({
+            'eventId': event_id,
+            'eventType': e_type,
+            'eventTimestamp': self.epoch + next(self.clock) / 10.0,
+            attrs_key: attrs})
+        return event_id
+
+    def decision(self):
+        scheduled = self.add('DecisionTaskScheduled',
+                             {'taskList': {'name': TASK_LIST}})
+        started = self.add('DecisionTaskStarted',
+                           {'scheduledEventId': scheduled})
+        self.add('DecisionTaskCompleted', {'scheduledEventId': scheduled,
+                                           'startedEventId': started})
+
+    def schedule(self, activity_id, input_data='[[], {}]'):
+        return self.add('ActivityTaskScheduled', {
+            'activityId': activity_id,
+            'activityType': {'name': 'task', 'version': '1'},
+            'taskList': {'name': TASK_LIST},
+            'input': input_data})
+
+    def start(self, scheduled):
+        return self.add('ActivityTaskStarted', {'scheduledEventId': scheduled})
+
+    def complete(self, scheduled, result):
+        return self.add('ActivityTaskCompleted', {'scheduledEventId': scheduled,
+                                                  'result': json.dumps(result)})
+
+    def timeout(self, scheduled):
+        return self.add('ActivityTaskTimedOut', {'scheduledEventId': scheduled,
+                                                 'timeoutType': 'START_TO_CLOSE'})
+
+    def timer(self, timer_id):
+        started = self.add('TimerStarted', {'timerId': timer_id,
+                                            'startToFireTimeout': '1'})
+        self.add('TimerFired', {'timerId': timer_id, 'startedEventId': started})
+
+    def pages(self, page_size=PAGE_SIZE):
+        # open a new decision so the history looks like a real poll response
+        scheduled = self.add('DecisionTaskScheduled',
+                             {'taskList': {'name': TASK_LIST}})
+        self.add('DecisionTaskStarted', {'scheduledEventId': scheduled})
+        result = []
+        for i in range(0, len(self.events), page_size):
+            result.append({
+                'taskToken': 'token-%s' % self.name,
+                'workflowType': {'name': self.name, 'version': '1'},
+                'events': self.events[i:i + page_size],
+                'nextPageToken': 'page-%s' % (i + page_size)})
+        del result[-1]['nextPageToken']
+        return result
+
+
+def _input(count):
+    return json.dumps([[count], {}])
+
+
+def fanout(n_events):
+    """One decision schedules everything, results come back in any order."""
+    count = max(n_events // 3, 1)
+    h = _History('FanOut', _input(count))
+    h.decision()
+    scheduled = [h.schedule('task-%s-0' % i, json.dumps([[i], {}]))
+                 for i in range(count)]
+    for i, s in enumerate(scheduled):
+        h.start(s)
+        h.complete(s, i)
+    return h.pages()
+
+
+def chain(n_events):
+    """A sequence of tasks, each scheduled in a new decision."""
+    count = max(n_events // 6, 1)
+    h = _History('Chain', _input(count))
+    for i in range(count):
+        h.decision()
+        s = h.schedule('task-%s-0' % i, json.dumps([[i], {}]))
+        h.start(s)
+        h.complete(s, i + 1)
+    return h.pages()
+
+
+def retries(n_events):
+    """Like fanout but every task times out once before finishing."""
+    count = max(n_events // 6, 1)
+    h = _History('Retries', _input(count))
+    h.decision()
+    # the retries consume call numbers: the first attempt of call N uses
+    # N * 2 and the second (N * 2 + 1)
+    first = [h.schedule('task-%s-0' % (i * 2), json.dumps([[i], {}]))
+             for i in range(count)]
+    for s in first:
+        h.start(s)
+        h.timeout(s)
+    h.decision()
+    second = [h.schedule('task-%s-1' % (i * 2 + 1), json.dumps([[i], {}]))
+              for i in range(count)]
+    for i, s in enumerate(second):
+        h.start(s)
+        h.complete(s, i)
+    return h.pages()
+
+
+def timers(n_events):
+    """Like fanout but every task waits for a timer before being scheduled."""
+    count = max(n_events // 5, 1)
+    h = _History('Timers', _input(count))
+    h.decision()
+    for i in range(count):
+        h.timer('task-%s-0:t' % i)
+    h.decision()
+    scheduled = [h.schedule('task-%s-0' % i, json.dumps([[i], {}]))
+                 for i in range(count)]
+    for i, s in enumerate(scheduled):
+        h.complete(s, i)
+    return h.pages()
+
+
+shapes = {
+    'fanout': fanout,
+    'chain': chain,
+    'retries': retries,
+    'timers': timers,
+}
+
+
+def _sum_all(results):
+    return sum(r.result() for r in results)
+
+
+class FanOut(object):
+    def __init__(self, task):
+        self.task = task
+
+    def run(self, n):
+        return _sum_all([self.task(i) for i in range(n)])
+
+
+class Chain(object):
+    def __init__(self, task):
+        self.task = task
+
+    def run(self, n):
+        r = 0
+        for _ in range(n):
+            r = self.task(r)
+        return r.result()
+
+
+def _config(name, retry=(0, 0, 0)):
+    config = SWFWorkflowConfig(1, name=name, rate_limit=None)
+    config.conf_activity('task', 1, retry=retry)
+    return config
+
+
+# The (config, workflow factory) pairs that can replay each shape
+workflows = {
+    'fanout': (_config('FanOut'), FanOut),
+    'chain': (_config('Chain'), Chain),
+    'retries': (_config('Retries', retry=(0, 0)), FanOut),
+    'timers': (_config('Timers', retry=(1,)), FanOut),
+}
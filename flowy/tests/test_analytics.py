@@ -0,0 +1,104 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from flowy.analytics import ActivityTable
+from flowy.analytics import COMPLETED
+from flowy.analytics import RUNNING
+from flowy.analytics import TIMED_OUT
+from flowy.analytics import activity_attempts
+from flowy.analytics import load_histories
+from flowy.analytics import numpy
+from flowy.tests.histories import retries
+from flowy.tests.histories import timers
+
+
+def _events(pages):
+    return [e for page in pages for e in page['events']]
+
+
+class TestLoadHistories(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, lines):
+        path = os.path.join(self.path, name)
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return path
+
+    def test_recorded_pages_are_merged(self):
+        pages = retries(60)
+        lines = []
+        for page in pages:
+            lines.append('>>>\tPollForDecisionTask\t{}')
+            lines.append('<<<\t%s' % json.dumps(page))
+        # a later decision reloads the whole history
+        lines.append('>>>\tPollForDecisionTask\t{}')
+        lines.append('<<<\t%s' % json.dumps(pages[0]))
+        lines.append('>>>\tRespondDecisionTaskCompleted\t{}')
+        lines.append('<<<\tnull')
+        lines.append('>>>\tPollForDecisionTask\t{}')
+        lines.append('<<<\tThrottlingException')
+        path = self.write('x.workflow.log', lines)
+        [history] = load_histories([path])
+        self.assertEqual(history, _events(pages))
+
+    def test_exported_histories(self):
+        h1, h2 = _events(retries(60)), _events(timers(60))
+        single = self.write('single.json', [json.dumps({'events': h1})])
+        events = self.write('events.json', [json.dumps(h2)])
+        lines = self.write('lines.json', [json.dumps({'events': h1}),
+                                          json.dumps({'events': h2})])
+        self.assertEqual(load_histories([single, events]), [h1, h2])
+        self.assertEqual(load_histories([lines]), [h1, h2])
+
+
+class TestActivityAttempts(unittest.TestCase):
+    def test_retries(self):
+        rows = list(activity_attempts(_events(retries(12))))
+        self.assertEqual(len(rows), 4)
+        for row in rows[:2]:
+            self.assertEqual(row[:3], ('task:1', 'benchmark', 0))
+            self.assertEqual(row[6], TIMED_OUT)
+            self.assertAlmostEqual(row[5] - row[4], 0.1, places=3)
+        for row in rows[2:]:
+            self.assertEqual(row[:3], ('task:1', 'benchmark', 1))
+            self.assertEqual(row[6], COMPLETED)
+
+    def test_not_started(self):
+        events = _events(timers(10))
+        events = [e for e in events
+                  if e['eventType'] != 'ActivityTaskCompleted']
+        rows = list(activity_attempts(events))
+        self.assertEqual(len(rows), 2)
+        for row in rows:
+            self.assertEqual(row[4:], (None, None, RUNNING))
+
+
+class TestActivityTable(unittest.TestCase):
+    def setUp(self):
+        if numpy is None:
+            raise unittest.SkipTest('NumPy is not installed.')
+
+    def test_report(self):
+        table = ActivityTable.from_histories([_events(retries(60)),
+                                              _events(timers(60))])
+        self.assertEqual(len(table), 32)
+        report = table.report(bucket=1)
+        self.assertEqual(report['attempts'], 32)
+        rates = report['rates']['task:1']
+        self.assertEqual(rates['count'], 32)
+        self.assertAlmostEqual(rates['retry_rate'], 10 / 32.0)
+        self.assertAlmostEqual(rates['timeout_rate'], 10 / 32.0)
+        self.assertEqual(rates['failure_rate'], 0)
+        # the timers activities are never started
+        [p50, p90, p99] = report['start_to_close']['task:1']
+        self.assertAlmostEqual(p50, 0.1, places=3)
+        self.assertIn('benchmark', report['queueing_delay'])
+        self.assertEqual(sum(report['throughput']['counts']), 32)
@@ -0,0 +1,95 @@
+import json
+from unittest import TestCase
+
+from flowy.backend.local import LocalExecutor
+from flowy.backend.local import LocalWorkflowConfig
+from flowy.backend.swf import SWFWorkflowConfig
+from flowy.base import TaskError
+from flowy.dag import DAG
+from flowy.tests.test_swf import make_context
+from flowy.tests.test_swf import run_workflow
+
+
+def double(x):
+    return x * 2
+
+
+def add(numbers, more=0):
+    return sum(numbers) + more
+
+
+def fail(x):
+    raise ValueError('err!')
+
+
+def diamond():
+    dag = DAG('Diamond')
+    left = dag.task('double', dag.input(0))
+    right = dag.task('double', dag.input('n'))
+    dag.output(dag.task('add', [left, right], more=left))
+    return dag
+
+
+class TestLocalDAG(TestCase):
+    def setUp(self):
+        self.executor = LocalExecutor(workers=2)
+
+    def tearDown(self):
+        self.executor.close()
+
+    def config(self, double=double):
+        config = LocalWorkflowConfig()
+        config.conf_activity('double', double)
+        config.conf_activity('add', add)
+        return config
+
+    def test_output(self):
+        result = self.executor.run(self.config(), diamond(), 1, n=2)
+        self.assertEqual(result, 2 + 4 + 2)
+
+    def test_no_output(self):
+        dag = DAG()
+        dag.task('add', [dag.task('double', i) for i in range(3)])
+        self.assertEqual(self.executor.run(self.config(), dag), None)
+
+    def test_errors(self):
+        with self.assertRaises(TaskError):
+            self.executor.run(self.config(fail), diamond(), 1, n=2)
+
+    def test_foreign_tasks(self):
+        other = DAG().task('double', 1)
+        self.assertRaises(ValueError, DAG().task, 'add', [other])
+
+
+class TestSWFDAG(TestCase):
+    def decide(self, running=(), results=None):
+        config = SWFWorkflowConfig(1)
+        config.conf_activity('double', 1)
+        config.conf_activity('add', 1)
+        context = make_context(running, results=results,
+                               order=sorted(results or {}),
+                               input_data='[[1], {"n": 2}]')
+        return run_workflow(config, diamond(), context)
+
+    def test_roots(self):
+        decisions = self.decide()
+        self.assertEqual(
+            [d['scheduleActivityTaskDecisionAttributes']['activityId']
+             for d in decisions], ['double-0-0', 'double-1-0'])
+
+    def test_call_keys_follow_the_tasks(self):
+        # the first task is still running, the second is not reached yet
+        self.assertEqual(self.decide(running=['double-0-0',
+                                              'double-1-0']), [])
+        decisions = self.decide(results={'double-0-0': '2',
+                                         'double-1-0': '4'})
+        [decision] = decisions
+        attrs = decision['scheduleActivityTaskDecisionAttributes']
+        self.assertEqual(attrs['activityId'], 'add-0-0')
+        self.assertEqual(json.loads(attrs['input']), [[[2, 4]], {'more': 2}])
+
+    def test_finish(self):
+        [decision] = self.decide(results={'double-0-0': '2',
+                                          'double-1-0': '4', 'add-0-0': '8'})
+        self.assertEqual(decision['decisionType'],
+                         'CompleteWorkflowExecution')
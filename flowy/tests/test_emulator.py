@@ -0,0 +1,608 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from boto.swf.exceptions import SWFTypeAlreadyExistsError
+from boto.swf.exceptions import SWFWorkflowExecutionAlreadyStartedError
+
+from flowy.backend.swf import SWFActivityConfig
+from flowy.backend.swf import SWFActivityRegistry
+from flowy.backend.swf import SWFActivityWorker
+from flowy.backend.swf import SWFCompletionService
+from flowy.backend.swf import SWFWorkflowConfig
+from flowy.backend.swf import SWFWorkflowRegistry
+from flowy.backend.swf import SWFWorkflowStarter
+from flowy.backend.swf import SWFWorkflowWorker
+from flowy.backend.swf import _RegistrationError
+from flowy.backend.swf import _WeightedQueue
+from flowy.backend.swf import _run_activity
+from flowy.backend.swf import pending
+from flowy.backend.swf import poll_next_decision
+from flowy.backend.swf import task_token
+from flowy.emulator import SWFEmulator
+from flowy.emulator import layer1
+from flowy.emulator import serve
+
+
+DOMAIN = 'emulated'
+TASK_LIST = 'decisions'
+
+
+class Child(object):
+    def __init__(self, double):
+        self.double = double
+
+    def run(self, n):
+        return sum(r.result() for r in map(self.double, range(n)))
+
+
+class Parent(object):
+    def __init__(self, child, double):
+        self.child = child
+        self.double = double
+
+    def run(self, n):
+        return self.child(n).result() + self.double(n).result()
+
+
+child = SWFWorkflowConfig(1, default_task_list=TASK_LIST,
+                          default_workflow_duration=600,
+                          default_decision_duration=10,
+                          default_child_policy='TERMINATE')
+child.conf_activity('double', 1, task_list='activities', heartbeat=10,
+                    schedule_to_close=60, schedule_to_start=60,
+                    start_to_close=5, retry=(0, 3))
+parent = SWFWorkflowConfig(1, default_task_list=TASK_LIST,
+                           default_workflow_duration=600,
+                           default_decision_duration=10,
+                           default_child_policy='TERMINATE')
+parent.conf_workflow('child', 1, name='Child')
+parent.conf_activity('double', 1, task_list='activities', heartbeat=10,
+                     schedule_to_close=60, schedule_to_start=60,
+                     start_to_close=5)
+
+
+local_calls = []
+
+
+def local_half(x):
+    local_calls.append(x)
+    return x // 2
+
+
+class Local(object):
+    def __init__(self, half, double):
+        self.half = half
+        self.double = double
+
+    def run(self, n):
+        return self.double(self.half(n)).result() + self.half(n + 2).result()
+
+
+local = SWFWorkflowConfig(1, default_task_list=TASK_LIST,
+                          default_workflow_duration=600,
+                          default_decision_duration=10,
+                          default_child_policy='TERMINATE')
+local.conf_local_activity('half', local_half)
+local.conf_activity('double', 1, task_list='activities', heartbeat=10,
+                    schedule_to_close=60, schedule_to_start=60,
+                    start_to_close=5)
+
+
+hedged = SWFWorkflowConfig(1, default_task_list=TASK_LIST,
+                           default_workflow_duration=600,
+                           default_decision_duration=10,
+                           default_child_policy='TERMINATE')
+hedged.conf_activity('double', 1, task_list='activities', heartbeat=10,
+                     schedule_to_close=60, schedule_to_start=60,
+                     start_to_close=30, hedge_after=5)
+
+
+class Hedged(object):
+    def __init__(self, double):
+        self.double = double
+
+    def run(self, n):
+        return self.double(n).result()
+
+
+class TestEmulator(TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        emulator = SWFEmulator(poll_timeout=0.05, clock=lambda: self.now)
+        self.emulator = emulator
+        self.server = serve(port=0, tick=3600, emulator=emulator)
+        self.layer1 = layer1(*self.server.server_address)
+        self.registry = SWFWorkflowRegistry()
+        self.registry.register(child, Child)
+        self.registry.register(parent, Parent)
+        self.registry.register(local, Local)
+        self.registry.register(hedged, Hedged)
+        self.registry.register_remote(self.layer1, DOMAIN)
+        self.layer1.register_activity_type(DOMAIN, 'double', '1')
+
+    def tearDown(self):
+        self.server.shutdown()
+
+    def start(self, name, *args):
+        starter = SWFWorkflowStarter(self.layer1, setup_log=False)
+        return starter.start(DOMAIN, name, 1, wid=name)(*args)
+
+    def advance(self, seconds):
+        self.now += seconds
+        self.emulator.tick()
+
+    def decide(self):
+        """Run all the pending decisions."""
+        while self.layer1.count_pending_decision_tasks(
+                DOMAIN, TASK_LIST)['count']:
+            self.registry(poll_next_decision(self.layer1, DOMAIN, TASK_LIST))
+
+    def work(self, respond=True):
+        """Run all the pending activities and return how many there were."""
+        done = 0
+        while 1:
+            task = self.layer1.poll_for_activity_task(DOMAIN, 'activities')
+            if not task['taskToken']:
+                return done
+            done += 1
+            if respond:
+                [[x], _] = json.loads(task['input'])
+                self.layer1.respond_activity_task_completed(
+                    task['taskToken'], json.dumps(x * 2))
+
+    def history(self, wid):
+        run_id = self.emulator.db.execute(
+            'SELECT run_id FROM executions WHERE workflow_id = ?',
+            (wid,)).fetchone()[0]
+        response = self.layer1.get_workflow_execution_history(
+            DOMAIN, run_id, wid)
+        return response['events']
+
+    def test_workflow_with_child(self):
+        self.assertTrue(self.start('Parent', 4))
+        self.decide()  # the child is started and schedules its activities
+        self.assertEqual(self.work(), 4)
+        self.decide()
+        self.assertEqual(self.work(), 1)
+        self.decide()
+        last = self.history('Parent')[-1]
+        self.assertEqual(last['eventType'], 'WorkflowExecutionCompleted')
+        result = last['workflowExecutionCompletedEventAttributes']['result']
+        self.assertEqual(json.loads(result), 12 + 8)
+
+    def test_local_activities(self):
+        del local_calls[:]
+        self.assertTrue(self.start('Local', 8))
+        self.decide()
+        self.assertEqual(self.work(), 1)
+        self.decide()
+        # each local activity ran once, the replays used the markers
+        self.assertEqual(local_calls, [8, 10])
+        last = self.history('Local')[-1]
+        result = last['workflowExecutionCompletedEventAttributes']['result']
+        self.assertEqual(json.loads(result), 8 + 5)
+
+    def test_hedged_activities(self):
+        self.assertTrue(self.start('Hedged', 3))
+        self.decide()
+        slow = self.layer1.poll_for_activity_task(DOMAIN, 'activities')
+        self.advance(5)
+        self.decide()  # the hedge timer fired, the duplicate is scheduled
+        self.assertEqual(self.work(), 1)
+        self.decide()
+        events = self.history('Hedged')
+        last = events[-1]
+        result = last['workflowExecutionCompletedEventAttributes']['result']
+        self.assertEqual(json.loads(result), 6)
+        [requested] = [e for e in events
+                       if e['eventType'] == 'ActivityTaskCancelRequested']
+        attrs = requested['activityTaskCancelRequestedEventAttributes']
+        self.assertEqual(attrs['activityId'], slow['activityId'])
+
+    def test_decision_pagination(self):
+        self.start('Child', 2)
+        first = self.layer1.poll_for_decision_task(DOMAIN, TASK_LIST,
+                                                   maximum_page_size=1)
+        events = first['events']
+        page = first
+        while page.get('nextPageToken'):
+            page = self.layer1.poll_for_decision_task(
+                DOMAIN, TASK_LIST, maximum_page_size=1,
+                next_page_token=page['nextPageToken'])
+            self.assertEqual(page['taskToken'], first['taskToken'])
+            events.extend(page['events'])
+        self.assertEqual([e['eventType'] for e in events], [
+            'WorkflowExecutionStarted', 'DecisionTaskScheduled',
+            'DecisionTaskStarted'])
+        self.assertEqual(events[-1]['eventId'], first['startedEventId'])
+
+    def test_timeouts_and_timers(self):
+        self.start('Child', 1)
+        self.decide()
+        self.assertEqual(self.work(respond=False), 1)
+        self.advance(6)  # the start to close timeout is 5 seconds
+        self.decide()  # the retry is scheduled with a delay of 3 seconds
+        self.assertEqual(self.work(), 0)
+        self.advance(3)
+        self.decide()
+        self.assertEqual(self.work(), 1)
+        self.decide()
+        event_types = [e['eventType'] for e in self.history('Child')]
+        for e_type in ['ActivityTaskTimedOut', 'TimerStarted', 'TimerFired',
+                       'ActivityTaskCompleted', 'WorkflowExecutionCompleted']:
+            self.assertIn(e_type, event_types)
+
+    def test_execution_timeout(self):
+        self.start('Child', 1)
+        self.advance(601)
+        self.assertEqual(self.history('Child')[-1]['eventType'],
+                         'WorkflowExecutionTimedOut')
+
+    def test_faults(self):
+        with self.assertRaises(SWFTypeAlreadyExistsError):
+            self.layer1.register_activity_type(DOMAIN, 'double', '1')
+        self.assertTrue(self.start('Child', 1))
+        with self.assertRaises(SWFWorkflowExecutionAlreadyStartedError):
+            self.layer1.start_workflow_execution(DOMAIN, 'Child', 'Child', '1')
+
+
+class NoCalls(object):
+    def __getattr__(self, name):
+        raise AssertionError('Unexpected remote call: %s' % name)
+
+
+class TestRegistration(TestCase):
+    def setUp(self):
+        self.server = serve(port=0, poll_timeout=0.05)
+        self.layer1 = layer1(*self.server.server_address)
+        self.path = tempfile.mkdtemp()
+        self.cache = os.path.join(self.path, 'registered.json')
+
+    def tearDown(self):
+        self.server.shutdown()
+        shutil.rmtree(self.path)
+
+    def registry(self, n, task_list=TASK_LIST):
+        registry = SWFWorkflowRegistry()
+        for i in range(n):
+            config = SWFWorkflowConfig(1, name='W%s' % i,
+                                       default_task_list=task_list,
+                                       default_child_policy='TERMINATE')
+            registry.register(config, Child)
+        return registry
+
+    def test_cached_registration(self):
+        self.registry(20).register_remote(self.layer1, DOMAIN,
+                                          cache=self.cache)
+        types = self.layer1.list_workflow_types(DOMAIN, 'REGISTERED')
+        self.assertEqual(len(types['typeInfos']), 20)
+        # nothing changed, no remote calls are needed
+        self.registry(20).register_remote(NoCalls(), DOMAIN, cache=self.cache)
+
+    def test_only_new_types_are_registered(self):
+        self.registry(10).register_remote(self.layer1, DOMAIN,
+                                          cache=self.cache)
+        self.registry(12).register_remote(self.layer1, DOMAIN,
+                                          cache=self.cache)
+        types = self.layer1.list_workflow_types(DOMAIN, 'REGISTERED')
+        self.assertEqual(len(types['typeInfos']), 12)
+
+    def test_one_client_per_thread(self):
+        address = self.server.server_address
+        clients = []
+
+        def layer1_factory():
+            clients.append(threading.current_thread())
+            return layer1(*address)
+
+        self.registry(20).register_remote(self.layer1, DOMAIN, workers=4,
+                                          layer1_factory=layer1_factory)
+        types = self.layer1.list_workflow_types(DOMAIN, 'REGISTERED')
+        self.assertEqual(len(types['typeInfos']), 20)
+        self.assertTrue(1 <= len(clients) <= 4)
+        self.assertEqual(len(set(clients)), len(clients))
+
+    def test_incompatible(self):
+        self.registry(3).register_remote(self.layer1, DOMAIN,
+                                         cache=self.cache)
+        with self.assertRaises(_RegistrationError):
+            self.registry(3, task_list='other').register_remote(
+                self.layer1, DOMAIN, cache=self.cache)
+        # without the cache, the existing types are checked too
+        self.registry(3).register_remote(self.layer1, DOMAIN)
+
+
+# the activities are scheduled with the registered defaults
+defaults = SWFWorkflowConfig(1, name='Defaults', default_task_list=TASK_LIST,
+                             default_workflow_duration=600,
+                             default_decision_duration=10,
+                             default_child_policy='TERMINATE')
+defaults.conf_activity('double', 1, task_list='activities')
+
+
+class Mapped(object):
+    def __init__(self, double):
+        self.double = double
+
+    def run(self, n):
+        return self.double(range(n)).result()
+
+
+mapped = SWFWorkflowConfig(1, name='Mapped', default_task_list=TASK_LIST,
+                           default_workflow_duration=600,
+                           default_decision_duration=10,
+                           default_child_policy='TERMINATE')
+mapped.conf_map('double', 1, task_list='activities', shard_size=3)
+
+
+def double(x):
+    return x * 2
+
+
+def triple(x):
+    return x * 3
+
+
+def slow_triple(x):
+    time.sleep(3)
+    return x * 3
+
+
+tokens = []
+
+
+def external_triple(x):
+    tokens.append((task_token(), x))
+    return pending
+
+
+class TestActivityWorker(TestCase):
+    def setUp(self):
+        self.server = serve(port=0, poll_timeout=0.05)
+        self.layer1 = layer1(*self.server.server_address)
+        self.registry = SWFWorkflowRegistry()
+        self.registry.register(defaults, Child)
+        self.registry.register_remote(self.layer1, DOMAIN)
+        self.activities = SWFActivityRegistry()
+        self.worker = None
+
+    def tearDown(self):
+        if self.worker is not None:
+            self.worker.stop()
+        self.server.shutdown()
+
+    def start_worker(self, activity, heartbeat=10, **kwargs):
+        config = SWFActivityConfig(1, name='double', default_heartbeat=heartbeat,
+                                   default_schedule_to_close=60,
+                                   default_schedule_to_start=60,
+                                   default_start_to_close=60)
+        self.activities.register(config, activity)
+        self.activities.register_remote(self.layer1, DOMAIN)
+        address = self.server.server_address
+        self.worker = SWFActivityWorker(DOMAIN, 'activities', self.activities,
+                                        layer1_factory=lambda: layer1(*address),
+                                        **kwargs)
+        self.worker.start()
+
+    def run_workflow(self, n, timeout=10, idle=None, name='Defaults'):
+        starter = SWFWorkflowStarter(self.layer1, setup_log=False)
+        starter.start(DOMAIN, name, 1, wid=name)(n)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if idle is not None:
+                idle()
+            while self.layer1.count_pending_decision_tasks(
+                    DOMAIN, TASK_LIST)['count']:
+                self.registry(poll_next_decision(self.layer1, DOMAIN,
+                                                 TASK_LIST))
+            run_id = self.server.emulator.db.execute(
+                'SELECT run_id FROM executions WHERE workflow_id = ?',
+                (name,)).fetchone()[0]
+            events = self.layer1.get_workflow_execution_history(
+                DOMAIN, run_id, name)['events']
+            last = events[-1]
+            if last['eventType'] == 'WorkflowExecutionCompleted':
+                attrs = last['workflowExecutionCompletedEventAttributes']
+                return json.loads(attrs['result']), events
+            time.sleep(0.05)
+        self.fail('The workflow did not finish in time.')
+
+    def test_thread_pool(self):
+        self.start_worker(triple, workers=4)
+        result, _ = self.run_workflow(10)
+        self.assertEqual(result, sum(range(10)) * 3)
+
+    def test_process_pool(self):
+        self.start_worker(triple, workers=2, processes=True)
+        result, _ = self.run_workflow(10)
+        self.assertEqual(result, sum(range(10)) * 3)
+
+    def test_map(self):
+        self.registry.register(mapped, Mapped)
+        self.registry.register_remote(self.layer1, DOMAIN)
+        self.start_worker(triple, workers=4)
+        result, events = self.run_workflow(10, name='Mapped')
+        self.assertEqual(result, [x * 3 for x in range(10)])
+        # 9 items in a shard of 3 shards and 1 item in another shard
+        e_types = [e['eventType'] for e in events]
+        self.assertEqual(e_types.count('StartChildWorkflowExecutionInitiated'),
+                         2)
+        self.assertNotIn('ActivityTaskScheduled', e_types)
+        children = self.server.emulator.db.execute(
+            'SELECT COUNT(*) FROM executions WHERE parent_run_id IS NOT NULL'
+        ).fetchone()[0]
+        self.assertEqual(children, 5)
+
+    def test_heartbeats(self):
+        # it takes longer than the heartbeat timeout to finish
+        self.start_worker(slow_triple, heartbeat=2, workers=1)
+        result, events = self.run_workflow(1)
+        self.assertEqual(result, 0)
+        self.assertNotIn('ActivityTaskTimedOut',
+                         [e['eventType'] for e in events])
+
+    def test_external_completion(self):
+        path = tempfile.mkdtemp()
+        outbox = os.path.join(path, 'outbox.sqlite')
+        del tokens[:]
+        self.start_worker(external_triple, heartbeat=3600, workers=2)
+
+        def complete():
+            # the completions are saved in the outbox first
+            while tokens:
+                token, x = tokens.pop()
+                SWFCompletionService(NoCalls(), outbox).complete(token, x * 3)
+            SWFCompletionService(self.layer1, outbox).flush()
+        try:
+            result, _ = self.run_workflow(10, idle=complete)
+        finally:
+            shutil.rmtree(path)
+        self.assertEqual(result, sum(range(10)) * 3)
+
+    def test_separate_registries(self):
+        # the same activity type is run by each worker with its own registry
+        workers = []
+        for activity in (triple, double):
+            activities = SWFActivityRegistry()
+            activities.register(SWFActivityConfig(1, name='double'), activity)
+            workers.append(SWFActivityWorker(DOMAIN, 'activities', activities,
+                                             layer1_factory=NoCalls,
+                                             workers=1))
+        try:
+            results = [w.pool.apply(_run_activity,
+                                    (('double', '1'), '[[5], {}]'))
+                       for w in workers]
+        finally:
+            for w in workers:
+                w.pool.close()
+                w.pool.join()
+        self.assertEqual(results, [(True, '15'), (True, '10')])
+
+
+class TestCompletionService(TestCase):
+    def setUp(self):
+        self.server = serve(port=0, poll_timeout=0.05)
+        self.layer1 = layer1(*self.server.server_address)
+
+    def tearDown(self):
+        self.server.shutdown()
+
+    def test_closed_tasks_are_dropped(self):
+        service = SWFCompletionService(self.layer1)
+        service.complete('unknown', 1)
+        self.assertEqual(service.flush(), 0)
+        self.assertEqual(service.db.execute(
+            'SELECT COUNT(*) FROM outbox').fetchone()[0], 0)
+
+    def test_retries(self):
+        service = SWFCompletionService(NoCalls(), max_attempts=2)
+        service.fail('token', 'err!')
+        self.assertEqual(service.flush(), 0)
+        self.assertEqual(service.db.execute(
+            'SELECT attempts FROM outbox').fetchone()[0], 1)
+        service.db.execute('UPDATE outbox SET send_at = 0')
+        service.flush()
+        self.assertEqual(service.db.execute(
+            'SELECT COUNT(*) FROM outbox').fetchone()[0], 0)
+
+
+class Echo(object):
+    def run(self, n):
+        return n
+
+
+class RecordingQueue(_WeightedQueue):
+    """Keep the task list of each decision run, in order."""
+    def __init__(self, weights):
+        super(RecordingQueue, self).__init__(weights)
+        self.picked = []
+
+    def get(self, timeout=None):
+        context = super(RecordingQueue, self).get(timeout)
+        self.picked.append(context.task_list)
+        return context
+
+
+class TestWorkflowWorker(TestCase):
+    task_lists = [(DOMAIN, 'a', 1), (DOMAIN, 'b', 1), ('other', 'c', 3)]
+
+    def setUp(self):
+        self.server = serve(port=0, poll_timeout=0.05)
+        self.layer1 = layer1(*self.server.server_address)
+        self.registry = SWFWorkflowRegistry()
+        for domain, task_list, _ in self.task_lists:
+            config = SWFWorkflowConfig(1, name='Echo-%s' % task_list,
+                                       default_task_list=task_list,
+                                       default_workflow_duration=600,
+                                       default_decision_duration=10,
+                                       default_child_policy='TERMINATE')
+            self.registry.register(config, Echo)
+        for domain in (DOMAIN, 'other'):
+            self.registry.register_remote(self.layer1, domain)
+        self.taken_at_poll = []
+        self.make_worker(executors=2)
+
+    def make_worker(self, executors):
+        self.worker = SWFWorkflowWorker(
+            self.task_lists, self.registry, layer1_factory=self.layer1_factory,
+            max_pollers=3, executors=executors)
+        self.worker.ready = RecordingQueue([w for _, _, w in self.task_lists])
+        self.thread = threading.Thread(target=self.worker.run)
+
+    def layer1_factory(self):
+        client = layer1(*self.server.server_address)
+        poll = client.poll_for_decision_task
+
+        def checked_poll(*args, **kwargs):
+            self.taken_at_poll.append(self.worker.taken)
+            return poll(*args, **kwargs)
+        client.poll_for_decision_task = checked_poll
+        return client
+
+    def tearDown(self):
+        self.worker.stop()
+        self.thread.join()
+        self.server.shutdown()
+
+    def wait_for(self, predicate, timeout=10):
+        deadline = time.time() + timeout
+        while not predicate():
+            self.assertTrue(time.time() < deadline, 'Timed out.')
+            time.sleep(0.05)
+
+    def start_workflows(self, n):
+        starter = SWFWorkflowStarter(self.layer1, setup_log=False)
+        for domain, task_list, _ in self.task_lists:
+            for i in range(n):
+                starter.start(domain, 'Echo-%s' % task_list, 1,
+                              wid='%s-%s' % (task_list, i))(i)
+
+    def test_all_task_lists(self):
+        self.worker.start()
+        self.thread.start()
+        self.start_workflows(5)
+        db = self.server.emulator.db
+        self.wait_for(lambda: db.execute(
+            "SELECT COUNT(*) FROM executions WHERE status = 'COMPLETED'"
+        ).fetchone()[0] == 15)
+        # the extra pollers exit once there's no more work
+        self.wait_for(lambda: self.worker.pollers == [1, 1, 1])
+        # no poll was made while both executors were taken
+        self.assertTrue(self.taken_at_poll)
+        self.assertTrue(max(self.taken_at_poll) < 2)
+
+    def test_weights_decide_the_order(self):
+        self.make_worker(executors=1)
+        self.start_workflows(1)
+        # no task list holds the only executor while it polls, so all of them
+        # take their decision before any is run
+        self.worker.start()
+        self.wait_for(lambda: self.worker.taken == 3)
+        self.thread.start()
+        self.wait_for(lambda: len(self.worker.ready.picked) == 3)
+        self.assertEqual(self.worker.ready.picked, ['c', 'a', 'b'])
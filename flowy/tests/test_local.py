@@ -0,0 +1,246 @@
+import time
+from unittest import TestCase
+
+from flowy.backend.local import LocalExecutor
+from flowy.backend.local import LocalWorkflowConfig
+from flowy.base import RetryPolicy
+from flowy.base import TaskError
+from flowy.base import TaskTimedout
+from flowy.base import restart
+from flowy.base import wait_first
+
+
+def double(x):
+    return x * 2
+
+
+def add(*args):
+    return sum(args)
+
+
+def fail():
+    raise ValueError('err!')
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+class MapReduce(object):
+    def __init__(self, double, add):
+        self.double = double
+        self.add = add
+
+    def run(self, n):
+        return self.add(*[self.double(i) for i in range(n)]).result()
+
+
+map_reduce = LocalWorkflowConfig()
+map_reduce.conf_activity('double', double)
+map_reduce.conf_activity('add', add)
+
+
+def add_nested(numbers, more):
+    return sum(numbers) + more['a'] + sum(more['b'])
+
+
+class Nested(object):
+    def __init__(self, double, add):
+        self.double = double
+        self.add = add
+
+    def run(self, n):
+        doubles = [self.double(i) for i in range(n)]
+        more = {'a': self.double(n), 'b': (self.double(1),)}
+        return self.add(doubles, more).result()
+
+
+nested = LocalWorkflowConfig()
+nested.conf_activity('double', double)
+nested.conf_activity('add', add_nested)
+
+
+def nested_errors():
+    config = LocalWorkflowConfig()
+    config.conf_activity('double', fail)
+    config.conf_activity('add', add_nested)
+    return config
+
+
+class Parent(object):
+    def __init__(self, child):
+        self.child = child
+
+    def run(self, n):
+        return self.child(n).result() + 1
+
+
+parent = LocalWorkflowConfig()
+parent.conf_workflow('child', map_reduce, MapReduce)
+
+
+class Failing(object):
+    def __init__(self, fail):
+        self.fail = fail
+
+    def run(self):
+        try:
+            self.fail().result()
+        except TaskError as e:
+            return 'caught %s' % e
+
+
+failing = LocalWorkflowConfig()
+failing.conf_activity('fail', fail)
+
+
+class WorkflowError(object):
+    def run(self):
+        raise ValueError('err!')
+
+
+class Restarting(object):
+    def run(self, n):
+        if n < 3:
+            return restart(n + 1)
+        return n
+
+
+class Timeouts(object):
+    def __init__(self, sleep):
+        self.sleep = sleep
+
+    def run(self):
+        slow, fast = self.sleep(1), self.sleep(0)
+        first = wait_first(slow, fast).result()
+        try:
+            slow.result()
+        except TaskTimedout:
+            return first, 'timedout'
+
+
+timeouts = LocalWorkflowConfig()
+timeouts.conf_activity('sleep', sleep, retry=(0,), timeout=0.2)
+
+
+class Delays(object):
+    def __init__(self, double):
+        self.double = double
+
+    def run(self):
+        return self.double(21).result()
+
+
+delays = LocalWorkflowConfig()
+delays.conf_activity('double', double, retry=(0.1,))
+
+
+attempts = []
+
+
+def flaky(x):
+    attempts.append(x)
+    if len(attempts) < 3:
+        raise ValueError('flaky %s' % len(attempts))
+    return x * 2
+
+
+class Flaky(object):
+    def __init__(self, flaky):
+        self.flaky = flaky
+
+    def run(self):
+        try:
+            return self.flaky(21).result()
+        except TaskError as e:
+            return str(e)
+
+
+def flaky_config(**kwargs):
+    config = LocalWorkflowConfig()
+    config.conf_activity('flaky', flaky, retry=RetryPolicy(delay=0, **kwargs))
+    return config
+
+
+class TestLocalExecutor(TestCase):
+    def setUp(self):
+        self.executor = LocalExecutor(workers=4)
+
+    def tearDown(self):
+        self.executor.close()
+
+    def test_map_reduce(self):
+        result = self.executor.run(map_reduce, MapReduce, 10)
+        self.assertEqual(result, 90)
+
+    def test_nested_results(self):
+        self.assertEqual(self.executor.run(nested, Nested, 10), 112)
+
+    def test_nested_errors(self):
+        with self.assertRaises(TaskError):
+            self.executor.run(nested_errors(), Nested, 3)
+
+    def test_subworkflow(self):
+        self.assertEqual(self.executor.run(parent, Parent, 10), 91)
+
+    def test_activity_errors(self):
+        self.assertEqual(self.executor.run(failing, Failing), 'caught err!')
+
+    def test_workflow_errors(self):
+        config = LocalWorkflowConfig()
+        with self.assertRaises(TaskError):
+            self.executor.run(config, WorkflowError)
+
+    def test_restart(self):
+        config = LocalWorkflowConfig()
+        self.assertEqual(self.executor.run(config, Restarting, 0), 3)
+
+    def test_timeout(self):
+        result = self.executor.run(timeouts, Timeouts)
+        self.assertEqual(result, (0, 'timedout'))
+
+    def test_delay(self):
+        self.assertEqual(self.executor.run(delays, Delays), 42)
+
+    def test_retry_errors(self):
+        del attempts[:]
+        config = flaky_config(retry_on=lambda reason: 'flaky' in reason)
+        self.assertEqual(self.executor.run(config, Flaky), 42)
+        self.assertEqual(len(attempts), 3)
+
+    def test_errors_not_retried_by_default(self):
+        del attempts[:]
+        self.assertEqual(self.executor.run(flaky_config(), Flaky), 'flaky 1')
+
+    def test_max_attempts(self):
+        del attempts[:]
+        config = flaky_config(max_attempts=2, retry_on=lambda reason: True)
+        self.assertEqual(self.executor.run(config, Flaky), 'flaky 2')
+
+
+def unpicklable_result():
+    return lambda: None
+
+
+class TestLocalProcessExecutor(TestCase):
+    def setUp(self):
+        self.executor = LocalExecutor(workers=2, processes=True)
+
+    def tearDown(self):
+        self.executor.close()
+
+    def test_map_reduce(self):
+        self.assertEqual(self.executor.run(map_reduce, MapReduce, 10), 90)
+
+    def test_unpicklable_activity(self):
+        config = LocalWorkflowConfig()
+        config.conf_activity('fail', lambda: 1)
+        result = self.executor.run(config, Failing)
+        self.assertTrue(result.startswith('caught '))
+
+    def test_unpicklable_result(self):
+        config = LocalWorkflowConfig()
+        config.conf_activity('fail', unpicklable_result)
+        result = self.executor.run(config, Failing)
+        self.assertTrue(result.startswith('caught '))
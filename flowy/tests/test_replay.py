@@ -0,0 +1,49 @@
+import json
+from unittest import TestCase
+
+from flowy.backend.swf import SWFWorkflowRegistry
+from flowy.replay import StackProfiler
+from flowy.replay import _until
+from flowy.replay import replay
+from flowy.tests import histories
+
+
+def _registry_and_events(shape, n_events=100):
+    registry = SWFWorkflowRegistry()
+    registry.register(*histories.workflows[shape])
+    pages = histories.shapes[shape](n_events)
+    return registry, [e for page in pages for e in page['events']]
+
+
+class TestReplay(TestCase):
+    def test_complete(self):
+        registry, events = _registry_and_events('fanout')
+        timings, decisions = replay(registry, events)
+        self.assertEqual(sorted(timings), ['decide', 'load_events'])
+        [decision] = decisions
+        self.assertEqual(decision['decisionType'],
+                         'CompleteWorkflowExecution')
+        attrs = decision['completeWorkflowExecutionDecisionAttributes']
+        self.assertEqual(json.loads(attrs['result']), sum(range(33)))
+
+    def test_until(self):
+        registry, events = _registry_and_events('chain', 60)
+        # the first task completed in the 6th event, the next decision follows
+        _, decisions = replay(registry, _until(events, 7))
+        [decision] = decisions
+        self.assertEqual(decision['decisionType'], 'ScheduleActivityTask')
+        attrs = decision['scheduleActivityTaskDecisionAttributes']
+        self.assertEqual(attrs['activityId'], 'task-1-0')
+
+    def test_collapsed_stacks(self):
+        registry, events = _registry_and_events('fanout')
+        profiler = StackProfiler()
+        _, decisions = replay(registry, events, profiler=profiler)
+        self.assertEqual(len(decisions), 1)
+        lines = profiler.collapsed()
+        self.assertTrue(lines)
+        for line in lines:
+            stack, duration = line.rsplit(' ', 1)
+            self.assertTrue(int(duration) > 0)
+            self.assertTrue(stack.startswith('__call__ (swf.py:'))
+        self.assertTrue(any('run (histories.py:' in line for line in lines))
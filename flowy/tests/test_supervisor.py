@@ -0,0 +1,87 @@
+import os
+import shutil
+import signal
+import tempfile
+import time
+from unittest import TestCase
+
+from flowy.supervisor import Supervisor
+
+
+class TestSupervisor(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.supervisor_pid = None
+
+    def tearDown(self):
+        if self.supervisor_pid is not None:
+            self.stop()
+        shutil.rmtree(self.path)
+
+    def start(self, run, **kwargs):
+        """Start a supervisor in a new process with workers that call run
+        with the task number."""
+        def worker_factory():
+            tasks = iter(range(1000))
+            poll = lambda: time.sleep(0.01) or next(tasks)
+            return poll, run
+        pid = os.fork()
+        if pid == 0:
+            try:
+                Supervisor(worker_factory, **kwargs).run()
+            finally:
+                os._exit(0)
+        self.supervisor_pid = pid
+
+    def stop(self):
+        os.kill(self.supervisor_pid, signal.SIGTERM)
+        os.waitpid(self.supervisor_pid, 0)
+        self.supervisor_pid = None
+
+    def done(self, n):
+        open(os.path.join(self.path, '%s-%s' % (os.getpid(), n)), 'w').close()
+
+    def pids(self):
+        """Map each worker pid to the number of tasks done."""
+        pids = {}
+        for name in os.listdir(self.path):
+            pid = name.split('-')[0]
+            pids[pid] = pids.get(pid, 0) + 1
+        return pids
+
+    def wait_for(self, predicate, timeout=10):
+        deadline = time.time() + timeout
+        while not predicate():
+            self.assertTrue(time.time() < deadline, 'Timed out.')
+            time.sleep(0.05)
+
+    def test_recycle(self):
+        self.start(self.done, workers=2, max_tasks=3)
+        self.wait_for(lambda: sum(self.pids().values()) >= 12)
+        self.stop()
+        pids = self.pids()
+        self.assertTrue(len(pids) >= 4)
+        self.assertTrue(max(pids.values()) <= 3)
+
+    def test_crashed_workers_are_restarted(self):
+        def crash(n):
+            self.done(n)
+            raise ValueError('err!')
+        self.start(crash, workers=2, restart_delay=0.1)
+        self.wait_for(lambda: len(self.pids()) >= 4)
+
+    def test_rolling_restart(self):
+        self.start(self.done, workers=2)
+        self.wait_for(lambda: len(self.pids()) == 2)
+        old_pids = set(self.pids())
+        os.kill(self.supervisor_pid, signal.SIGHUP)
+        self.wait_for(lambda: len(set(self.pids()) - old_pids) == 2)
+
+    def test_running_tasks_are_finished(self):
+        def slow(n):
+            time.sleep(0.5)
+            self.done(n)
+        self.start(slow, workers=1)
+        time.sleep(0.2)
+        self.stop()
+        self.assertEqual(sum(self.pids().values()), 1)
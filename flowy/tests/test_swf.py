@@ -0,0 +1,863 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from unittest import TestCase
+
+try:
+    from queue import Empty
+except ImportError:  # pragma: no cover
+    from Queue import Empty
+
+from flowy.backend.swf import AIMDRateLimit
+from flowy.backend.swf import HashRouting
+from flowy.backend.swf import LeastLoadedRouting
+from flowy.backend.swf import PendingActivityCounts
+from flowy.backend.swf import SWFActivityConfig
+from flowy.backend.swf import SWFActivityRegistry
+from flowy.backend.swf import RoundRobinRouting
+from flowy.backend.swf import SWFContext
+from flowy.backend.swf import SWFWorkflow
+from flowy.backend.swf import SWFWorkflowConfig
+from flowy.backend.swf import SWFWorkflowRegistry
+from flowy.backend.swf import _Hedges
+from flowy.backend.swf import _ResultSpill
+from flowy.backend.swf import _TaskListLoad
+from flowy.backend.swf import _WeightedQueue
+from flowy.backend.swf import _chunk_keys
+from flowy.backend.swf import load_events
+from flowy.base import RetryPolicy
+from flowy.base import restart
+from flowy.tests import histories
+
+
+class DummyLayer1(object):
+    def __init__(self):
+        self.decisions = []
+
+    def respond_decision_task_completed(self, task_token, decisions):
+        self.decisions.append(decisions)
+
+
+def make_context(running=(), timedout=(), results=None, errors=None,
+                 order=(), input_data='[[], {}]', decision_duration='10',
+                 **kwargs):
+    return SWFContext(DummyLayer1(), 'token', 'Name', '1', input_data,
+                      'tl', decision_duration, '100', None, 'TERMINATE',
+                      set(running), set(timedout), dict(results or {}),
+                      dict(errors or {}), list(order), **kwargs)
+
+
+def _history(*events):
+    return [{'eventId': i + 1, 'eventType': e_type,
+             '%sEventAttributes' % (e_type[0].lower() + e_type[1:]): attrs}
+            for i, (e_type, attrs) in enumerate(events)]
+
+
+def run_workflow(config, factory, context):
+    """Run a decision and return the decisions it sent."""
+    SWFWorkflow(config, factory).run(context)
+    [decisions] = context.layer1.decisions
+    return decisions
+
+
+class Checkpointed(object):
+    def __init__(self, a):
+        self.a = a
+
+    def run(self, n=0):
+        return self.a(n).result()
+
+    def checkpoint(self):
+        return restart(n=42)
+
+
+class TestCheckpoint(TestCase):
+    def run_workflow(self, context, **conf_kwargs):
+        conf = SWFWorkflowConfig(1, **conf_kwargs)
+        conf.conf_activity('a', 1)
+        return run_workflow(conf, Checkpointed, context)
+
+    def test_no_limits(self):
+        decisions = self.run_workflow(make_context(events=1000))
+        decision_types = [d['decisionType'] for d in decisions]
+        self.assertEqual(decision_types, ['ScheduleActivityTask'])
+
+    def test_events_limit(self):
+        [decision] = self.run_workflow(make_context(events=1000),
+                                       max_events=100)
+        self.assertEqual(decision['decisionType'],
+                         'ContinueAsNewWorkflowExecution')
+        attrs = decision['continueAsNewWorkflowExecutionDecisionAttributes']
+        self.assertEqual(json.loads(attrs['input']), [[], {'n': 42}])
+
+    def test_pages_limit(self):
+        [decision] = self.run_workflow(make_context(pages=3), max_pages=3)
+        self.assertEqual(decision['decisionType'],
+                         'ContinueAsNewWorkflowExecution')
+
+    def test_running_tasks_are_not_lost(self):
+        decisions = self.run_workflow(make_context(running=['a-0-0'],
+                                                   events=1000),
+                                      max_events=100)
+        self.assertEqual(decisions, [])
+
+
+class Slow(object):
+    def __init__(self, a):
+        self.a = a
+
+    def run(self):
+        first = self.a(1)
+        time.sleep(0.15)
+        second = self.a(2)
+        return first.result() + second.result()
+
+
+class TestDecisionBudget(TestCase):
+    def run_workflow(self, running=(), results=None, started=None,
+                     budget=0.1):
+        context = make_context(running, results=results, decision_duration='1',
+                               events=7, started=started, budget=budget)
+        conf = SWFWorkflowConfig(1)
+        conf.conf_activity('a', 1)
+        return run_workflow(conf, Slow, context)
+
+    def test_no_budget(self):
+        decisions = self.run_workflow(budget=None)
+        self.assertEqual([d['decisionType'] for d in decisions],
+                         ['ScheduleActivityTask', 'ScheduleActivityTask'])
+
+    def test_partial_decisions_are_sent(self):
+        [decision] = self.run_workflow()
+        self.assertEqual(decision['decisionType'], 'ScheduleActivityTask')
+
+    def test_new_decision_is_forced(self):
+        [decision] = self.run_workflow(started=time.time() - 0.5)
+        self.assertEqual(decision['decisionType'], 'StartTimer')
+        attrs = decision['startTimerDecisionAttributes']
+        self.assertEqual(attrs['timerId'], 'budget-7:t')
+        self.assertEqual(attrs['startToFireTimeout'], '0')
+
+    def test_running_tasks_trigger_the_new_decision(self):
+        decisions = self.run_workflow(running=['a-0-0'],
+                                      started=time.time() - 0.5)
+        self.assertEqual(decisions, [])
+
+    def test_budget_timer_is_not_a_retry_timer(self):
+        events = [
+            {'eventId': 1, 'eventType': 'TimerStarted',
+             'timerStartedEventAttributes': {'timerId': 'budget-7:t'}}]
+        running, _, results, _, _ = load_events(iter(events))
+        # the pending timer will trigger the next decision, no other is needed
+        decisions = self.run_workflow(running=running, results=results,
+                                      started=time.time() - 0.5)
+        self.assertEqual(decisions, [])
+        events.append({'eventId': 2, 'eventType': 'TimerFired',
+                       'timerFiredEventAttributes': {
+                           'timerId': 'budget-7:t'}})
+        running, _, results, _, _ = load_events(iter(events))
+        # once fired, the tasks are scheduled as first attempts
+        decisions = self.run_workflow(running=running, results=results,
+                                      budget=None)
+        attrs = [d['scheduleActivityTaskDecisionAttributes'] for d in decisions]
+        self.assertEqual([a['activityId'] for a in attrs], ['a-0-0', 'a-1-0'])
+
+
+class TestSharedRetryTimers(TestCase):
+    def run_workflow(self, context):
+        config = SWFWorkflowConfig(1, retry_bucket=60)
+        config.conf_activity('task', 1, retry=(0, 10))
+        return run_workflow(config, histories.FanOut, context)
+
+    def test_one_timer_per_bucket(self):
+        context = make_context(timedout=['task-0-0', 'task-2-0', 'task-4-0'],
+                               input_data='[[3], {}]')
+        [decision] = self.run_workflow(context)
+        self.assertEqual(decision['decisionType'], 'StartTimer')
+        attrs = decision['startTimerDecisionAttributes']
+        self.assertEqual(json.loads(attrs['control']),
+                         ['task-1-1', 'task-3-1', 'task-5-1'])
+        self.assertTrue(10 <= int(attrs['startToFireTimeout']) <= 70)
+
+    def test_fired_timers(self):
+        events = [
+            {'eventId': 1, 'eventType': 'TimerStarted',
+             'timerStartedEventAttributes': {
+                 'timerId': 'retry-60-0-0:t',
+                 'control': '["task-1-1", "task-3-1"]'}}]
+        running, _, results, _, _ = load_events(iter(events))
+        self.assertEqual(running, set(['task-1-1', 'task-3-1']))
+        events.append({'eventId': 2, 'eventType': 'TimerFired',
+                       'timerFiredEventAttributes': {
+                           'timerId': 'retry-60-0-0:t'}})
+        running, _, results, _, _ = load_events(iter(events))
+        self.assertEqual(running, set())
+        context = make_context(timedout=['task-0-0', 'task-2-0'],
+                               results=results, input_data='[[2], {}]')
+        decisions = self.run_workflow(context)
+        self.assertEqual([d['decisionType'] for d in decisions],
+                         ['ScheduleActivityTask', 'ScheduleActivityTask'])
+        attrs = [d['scheduleActivityTaskDecisionAttributes'] for d in decisions]
+        self.assertEqual([a['activityId'] for a in attrs],
+                         ['task-1-1', 'task-3-1'])
+
+    def test_chunks(self):
+        keys = ['task-%s-1' % i for i in range(1000)]
+        chunks = list(_chunk_keys(keys, size=1000))
+        self.assertTrue(all(len(chunk) <= 1000 for chunk in chunks))
+        self.assertEqual(sum((json.loads(c) for c in chunks), []), keys)
+
+
+calls = []
+
+
+def shard(n):
+    calls.append(n)
+    if n < 0:
+        raise ValueError('negative')
+    return 'shard-%s' % (n % 4)
+
+
+def slow_shard(n):
+    calls.append(n)
+    time.sleep(0.2)
+    return 'shard-%s' % (n % 4)
+
+
+class Sharded(object):
+    def __init__(self, shard, task):
+        self.shard = shard
+        self.task = task
+
+    def run(self, n):
+        return self.task(self.shard(n)).result()
+
+
+class TestLocalActivities(TestCase):
+    def setUp(self):
+        del calls[:]
+
+    def run_workflow(self, n, *history, **kwargs):
+        config = SWFWorkflowConfig(1)
+        config.conf_local_activity('shard', kwargs.pop('shard', shard),
+                                   timeout=kwargs.pop('timeout', 5))
+        config.conf_activity('task', 1)
+        context = make_context(*load_events(iter(_history(*history))),
+                               input_data='[[%s], {}]' % n, **kwargs)
+        return run_workflow(config, Sharded, context)
+
+    def test_run_inline(self):
+        marker, schedule = self.run_workflow(5)
+        self.assertEqual(calls, [5])
+        self.assertEqual(marker['decisionType'], 'RecordMarker')
+        attrs = marker['recordMarkerDecisionAttributes']
+        self.assertEqual(attrs['markerName'], 'shard-0-0:l')
+        self.assertEqual(json.loads(attrs['details']),
+                         ['result', '"shard-1"'])
+        attrs = schedule['scheduleActivityTaskDecisionAttributes']
+        self.assertEqual(json.loads(attrs['input']), [['shard-1'], {}])
+
+    def test_replay_from_marker(self):
+        [decision] = self.run_workflow(
+            5,
+            ('DecisionTaskStarted', {}),
+            ('DecisionTaskCompleted', {'startedEventId': 1}),
+            ('MarkerRecorded', {'markerName': 'shard-0-0:l',
+                                'decisionTaskCompletedEventId': 2,
+                                'details': '["result", "\\"shard-1\\""]'}),
+            ('ActivityTaskScheduled', {'activityId': 'task-0-0'}),
+            ('ActivityTaskCompleted', {'scheduledEventId': 4,
+                                       'result': '"done"'}))
+        self.assertEqual(calls, [])
+        self.assertEqual(decision['decisionType'],
+                         'CompleteWorkflowExecution')
+
+    def test_errors(self):
+        [fail] = self.run_workflow(-1)
+        self.assertEqual(calls, [-1])
+        self.assertEqual(fail['decisionType'], 'FailWorkflowExecution')
+        attrs = fail['failWorkflowExecutionDecisionAttributes']
+        self.assertIn('negative', attrs['reason'])
+
+    def test_timeouts_are_retried_in_a_new_decision(self):
+        marker, timer = self.run_workflow(5, shard=slow_shard, timeout=0.05)
+        self.assertEqual(calls, [5])
+        attrs = marker['recordMarkerDecisionAttributes']
+        self.assertEqual(json.loads(attrs['details']), ['timeout', None])
+        attrs = timer['startTimerDecisionAttributes']
+        self.assertEqual(attrs['timerId'], 'shard-1-1:t')
+        self.assertEqual(attrs['startToFireTimeout'], '0')
+
+    def test_not_enough_time_left(self):
+        # the decision times out in 10 seconds
+        started = time.time() - 8
+        [timer] = self.run_workflow(5, started=started)
+        self.assertEqual(calls, [])
+        attrs = timer['startTimerDecisionAttributes']
+        self.assertEqual(attrs['timerId'], 'shard-0-0:t')
+        # the new decision doesn't have enough time either
+        marker, timer = self.run_workflow(
+            5,
+            ('TimerStarted', {'timerId': 'shard-0-0:t'}),
+            ('TimerFired', {'timerId': 'shard-0-0:t'}),
+            started=started)
+        self.assertEqual(calls, [])
+        attrs = marker['recordMarkerDecisionAttributes']
+        self.assertEqual(json.loads(attrs['details']), ['timeout', None])
+        attrs = timer['startTimerDecisionAttributes']
+        self.assertEqual(attrs['timerId'], 'shard-1-1:t')
+        # with a budget, the time left is counted until the budget runs out
+        self.assertEqual(len(self.run_workflow(5, budget=0.8)), 2)
+        self.assertEqual(calls, [5])
+        del calls[:]
+        [timer] = self.run_workflow(5, budget=0.8, started=time.time() - 4)
+        self.assertEqual(calls, [])
+
+    def test_marker_order(self):
+        # the activity finished while the decision that ran shard was running
+        _, _, _, _, order = load_events(iter([
+            {'eventId': 1, 'eventType': 'ActivityTaskScheduled',
+             'activityTaskScheduledEventAttributes': {'activityId': 'a-0-0'}},
+            {'eventId': 2, 'eventType': 'DecisionTaskStarted',
+             'decisionTaskStartedEventAttributes': {}},
+            {'eventId': 3, 'eventType': 'ActivityTaskCompleted',
+             'activityTaskCompletedEventAttributes': {'scheduledEventId': 1,
+                                                      'result': '1'}},
+            {'eventId': 4, 'eventType': 'DecisionTaskCompleted',
+             'decisionTaskCompletedEventAttributes': {'startedEventId': 2}},
+            {'eventId': 5, 'eventType': 'MarkerRecorded',
+             'markerRecordedEventAttributes': {
+                 'markerName': 'shard-0-0:l', 'details': '["timeout", null]',
+                 'decisionTaskCompletedEventId': 4}},
+            {'eventId': 6, 'eventType': 'MarkerRecorded',
+             'markerRecordedEventAttributes': {
+                 'markerName': 'other', 'decisionTaskCompletedEventId': 4}},
+        ]))
+        self.assertEqual(order, ['shard-0-0', 'a-0-0'])
+
+
+class CountingLayer1(object):
+    def __init__(self, count):
+        self.count = count
+        self.calls = 0
+
+    def count_pending_activity_tasks(self, domain, task_list):
+        self.calls += 1
+        return {'count': self.count, 'truncated': False}
+
+
+class TestRateControl(TestCase):
+    def test_window(self):
+        limit = AIMDRateLimit(initial=4, maximum=5, target_delay=10)
+        self.assertEqual(limit.window([], 'tl'), 4)
+        # about a full window of fast starts grows the window by one
+        self.assertEqual(limit.window([('tl', 1)] * 4, 'tl'), 4)
+        self.assertEqual(limit.window([('tl', 1)] * 5, 'tl'), 5)
+        self.assertEqual(limit.window([('tl', 1)] * 100, 'tl'), 5)
+        self.assertEqual(limit.window([('tl', 1)] * 4, 'other'), 4)
+        self.assertEqual(limit.window([('tl', 30)], 'tl'), 2)
+        self.assertEqual(limit.window([(None, None)] * 5, 'other'), 1)
+        limit.pending = lambda task_list: 10
+        self.assertEqual(limit.window([], 'tl'), 2)
+
+    def test_signals(self):
+        load = _TaskListLoad()
+        load_events(iter([
+            {'eventId': 1, 'eventType': 'ActivityTaskScheduled',
+             'eventTimestamp': 100,
+             'activityTaskScheduledEventAttributes': {
+                 'activityId': 'task-0-0', 'taskList': {'name': 'tl'}}},
+            {'eventId': 2, 'eventType': 'ActivityTaskScheduled',
+             'eventTimestamp': 100,
+             'activityTaskScheduledEventAttributes': {
+                 'activityId': 'task-1-0', 'taskList': {'name': 'tl'}}},
+            {'eventId': 3, 'eventType': 'ActivityTaskStarted',
+             'eventTimestamp': 130,
+             'activityTaskStartedEventAttributes': {'scheduledEventId': 1}},
+            {'eventId': 4, 'eventType': 'ActivityTaskCompleted',
+             'activityTaskCompletedEventAttributes': {'scheduledEventId': 1,
+                                                      'result': '1'}},
+            {'eventId': 5, 'eventType': 'ScheduleActivityTaskFailed',
+             'scheduleActivityTaskFailedEventAttributes': {
+                 'activityId': 'task-2-0',
+                 'cause': 'OPEN_ACTIVITIES_LIMIT_EXCEEDED'}},
+        ]), load=load)
+        self.assertEqual(load.running, {'tl': 1})
+        self.assertEqual(load.signals, [('tl', 30), (None, None)])
+
+    def test_limited_scheduling(self):
+        load = _TaskListLoad()
+        load.activity_scheduled(1, 'tl', 100)
+        context = make_context(running=['task-0-0'], input_data='[[6], {}]',
+                               load=load)
+        config = SWFWorkflowConfig(1, rate_control=AIMDRateLimit(initial=3))
+        config.conf_activity('task', 1, task_list='tl')
+        decisions = run_workflow(config, histories.FanOut, context)
+        attrs = [d['scheduleActivityTaskDecisionAttributes'] for d in decisions]
+        self.assertEqual([a['activityId'] for a in attrs],
+                         ['task-1-0', 'task-2-0'])
+
+    def test_pending_counts_cached(self):
+        layer1 = CountingLayer1(7)
+        pending = PendingActivityCounts('domain', layer1, ttl=60)
+        self.assertEqual(pending('tl'), 7)
+        self.assertEqual(pending('tl'), 7)
+        self.assertEqual(layer1.calls, 1)
+        pending('other')
+        self.assertEqual(layer1.calls, 2)
+
+
+class Single(object):
+    def __init__(self, task):
+        self.task = task
+
+    def run(self):
+        return self.task().result()
+
+
+class TestHedges(TestCase):
+    scheduled = {'activityId': 'task-0-0', 'input': '[[1], {}]',
+                 'activityType': {'name': 'task', 'version': '1'},
+                 'taskList': {'name': 'tl'}, 'startToCloseTimeout': '60'}
+
+    def run_workflow(self, *history):
+        hedges = _Hedges()
+        context = make_context(*load_events(iter(_history(*history)),
+                                            hedges=hedges), hedges=hedges)
+        config = SWFWorkflowConfig(1)
+        config.conf_activity('task', 1, task_list='tl', hedge_after=5,
+                             hedge_task_list='fast')
+        return run_workflow(config, Single, context)
+
+    def test_hedge_timer(self):
+        timer, schedule = self.run_workflow()
+        attrs = timer['startTimerDecisionAttributes']
+        self.assertEqual(attrs['timerId'], 'task-0-0:h:t')
+        self.assertEqual(attrs['control'], 'fast')
+        self.assertEqual(schedule['decisionType'], 'ScheduleActivityTask')
+
+    def test_duplicate(self):
+        [schedule] = self.run_workflow(
+            ('TimerStarted', {'timerId': 'task-0-0:h:t', 'control': 'fast'}),
+            ('ActivityTaskScheduled', self.scheduled),
+            ('TimerFired', {'timerId': 'task-0-0:h:t'}))
+        attrs = schedule['scheduleActivityTaskDecisionAttributes']
+        self.assertEqual(attrs['activityId'], 'task-0-0:h')
+        self.assertEqual(attrs['taskList'], {'name': 'fast'})
+        self.assertEqual(attrs['input'], '[[1], {}]')
+        self.assertEqual(attrs['startToCloseTimeout'], '60')
+
+    def test_failure_waits_for_duplicate(self):
+        [complete] = self.run_workflow(
+            ('TimerStarted', {'timerId': 'task-0-0:h:t'}),
+            ('ActivityTaskScheduled', self.scheduled),
+            ('TimerFired', {'timerId': 'task-0-0:h:t'}),
+            ('ActivityTaskScheduled', dict(self.scheduled,
+                                           activityId='task-0-0:h')),
+            ('ActivityTaskFailed', {'scheduledEventId': 2, 'reason': 'err'}),
+            ('ActivityTaskCompleted', {'scheduledEventId': 4,
+                                       'result': '"fast"'}))
+        attrs = complete['completeWorkflowExecutionDecisionAttributes']
+        self.assertEqual(json.loads(attrs['result']), 'fast')
+
+    def test_hedge_timer_canceled(self):
+        cancel, complete = self.run_workflow(
+            ('TimerStarted', {'timerId': 'task-0-0:h:t'}),
+            ('ActivityTaskScheduled', self.scheduled),
+            ('ActivityTaskCompleted', {'scheduledEventId': 2,
+                                       'result': '"done"'}))
+        self.assertEqual(cancel['decisionType'], 'CancelTimer')
+        self.assertEqual(cancel['cancelTimerDecisionAttributes'],
+                         {'timerId': 'task-0-0:h:t'})
+        self.assertEqual(complete['decisionType'],
+                         'CompleteWorkflowExecution')
+        hedges = _Hedges()
+        load_events(iter(_history(
+            ('TimerStarted', {'timerId': 'task-0-0:h:t'}),
+            ('ActivityTaskScheduled', self.scheduled),
+            ('ActivityTaskCompleted', {'scheduledEventId': 2,
+                                       'result': '"done"'}),
+            ('TimerCanceled', {'timerId': 'task-0-0:h:t'}))), hedges=hedges)
+        self.assertEqual(hedges.timers, set())
+        self.assertEqual(hedges.cancel_timers, set())
+
+    def test_losers_are_ignored(self):
+        hedges = _Hedges()
+        running, _, results, errors, order = load_events(iter(_history(
+            ('TimerStarted', {'timerId': 'task-0-0:h:t'}),
+            ('ActivityTaskScheduled', self.scheduled),
+            ('TimerFired', {'timerId': 'task-0-0:h:t'}),
+            ('ActivityTaskScheduled', dict(self.scheduled,
+                                           activityId='task-0-0:h')),
+            ('ActivityTaskCompleted', {'scheduledEventId': 2,
+                                       'result': '1'}),
+            ('ActivityTaskCompleted', {'scheduledEventId': 4,
+                                       'result': '2'}),
+            ('ActivityTaskCancelRequested', {'activityId': 'task-0-0:h'}),
+            ('RequestCancelActivityTaskFailed',
+             {'activityId': 'task-0-0:h'}))), hedges=hedges)
+        self.assertEqual(running, set())
+        self.assertEqual(results, {'task-0-0': '1'})
+        self.assertEqual(errors, {})
+        self.assertEqual(order, ['task-0-0'])
+        self.assertEqual(hedges.cancel, set())
+        self.assertEqual(hedges.open, {})
+
+
+class TestRouting(TestCase):
+    task_lists = ['a', 'b', 'c']
+
+    def run_workflow(self, routing, n=6, timedout=()):
+        context = make_context(timedout=timedout,
+                               input_data='[[%s], {}]' % n)
+        config = SWFWorkflowConfig(1)
+        config.conf_activity('task', 1, task_list=self.task_lists,
+                             routing=routing, retry=(0, 0))
+        decisions = run_workflow(config, histories.FanOut, context)
+        attrs = [d['scheduleActivityTaskDecisionAttributes'] for d in decisions]
+        return [(a['activityId'], a['taskList']['name']) for a in attrs]
+
+    def test_hash(self):
+        routed = dict(self.run_workflow(None, 20))
+        self.assertTrue(set(routed.values()) <= set(self.task_lists))
+        self.assertTrue(len(set(routed.values())) > 1)
+        # the same input goes to the same task list
+        self.assertEqual(routed, dict(self.run_workflow(HashRouting(), 20)))
+
+    def test_round_robin(self):
+        routed = self.run_workflow(RoundRobinRouting(), 4,
+                                   timedout=['task-0-0'])
+        self.assertEqual(routed, [('task-1-1', 'b'), ('task-2-0', 'c'),
+                                  ('task-3-0', 'a'), ('task-4-0', 'b')])
+
+    def test_least_loaded(self):
+        pending = {'a': 2, 'b': 0, 'c': 1}
+        routed = self.run_workflow(LeastLoadedRouting(pending.get), 4)
+        self.assertEqual([task_list for _, task_list in routed],
+                         ['b', 'b', 'c', 'a'])
+
+
+def halve(n):
+    if n % 2:
+        raise ValueError('odd')
+    return n // 2
+
+
+def pad(n):
+    return 'x' * n
+
+
+class TestBatches(TestCase):
+    marker = ('MarkerRecorded', {'markerName': 'task-0-0:b',
+                                 'details': '["task-0-0", "task-1-0"]'})
+    scheduled = ('ActivityTaskScheduled', {'activityId': 'task-0-0:b'})
+
+    def run_workflow(self, n, events=(), **conf_kwargs):
+        context = make_context(*load_events(iter(_history(*events))),
+                               input_data='[[%s], {}]' % n)
+        config = SWFWorkflowConfig(1)
+        config.conf_activity('task', 1, task_list='tl', **conf_kwargs)
+        return run_workflow(config, histories.FanOut, context)
+
+    def test_batched_calls(self):
+        decisions = self.run_workflow(5, batch=2)
+        self.assertEqual([d['decisionType'] for d in decisions],
+                         ['RecordMarker', 'ScheduleActivityTask'] * 3)
+        attrs = [d['scheduleActivityTaskDecisionAttributes']
+                 for d in decisions[1::2]]
+        self.assertEqual([a['activityId'] for a in attrs],
+                         ['task-0-0:b', 'task-2-0:b', 'task-4-0:b'])
+        self.assertEqual(attrs[0]['activityType'],
+                         {'name': 'task-batch', 'version': '1'})
+        marker = decisions[0]['recordMarkerDecisionAttributes']
+        self.assertEqual(marker['markerName'], 'task-0-0:b')
+        self.assertEqual(json.loads(marker['details']),
+                         ['task-0-0', 'task-1-0'])
+        inputs = [json.loads(i) for i in json.loads(attrs[0]['input'])]
+        self.assertEqual(inputs, [[[0], {}], [[1], {}]])
+
+    def test_batch_window(self):
+        [timer] = self.run_workflow(3, batch=10, batch_window=60)
+        attrs = timer['startTimerDecisionAttributes']
+        self.assertEqual(json.loads(attrs['control']),
+                         ['task-0-0', 'task-1-0', 'task-2-0'])
+
+    def test_demultiplexed_results(self):
+        completed = ('ActivityTaskCompleted', {
+            'scheduledEventId': 2,
+            'result': '[["result", "1"], ["error", "odd"]]'})
+        decisions = self.run_workflow(
+            2, [self.marker, self.scheduled, completed], batch=2)
+        self.assertEqual([d['decisionType'] for d in decisions],
+                         ['FailWorkflowExecution'])
+        running, _, results, errors, order = load_events(iter(_history(
+            self.marker, self.scheduled, completed)))
+        self.assertEqual(running, set())
+        self.assertEqual(results, {'task-0-0': '1'})
+        self.assertEqual(errors, {'task-1-0': 'odd'})
+        self.assertEqual(order, ['task-0-0', 'task-1-0'])
+
+    def test_batch_timeout(self):
+        _, timedout, _, _, order = load_events(iter(_history(
+            self.marker, self.scheduled,
+            ('ActivityTaskTimedOut', {'scheduledEventId': 2}))))
+        self.assertEqual(timedout, set(['task-0-0', 'task-1-0']))
+        self.assertEqual(order, ['task-0-0', 'task-1-0'])
+
+    def test_batch_activity(self):
+        registry = SWFActivityRegistry()
+        registry.register(SWFActivityConfig(1, batch=True), halve)
+        self.assertIn(('halve', '1'), registry.registry)
+        result = registry(('halve-batch', '1'),
+                          json.dumps(['[[4], {}]', '[[3], {}]']))
+        self.assertEqual(json.loads(result), [['result', '2'],
+                                              ['error', 'odd']])
+
+    def test_large_batch_results(self):
+        registry = SWFActivityRegistry()
+        registry.register(SWFActivityConfig(1, batch=True), pad)
+        sizes = [10, 20000, 15000, 30000]
+        result = registry(('pad-batch', '1'),
+                          json.dumps(['[[%s], {}]' % n for n in sizes]))
+        self.assertTrue(len(result) <= 32768)
+        # the largest results are dropped first
+        outcomes = json.loads(result)
+        self.assertEqual(outcomes[0], ['result', json.dumps('x' * 10)])
+        self.assertEqual(outcomes[2], ['result', json.dumps('x' * 15000)])
+        self.assertEqual(outcomes[1][0], 'error')
+        self.assertEqual(outcomes[3][0], 'error')
+
+    def test_invalid_batch_result(self):
+        _, _, results, errors, order = load_events(iter(_history(
+            self.marker, self.scheduled,
+            ('ActivityTaskCompleted', {'scheduledEventId': 2,
+                                       'result': '[["result", "1"], ["res'}))))
+        self.assertEqual(results, {})
+        self.assertEqual(sorted(errors), ['task-0-0', 'task-1-0'])
+        self.assertIn('Invalid batch result', errors['task-0-0'])
+        self.assertEqual(order, ['task-0-0', 'task-1-0'])
+
+    def test_batch_schedule_failed(self):
+        # the event has no control field, the call keys are in the marker
+        running, _, _, errors, order = load_events(iter(_history(
+            self.marker,
+            ('ScheduleActivityTaskFailed', {
+                'activityId': 'task-0-0:b',
+                'activityType': {'name': 'task-batch', 'version': '1'},
+                'cause': 'ACTIVITY_TYPE_DOES_NOT_EXIST',
+                'decisionTaskCompletedEventId': 1}))))
+        self.assertEqual(running, set())
+        self.assertEqual(errors, {'task-0-0': 'ACTIVITY_TYPE_DOES_NOT_EXIST',
+                                  'task-1-0': 'ACTIVITY_TYPE_DOES_NOT_EXIST'})
+        self.assertEqual(order, ['task-0-0', 'task-1-0'])
+
+
+class TestRetryPolicy(TestCase):
+    def test_backoff(self):
+        policy = RetryPolicy(max_attempts=5, delay=10, max_delay=25, jitter=0)
+        delays = [policy.attempt_delay(i, 'a-0-0') for i in range(6)]
+        self.assertEqual(delays, [0, 10, 20, 25, 25, None])
+
+    def test_jitter(self):
+        policy = RetryPolicy(max_attempts=2, delay=100, jitter=0.5)
+        delays = [policy.attempt_delay(1, 'a-%s-0' % i) for i in range(20)]
+        self.assertTrue(all(50 <= d <= 100 for d in delays))
+        self.assertTrue(len(set(delays)) > 1)
+        # the same on every replay
+        self.assertEqual(delays, [policy.attempt_delay(1, 'a-%s-0' % i)
+                                  for i in range(20)])
+
+    def run_workflow(self, **kwargs):
+        context = make_context(errors={'task-0-0': 'err!'}, order=['task-0-0'],
+                               times={'task-0-0': [1000.0, 1100.0]})
+        config = SWFWorkflowConfig(1)
+        config.conf_activity('task', 1, retry=RetryPolicy(
+            delay=0, retry_on=lambda reason: True, **kwargs))
+        [decision] = run_workflow(config, Single, context)
+        return decision
+
+    def test_retry_error(self):
+        decision = self.run_workflow(max_elapsed=200)
+        attrs = decision['scheduleActivityTaskDecisionAttributes']
+        self.assertEqual(attrs['activityId'], 'task-1-1')
+
+    def test_max_elapsed(self):
+        decision = self.run_workflow(max_elapsed=50)
+        self.assertEqual(decision['decisionType'],
+                         'FailWorkflowExecution')
+
+
+class TestWeightedQueue(TestCase):
+    def test_weighted_round_robin(self):
+        queue = _WeightedQueue([3, 1])
+        for _ in range(6):
+            queue.put(0, 'a')
+            queue.put(1, 'b')
+        # three a for each b, until there are no more a
+        picks = ''.join(queue.get() for _ in range(12))
+        self.assertEqual(picks, 'aabaaababbbb')
+        self.assertRaises(Empty, queue.get, 0.01)
+
+
+class TestSyntheticHistories(TestCase):
+    def replay(self, shape, spill=None):
+        pages = histories.shapes[shape](100)
+        events = [e for page in pages for e in page['events']]
+        attrs = events[0]['workflowExecutionStartedEventAttributes']
+        context = make_context(*load_events(iter(events), spill=spill),
+                               input_data=attrs['input'])
+        config, factory = histories.workflows[shape]
+        [decision] = run_workflow(config, factory, context)
+        self.assertEqual(decision['decisionType'],
+                         'CompleteWorkflowExecution')
+        attrs = decision['completeWorkflowExecutionDecisionAttributes']
+        return json.loads(attrs['result'])
+
+    def test_fanout(self):
+        self.assertEqual(self.replay('fanout'), sum(range(33)))
+
+    def test_chain(self):
+        self.assertEqual(self.replay('chain'), 16)
+
+    def test_retries(self):
+        self.assertEqual(self.replay('retries'), sum(range(16)))
+
+    def test_timers(self):
+        self.assertEqual(self.replay('timers'), sum(range(20)))
+
+    def test_spilled_results(self):
+        spill = _ResultSpill(threshold=1)
+        self.assertEqual(self.replay('fanout', spill), sum(range(33)))
+        self.assertEqual(self.replay('chain', spill), 16)
+
+
+class TestProxyCall(TestCase):
+    def bind(self, **kwargs):
+        config, _ = histories.workflows['fanout']
+        context = make_context(**kwargs)
+        return config.proxy_factory_registry['task'].bind(context)
+
+    def test_running_tasks_share_the_placeholder(self):
+        task = self.bind(running=['task-0-0', 'task-1-0'])
+        self.assertTrue(task(0) is task(1))
+
+    def test_nested_results(self):
+        task = self.bind(results={'task-0-0': '1', 'task-1-0': '2'},
+                         running=['task-2-0'],
+                         order=['task-0-0', 'task-1-0'])
+        done = [task(0), task(1)]
+        running = task(2)
+        task({'done': done, 'running': (running,)})
+        self.assertEqual(task.context.decisions._data, [])
+        task({'done': done})
+        [decision] = task.context.decisions._data
+        attrs = decision['scheduleActivityTaskDecisionAttributes']
+        self.assertEqual(json.loads(attrs['input']),
+                         [[{'done': [1, 2]}], {}])
+        # only the immutable containers are not walked again
+        self.assertNotIn(id(done), task.resolved)
+        frozen = tuple(done)
+        task(frozen, (done,))
+        self.assertIn(id(frozen), task.resolved)
+        self.assertEqual(len(task.resolved), 1)
+
+    def test_lists_changed_in_place(self):
+        task = self.bind(results={'task-0-0': '1'}, errors={'task-1-0': 'x'},
+                         order=['task-0-0', 'task-1-0'])
+        done, failed = task(0), task(1)
+        results = [done]
+        task(results)
+        self.assertEqual(len(task.context.decisions._data), 1)
+        results[0] = failed
+        self.assertTrue(task(results).is_error())
+        self.assertEqual(len(task.context.decisions._data), 1)
+
+    def test_results_are_slotted(self):
+        task = self.bind(results={'task-0-0': '7'}, order=['task-0-0'])
+        result = task(0)
+        self.assertFalse(hasattr(result, '__dict__'))
+        self.assertEqual(result.result(), 7)
+
+
+class TestResultSpill(TestCase):
+    def test_small_results_stay_in_memory(self):
+        spill = _ResultSpill(threshold=10)
+        self.assertEqual(spill(u'small'), u'small')
+        self.assertEqual(spill(None), None)
+        self.assertEqual(spill.file, None)
+
+    def test_large_results_are_loaded_lazily(self):
+        spill = _ResultSpill(threshold=10)
+        first = spill(u'"%s"' % (u'\u0103' * 20))
+        self.assertEqual(first.load(), u'"%s"' % (u'\u0103' * 20))
+        # the file is mapped again for the results added later
+        second = spill(u'x' * 30)
+        self.assertEqual(second.load(), u'x' * 30)
+        self.assertEqual(first.load(), u'"%s"' % (u'\u0103' * 20))
+
+
+_WORKFLOW_MODULE = """
+from flowy.backend.swf import SWFWorkflowConfig
+
+@SWFWorkflowConfig(1)
+class %s(object):
+    def run(self):
+        pass
+"""
+
+
+class TestScanManifest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.package = os.path.join(self.path, 'manifest_pkg')
+        os.mkdir(self.package)
+        self.write('__init__.py', '')
+        self.write('workflows.py', _WORKFLOW_MODULE % 'Scanned')
+        self.write('other.py', 'x = 1\n')
+        self.manifest = os.path.join(self.path, 'manifest.json')
+        sys.path.insert(0, self.path)
+
+    def tearDown(self):
+        sys.path.remove(self.path)
+        self.unload()
+        shutil.rmtree(self.path)
+
+    def write(self, name, source, mtime=None):
+        path = os.path.join(self.package, name)
+        with open(path, 'w') as f:
+            f.write(source)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def unload(self):
+        for name in list(sys.modules):
+            if name.startswith('manifest_pkg'):
+                del sys.modules[name]
+
+    def scan(self):
+        self.unload()
+        __import__('manifest_pkg')
+        registry = SWFWorkflowRegistry()
+        registry.scan(package=sys.modules['manifest_pkg'],
+                      manifest=self.manifest)
+        return sorted(registry.registry)
+
+    def test_manifest_is_reused(self):
+        self.assertEqual(self.scan(), [('Scanned', '1')])
+        self.assertTrue(os.path.exists(self.manifest))
+        self.assertEqual(self.scan(), [('Scanned', '1')])
+        self.assertNotIn('manifest_pkg.other', sys.modules)
+
+    def test_stale_manifest(self):
+        self.scan()
+        self.write('other.py', _WORKFLOW_MODULE % 'Added', mtime=1)
+        self.assertEqual(self.scan(), [('Added', '1'), ('Scanned', '1')])
+        self.assertIn('manifest_pkg.other', sys.modules)
+
+    def test_new_module(self):
+        self.scan()
+        self.write('new.py', _WORKFLOW_MODULE % 'New')
+        self.assertEqual(self.scan(), [('New', '1'), ('Scanned', '1')])